@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Mide el tiempo de importación de pygeonica y comprueba qué dependencias pesadas se cargan en cada caso.
+
+Cada importación se hace en un intérprete nuevo, repitiéndola varias veces y tomando la mediana.
+Uso:
+    python benchmarks/importacion.py [--repeticiones N] [--limite SEGUNDOS]
+
+Con --limite, termina con error si "import pygeonica" tarda más de ese tiempo o importa alguna
+dependencia pesada, de forma que puede utilizarse como comprobación automática.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Módulos cuya importación es costosa y que solo deben cargarse cuando se utilizan
+DEPENDENCIAS_PESADAS = ['pandas', 'numpy', 'pyodbc', 'serial', 'pyarrow']
+
+CASOS = {
+    'import pygeonica': 'import pygeonica',
+    'import pygeonica.configuracion': 'import pygeonica.configuracion',
+    'import pygeonica.estacion': 'import pygeonica.estacion',
+    'import pygeonica.bbdd': 'import pygeonica.bbdd',
+}
+
+_PLANTILLA = '''
+import sys, time, json
+sys.path.insert(0, {raiz!r})
+t = time.perf_counter()
+{sentencia}
+t = time.perf_counter() - t
+print(json.dumps({{'tiempo': t, 'cargados': [m for m in {pesadas!r} if m in sys.modules]}}))
+'''
+
+
+def mide(sentencia, repeticiones):
+    """
+    Importa la sentencia en un intérprete nuevo tantas veces como se indique.
+
+    Returns
+    -------
+    tiempo : float
+        Mediana del tiempo de importación, en segundos.
+    cargados : list
+        Dependencias pesadas cargadas tras la importación.
+    """
+
+    codigo = _PLANTILLA.format(raiz=RAIZ, sentencia=sentencia, pesadas=DEPENDENCIAS_PESADAS)
+    tiempos = []
+    for _ in range(repeticiones):
+        salida = subprocess.run([sys.executable, '-c', codigo], capture_output=True, text=True, check=True)
+        resultado = json.loads(salida.stdout.strip().splitlines()[-1])
+        tiempos.append(resultado['tiempo'])
+    return statistics.median(tiempos), resultado['cargados']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tiempo de importación de pygeonica')
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--limite', type=float, default=None,
+                        help='Tiempo máximo (s) de "import pygeonica"')
+    args = parser.parse_args()
+
+    correcto = True
+    for nombre, sentencia in CASOS.items():
+        try:
+            tiempo, cargados = mide(sentencia, args.repeticiones)
+        except subprocess.CalledProcessError as error:
+            print('%-32s error: %s' % (nombre, error.stderr.strip().splitlines()[-1]))
+            continue
+        print('%-32s %8.1f ms   dependencias: %s' % (nombre, tiempo * 1000, ', '.join(cargados) or '-'))
+
+        if (args.limite is not None) and (nombre == 'import pygeonica'):
+            if tiempo > args.limite:
+                print('  Supera el límite de %.1f ms' % (args.limite * 1000))
+                correcto = False
+            if cargados:
+                print('  No debería importar: ' + ', '.join(cargados))
+                correcto = False
+
+    sys.exit(0 if correcto else 1)
+
+
+if __name__ == '__main__':
+    main()
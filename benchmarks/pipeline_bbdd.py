@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de la lectura y exportación de datos de bbdd sin servidor de Geonica.
+
+Genera una base de datos SQLite con las tablas Datos, Canales, Parametros_spanish, Funciones y Funciones_MI,
+con las estaciones y canales del apartado Tipo_Lectura_Canales del fichero de configuración (los canales de
+medias con sus máximos y mínimos, como se configuran en Teletrans), y la utiliza en lugar del servidor SQL
+mediante configura_pool(fabrica=...).
+
+Para periodos de 1 día, 1 mes y 1 año mide, en cada etapa, el tiempo, las estaciones-día por segundo,
+las filas leídas y la memoria máxima reservada (tracemalloc). Con --etapas se muestra además el desglose
+de genera_fichero_meteo() por etapa interna (consulta, pivot, ajuste de medias, hora civil, escritura...).
+Uso:
+    python benchmarks/pipeline_bbdd.py [--periodos dia mes anio] [--db FICHERO] [--json FICHERO] [--etapas]
+
+La base de datos se genera la primera vez y se reutiliza en las siguientes ejecuciones.
+El año completo ocupa varios GB; para pruebas rápidas: --periodos dia mes
+"""
+
+import argparse
+import datetime as dt
+import functools
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pygeonica import bbdd, instrumentacion
+
+# Año de los datos sintéticos, con sus dos cambios de hora
+INICIO = dt.datetime(2019, 1, 1)
+PERIODOS = {'dia': 1, 'mes': 30, 'anio': 365}
+
+# Funciones de la tabla Funciones_MI (Ididioma 1034)
+FUNCIONES = {0: 'Ins.', 1: 'Med', 2: 'Acu', 3: 'Int', 4: 'Max', 5: 'Min', 9: 'OR Lógica'}
+
+# Fracción de minutos sin dato de cada canal, para que se interpolen los valores medios
+FRACCION_HUECOS = 0.002
+
+# La fecha se pasa a SQLite en el mismo formato en que se guarda
+sqlite3.register_adapter(dt.datetime, lambda fecha: fecha.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def _conecta(path):
+    # Fábrica de conexiones del pool, a nivel de módulo para poder usarse con workers
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+def genera_bbdd(path, dias):
+    """
+    Crea la base de datos sintética con los datos de las estaciones operativas durante el número
+    de días indicado (más un día antes y otro después), si no existe ya con esos días.
+    """
+
+    fin = INICIO + dt.timedelta(days=dias + 1)
+    if os.path.isfile(path):
+        with sqlite3.connect(path) as conexion:
+            try:
+                if conexion.execute('SELECT Fin FROM Benchmark').fetchone()[0] >= str(fin):
+                    return
+            except sqlite3.Error:
+                pass
+        os.remove(path)
+
+    estaciones = bbdd.lee_config('Estaciones Operativas', bbdd.PATH_CONFIG_PYGEONICA)
+    tipos = bbdd.lee_config('Tipo_Lectura_Canales', bbdd.PATH_CONFIG_PYGEONICA)
+    numero_funcion = {nombre: numero for numero, nombre in FUNCIONES.items()}
+
+    conexion = sqlite3.connect(path)
+    conexion.executescript('''
+        CREATE TABLE Datos (NumEstacion INTEGER, Fecha TIMESTAMP, NumParametro INTEGER, NumFuncion INTEGER, Valor REAL);
+        CREATE TABLE Parametros_spanish (NumParametro INTEGER, Nombre TEXT, Abreviatura TEXT, Unidad TEXT);
+        CREATE TABLE Canales (NumEstacion INTEGER, Canal INTEGER, NumParametro INTEGER, NumFuncion INTEGER);
+        CREATE TABLE Funciones (NumFuncion INTEGER, Nombre TEXT);
+        CREATE TABLE Funciones_MI (NumFuncion INTEGER, Nombre TEXT, Ididioma INTEGER);
+        CREATE TABLE Benchmark (Fin TEXT);
+    ''')
+    for numero, nombre in FUNCIONES.items():
+        conexion.execute('INSERT INTO Funciones VALUES (?, ?)', (numero, nombre))
+        conexion.execute('INSERT INTO Funciones_MI VALUES (?, ?, 1034)', (numero, nombre))
+
+    # Canales de cada estación: (NumParametro, funciones)
+    parametros = {}
+    canales = {}
+    for estacion in estaciones:
+        canales[estacion] = []
+        for canal, (abreviatura, tipo) in enumerate(tipos[estacion].items(), start=1):
+            if abreviatura not in parametros:
+                parametros[abreviatura] = len(parametros) + 1
+                conexion.execute('INSERT INTO Parametros_spanish VALUES (?, ?, ?, ?)',
+                                 (parametros[abreviatura], abreviatura, abreviatura, 'u'))
+            funciones = [numero_funcion[tipo]]
+            if tipo == 'Med':
+                funciones = [4, 1, 5]
+            for funcion in funciones:
+                conexion.execute('INSERT INTO Canales VALUES (?, ?, ?, ?)',
+                                 (estacion, canal, parametros[abreviatura], funcion))
+            canales[estacion].append((parametros[abreviatura], funciones))
+
+    # Los datos se generan e insertan día a día
+    rng = np.random.default_rng(0)
+    minutos = np.arange(24 * 60)
+    for d in range(dias + 2):
+        dia = np.datetime64(INICIO - dt.timedelta(days=1) + dt.timedelta(days=d), 'm')
+        fechas = np.char.replace(np.datetime_as_string(dia + minutos, unit='s'), 'T', ' ')
+        filas = []
+        for estacion in estaciones:
+            for parametro, funciones in canales[estacion]:
+                base = 100 * np.sin((d * 1440 + minutos) / 300.0 + parametro) + 10 * parametro
+                presentes = np.nonzero(rng.random(len(minutos)) > FRACCION_HUECOS)[0]
+                for funcion in funciones:
+                    valores = base + (funcion - 1) * 3 + rng.normal(0, 1, len(minutos))
+                    filas += zip([estacion] * len(presentes), fechas[presentes].tolist(), [parametro] * len(presentes),
+                                 [funcion] * len(presentes), valores[presentes].tolist())
+        conexion.executemany('INSERT INTO Datos VALUES (?, ?, ?, ?, ?)', filas)
+        conexion.commit()
+
+    conexion.execute('CREATE INDEX ix_datos ON Datos (NumEstacion, Fecha)')
+    conexion.execute('INSERT INTO Benchmark VALUES (?)', (str(fin),))
+    conexion.commit()
+    conexion.close()
+
+
+def _etapas(estaciones, dias, directorio):
+    # Funciones de cada etapa del benchmark, que devuelven el número de filas que leen o escriben
+    ini = INICIO.strftime('%Y-%m-%d')
+    fin = (INICIO + dt.timedelta(days=dias - 1)).strftime('%Y-%m-%d')
+    fin_raw = (INICIO + dt.timedelta(days=dias)).strftime('%Y-%m-%d')
+
+    def consulta():
+        return sum(len(bloque) for bloque in bbdd.iter_data_raw(estaciones, ini, fin_raw))
+
+    def lee_estacion():
+        return sum(len(data) for estacion in estaciones
+                   for _, data in bbdd.lee_periodo_geonica_ddbb(ini, fin, estacion))
+
+    def lee_estaciones():
+        return sum(len(data) for _, data in bbdd.lee_periodo_estaciones_ddbb(ini, fin, estaciones))
+
+    def genera():
+        bbdd.genera_fichero_meteo(ini, fin, path_fichero=directorio + os.sep)
+        return sum(1 for nombre in os.listdir(directorio))
+
+    etapas = {
+        'iter_data_raw': consulta,
+        'lee_periodo_geonica_ddbb': lee_estacion,
+        'lee_periodo_estaciones_ddbb': lee_estaciones,
+        'genera_fichero_meteo': genera,
+    }
+    if dias == 1:
+        etapas['get_data_raw'] = lambda: len(bbdd.get_data_raw(estaciones, ini, fin_raw))
+        etapas['lee_dia_geonica_ddbb'] = lambda: sum(len(bbdd.lee_dia_geonica_ddbb(ini, e)) for e in estaciones)
+    return etapas
+
+
+def mide(funcion, memoria=True):
+    """
+    Ejecuta la función y devuelve su resultado, el tiempo y la memoria máxima reservada (bytes).
+    La memoria se mide en una segunda ejecución, ya que tracemalloc ralentiza la primera.
+    """
+
+    t = time.perf_counter()
+    resultado = funcion()
+    tiempo = time.perf_counter() - t
+
+    pico = None
+    if memoria:
+        tracemalloc.start()
+        funcion()
+        pico = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return resultado, tiempo, pico
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de bbdd con una base de datos SQLite')
+    parser.add_argument('--periodos', nargs='+', choices=list(PERIODOS), default=list(PERIODOS))
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'pygeonica_benchmark.db'))
+    parser.add_argument('--json', default=None, help='Fichero en el que se guardan los resultados')
+    parser.add_argument('--sin-memoria', action='store_true', help='No mide la memoria (más rápido)')
+    parser.add_argument('--etapas', action='store_true',
+                        help='Muestra el desglose por etapa interna de genera_fichero_meteo()')
+    args = parser.parse_args()
+
+    dias_max = max(PERIODOS[periodo] for periodo in args.periodos)
+    t = time.perf_counter()
+    genera_bbdd(args.db, dias_max)
+    print('Base de datos: %s (%.1f s)' % (args.db, time.perf_counter() - t))
+
+    bbdd.configura_pool(fabrica=functools.partial(_conecta, args.db))
+    estaciones = bbdd.lee_config('Estaciones Operativas', bbdd.PATH_CONFIG_PYGEONICA)
+    # Los metadatos se leen antes, para no incluirlos en la primera etapa medida
+    for estacion in estaciones:
+        bbdd.get_channels_config(estacion)
+
+    resultados = []
+    print('%-6s %-28s %10s %16s %12s %12s' % ('Periodo', 'Etapa', 'Tiempo (s)', 'Estac.-día/s', 'Filas', 'Memoria (MB)'))
+    for periodo in args.periodos:
+        dias = PERIODOS[periodo]
+        with tempfile.TemporaryDirectory() as directorio:
+            for etapa, funcion in _etapas(estaciones, dias, directorio).items():
+                # Los mensajes de genera_fichero_meteo() no se muestran
+                with open(os.devnull, 'w') as nulo:
+                    salida, sys.stdout = sys.stdout, nulo
+                    try:
+                        filas, tiempo, pico = mide(funcion, memoria=not args.sin_memoria)
+                    finally:
+                        sys.stdout = salida
+                resultado = {'periodo': periodo, 'dias': dias, 'etapa': etapa, 'tiempo': tiempo,
+                             'estaciones_dia_s': len(estaciones) * dias / tiempo, 'filas': filas,
+                             'memoria_pico': pico}
+                resultados.append(resultado)
+                print('%-7s %-28s %10.3f %16.1f %12d %12s' % (
+                    periodo, etapa, tiempo, resultado['estaciones_dia_s'], filas,
+                    '-' if pico is None else '%.1f' % (pico / 1024**2)))
+
+            if args.etapas:
+                genera = _etapas(estaciones, dias, directorio)['genera_fichero_meteo']
+                with open(os.devnull, 'w') as nulo:
+                    salida, sys.stdout = sys.stdout, nulo
+                    try:
+                        with instrumentacion.Colector(memoria=not args.sin_memoria) as colector:
+                            genera()
+                    finally:
+                        sys.stdout = salida
+                resumen = colector.resumen()
+                print('\n%s, genera_fichero_meteo por etapa:' % periodo)
+                print('%-16s %8s %10s %12s %12s %12s' % ('Etapa', 'Medidas', 'Tiempo (s)', 'Filas ent.',
+                                                         'Filas sal.', 'Pico (MB)'))
+                for etapa, fila in resumen.iterrows():
+                    print('%-16s %8d %10.3f %12d %12d %12s' % (
+                        etapa, fila['medidas'], fila['tiempo'], fila['filas_entrada'], fila['filas_salida'],
+                        '-' if np.isnan(fila['memoria']) else '%.1f' % (fila['memoria'] / 1024**2)))
+                for resultado in resultados:
+                    if resultado['periodo'] == periodo and resultado['etapa'] == 'genera_fichero_meteo':
+                        resultado['etapas'] = resumen.reset_index().to_dict(orient='records')
+                print()
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(resultados, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,5 +5,18 @@ Created on Fri Mar  6 11:28:58 2020
 @author: Martin
 """
 
-from pygeonica import estacion
-from pygeonica import bbdd
\ No newline at end of file
+import importlib
+
+# Los submódulos se importan la primera vez que se utilizan (p.ej. pygeonica.bbdd), de forma que
+# "import pygeonica" no importa pandas, pyodbc ni pyserial hasta que se necesitan
+_SUBMODULOS = ('estacion', 'bbdd', 'cache', 'replica', 'configuracion', 'instrumentacion')
+
+
+def __getattr__(nombre):
+    if nombre in _SUBMODULOS:
+        return importlib.import_module('.' + nombre, __name__)
+    raise AttributeError("module '" + __name__ + "' has no attribute '" + nombre + "'")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULOS))
\ No newline at end of file
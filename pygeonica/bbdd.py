@@ -3,23 +3,29 @@
 
 @author: Martin
 """
-import pyodbc
 import pandas as pd
 import numpy as np
 import datetime as dt
-import yaml
 import csv
 import os
 import pytz
-from pathlib import Path
+import time
+import atexit
+import threading
+import queue
+import pickle
+import traceback
+import concurrent.futures
+import functools
+from contextlib import contextmanager
+
+from . import instrumentacion
+from .cache import CacheDatos
+from .configuracion import lee_config, PATH_CONFIG_PYGEONICA, PATH_CONFIG_SENSORES
 
 # En el servidor SQL hay que habilitar el puerto TCP del servidor y abrirlo en el firewall
 # https://docs.microsoft.com/es-es/sql/relational-databases/lesson-2-connecting-from-another-computer?view=sql-server-ver15
 
-module_path = os.path.dirname(__file__)
-PATH_CONFIG_PYGEONICA = str(Path(module_path, 'pygeonica_config.yaml'))
-PATH_CONFIG_SENSORES = str(Path(module_path, 'sensores_config.yaml'))
-
 # %%
 ###########################################################################################################
 ####
@@ -27,35 +33,6 @@ PATH_CONFIG_SENSORES = str(Path(module_path, 'sensores_config.yaml'))
 ####
 ###########################################################################################################
 
-def lee_config(dato, path):
-    '''
-    Lee del archuvo de configuración los datos que desee el usuario.
-
-    Parameters
-    ----------
-    dato : str
-        Opciones: Estaciones, Sensores, Servidor, BBDD
-    path : str, optional
-        Ruta al archivo de configuración. 
-        Por defecto es el archivo sensores_config.yaml que se encuentra
-        en la misma carpeta que el script.
-
-    Returns
-    -------
-    Dict
-        Diccionario con la configuración. Varía según la información solicitada.
-    '''
-     
-    try: 
-        with open(path,'r', encoding='utf8') as config_file:
-            config_yaml = yaml.load(config_file, Loader = yaml.FullLoader) #Se utiliza el FullLoader para evitar un mensaje de advertencia, ver https://msg.pyyaml.org/load para mas información
-                                                                    #No se utiliza el BasicLoader debido a que interpreta todo como strings, con FullLoader los valores numéricos los intrepreta como int o float
-        return config_yaml[dato]
-    except yaml.YAMLError:
-        print ("Error en el fichero de configuración")
-    except:
-        print("Error en la lectura del fichero")
-    
 servidor = lee_config('Servidor', PATH_CONFIG_PYGEONICA)
 bbdd = lee_config('BBDD', PATH_CONFIG_PYGEONICA)
 file = lee_config('File', PATH_CONFIG_PYGEONICA)
@@ -71,6 +48,34 @@ password = bbdd['Contrasena']
 
 DEFAULT_NAME = file['Nombre']
 DEFAULT_PATH = file['Path']
+
+# Parámetros por defecto del pool de conexiones a la base de datos
+POOL_TAMANO_MAX = 4             # Número máximo de conexiones abiertas a la vez
+POOL_TIEMPO_INACTIVIDAD = 300   # Segundos sin usarse tras los que una conexión libre se cierra
+POOL_TIEMPO_ESPERA = 60         # Segundos máximos de espera a que quede libre una conexión
+
+# Tiempo de vida (en segundos) de los metadatos de la BBDD (parámetros, funciones y canales) en la caché
+TTL_METADATOS = 3600
+
+# Número de filas que se leen de la base de datos en cada bloque en las lecturas por bloques
+CHUNK_DATOS = 200000
+
+# Número de elementos (bloques leídos o días pendientes de escribir) que se adelantan entre las etapas
+# de genera_fichero_meteo(), que se ejecutan en hilos distintos. Con 0 todo se hace en un único hilo
+PROFUNDIDAD_COLA = 2
+
+# Columnas de la tabla Datos
+COLUMNAS_DATOS = ['NumEstacion', 'Fecha', 'NumParametro', 'NumFuncion', 'Valor']
+
+# Tipos de las columnas de la tabla Datos, que se mantienen también en los DataFrames sin filas
+TIPOS_DATOS = {'NumEstacion': 'int64', 'Fecha': 'datetime64[ns]', 'NumParametro': 'int64', 'NumFuncion': 'int64',
+               'Valor': 'float64'}
+
+# Tipos de las columnas de la tabla Datos con compacto=True, que ocupan menos de la mitad de memoria
+TIPOS_COMPACTOS = {'NumEstacion': 'int32', 'NumParametro': 'int16', 'NumFuncion': 'int8', 'Valor': 'float32'}
+
+# Número máximo de sentencias preparadas (cursores) que se mantienen abiertas por cada conexión del pool
+SENTENCIAS_MAX = 32
     
 
 # pyodbc.drivers() # lista de drivers disponibles
@@ -117,426 +122,2155 @@ def _request_ddbb(server_address = SERVER_ADDRESS):       #request común a toda
     )
     return request;
 
-#%%
-###########################################################################################################
-####
-####        INTERFAZ DE USUARIO
-####
-###########################################################################################################
 
-def get_data_raw(numero_estacion, fecha_ini, fecha_fin = dt.date.today().strftime('%Y-%m-%d %H:%M')):
+def _filtro_canales(canales):
     """
     Info
     ----------
-    Se obtienen los datos en bruto de una estacion deseada, 
-        estos datos incluyen todos las funciones que estén configuradas en la estación.
+    Genera la condición SQL que selecciona de la tabla Datos solo los canales indicados,
+    agrupando los parámetros por función para que la condición sea lo más corta posible.
 
     Parameters
     ----------
-    numero_estacion : int
-        El número identificativo de la estación.
-    fecha_ini : str de datatime.date
-        La fecha de incio del periodo deseado.
-    fecha_fin : str de datatime.date, opcional
-        Fecha final del periodo. Por defecto es la fecha de hoy.
+    canales : iterable de (int, int)
+        Pares (NumParametro, NumFuncion) que se quieren obtener.
 
     Returns
     -------
-    data_raw : pandas.DataFrame
-        DataFrame con todos los datos de la base de datos en el periodo
-        deseado.
+    condicion : str
+        Condición con un marcador '?' por cada valor.
+    parametros : list
+        Valores de los marcadores, en orden.
 
     """
-
-    request = _request_ddbb()
     
-    query_data = (
-            "SELECT * FROM Datos "
-            "WHERE NumEstacion = " + str(numero_estacion) + " AND "
-            "Fecha >= '" + fecha_ini + "' AND "
-            "Fecha < '" + fecha_fin + "'"
-    ) #Se solicitan las medidas, junto son su correspondiende NumParámetro, de un periodo determinado
+    parametros_funcion = {}
+    for parametro, funcion in canales:
+        parametros_funcion.setdefault(int(funcion), set()).add(int(parametro))
     
-    #Se construye el DataFrame con los valores pedidos a la base de datos
-    data_raw = pd.read_sql(query_data, pyodbc.connect(request))
+    # Si no se ha solicitado ningún canal, la condición no selecciona ninguna fila
+    if len(parametros_funcion) == 0:
+        return '(1 = 0)', []
     
-    return data_raw
+    condiciones = []
+    parametros = []
+    for funcion, numeros in sorted(parametros_funcion.items()):
+        condiciones.append('(NumFuncion = ? AND NumParametro IN (' + ', '.join(['?'] * len(numeros)) + '))')
+        parametros += [funcion] + sorted(numeros)
+    return '(' + ' OR '.join(condiciones) + ')', parametros
 
 
-def get_parameters():
-    """
-    Info
-    -------
-    Mediante esta función se obtienen las funciones que están disponibles en la estacion,
-    junto con su número de parametro y unidad.    
-    
-    Returns
-    -------
-    data_parameters : pandas.DateFrame
-        DataFrame formada por: NumParametro, Nombre, Abreviatura y Unidad
+def _fecha_sql(fecha):
+    # Las fechas se pasan a la consulta como datetime, que el driver envía sin ambigüedad de formato
+    return pd.Timestamp(fecha).to_pydatetime()
 
-    """
-    
-    request = _request_ddbb()
-    
-    query_parameters = (
-            'SELECT NumParametro, Nombre, Abreviatura, Unidad FROM Parametros_spanish '
-    )
-    
-    data_parameters = (
-            pd.read_sql(query_parameters, pyodbc.connect(request))
-    )
+
+def _estaciones_canales(numero_estacion, canales):
+    # Devuelve la lista de estaciones solicitadas y el diccionario con los canales de cada una
+    if isinstance(numero_estacion, (list, tuple)):
+        estaciones = list(numero_estacion)
+    else:
+        estaciones = [numero_estacion]
+        if canales is not None:
+            canales = {numero_estacion: canales}
     
-    #parametros = data_parameters.set_index('NumParametro')
-    return data_parameters
+    if canales is None:
+        canales = {}
     
+    return estaciones, canales
 
-def get_channels_config(numero_estacion):
+
+def _filtra_canales(data, canales):
     """
     Info
     ----------
-    Devuelve una lista de los canales configurasdos en la estación indicada,
-    estos canales están ordenados en el mismo orden en el que los devuelve la estación
-    cuando se le solicita (mediante puerto Serie, conexión IP, etc. ) los datos de los canales.
+    Selecciona de los datos en bruto de una estación las filas de los canales indicados.
+    Equivale a la condición de _filtro_canales(), pero aplicada localmente.
 
     Parameters
     ----------
-    numero_estacion : int
-        El número identificativo de la estación.
+    data : pandas.DataFrame
+        Datos en bruto, con las columnas NumParametro y NumFuncion.
+    canales : iterable de (int, int)
+        Pares (NumParametro, NumFuncion) que se quieren obtener.
 
     Returns
     -------
-    canales : pandas.DataFrame
-        DataFrame con los canales configrados, formato: NumFuncion, Abreviatura y NumParametro
+    pandas.DataFrame
 
     """
-
-    request = _request_ddbb()
-    
-    query_channels_config = (
-            'SELECT Canales.NumFuncion, Canales.Canal, Parametros_spanish.Abreviatura, Parametros_spanish.NumParametro '
-            'FROM Canales '
-            'INNER JOIN Parametros_spanish ON Canales.NumParametro = Parametros_spanish.NumParametro '
-            'INNER JOIN Funciones ON Funciones.NumFuncion = Canales.NumFuncion '
-            'WHERE NumEstacion = ' + str(numero_estacion)
-    )
-    
-    data_channels_config = (
-            pd.read_sql(query_channels_config, pyodbc.connect(request))
-     )
-    
-    # Se obtiene la correspondecia Nombre de funcion -> número de función de la base de datos
-    numFunciones = get_functions().reset_index().set_index('Nombre')
     
-    # Diccionario en el que se indica que tipo de medida se desea alacenar por cada canal
-    tipo_medidas = lee_config('Tipo_Lectura_Canales', PATH_CONFIG_PYGEONICA)[numero_estacion]
-   
-    data_channels_config.set_index('Abreviatura', inplace=True)
+    pares = pd.MultiIndex.from_arrays([data['NumParametro'], data['NumFuncion']])
+    return data[pares.isin([(int(parametro), int(funcion)) for parametro, funcion in canales])]
 
-    # Se modifica el NunFuncion de cada medida para obtener las medidas deseadas por cada canal
-    # Se recorre la lista de canales...
-    for dato in data_channels_config.index:
-        # Hasta que se encuentre el canal que se desee modificar...
-        if dato in tipo_medidas.keys():
-            # Si la medida deseada se ha configurado en la estación...
-            numFuncion = int(numFunciones.loc[tipo_medidas[dato]])
-            # Si sólo hay una medida configurada...
-            if type(data_channels_config.loc[dato, 'NumFuncion']) == np.int64:
-                if numFuncion == data_channels_config.loc[dato, 'NumFuncion']:
-                    # Se modifica el dataframe, para que se guarden solo los valores deseados
-                    data_channels_config.loc[dato, 'NumFuncion'] = numFuncion
-            else: # En el caso de que se hayan configurado varios tipos de medidas...
-                if numFuncion in data_channels_config.loc[dato, 'NumFuncion'].tolist():
-                    # Se modifica el dataframe, para que se guarden solo los valores deseados
-                    vals = [numFuncion] * len(data_channels_config.loc[dato, 'NumFuncion'])
-                    data_channels_config.loc[dato, 'NumFuncion'] = vals
-     
-    data_channels_config.reset_index(inplace=True)
-            
-    # Se ordenan los canales por el número del 'Canal' que le corresponde en a base de datos
-    data_channels_config.set_index('Canal', inplace = True)
-    data_channels_config.sort_values(by = 'Canal', inplace= True)
-    # Se borran los duplicados en la columna de 'Abreviatura', y se quita la columna 'Canal' que no aporta información
-    # útil, ya que son valores propios de la base de datos.
-    canales = data_channels_config.drop_duplicates(subset='Abreviatura').reset_index().drop(columns='Canal')
-    
-    return canales
 
-def get_functions():
+def _query_datos(numero_estacion, fecha_ini, fecha_fin, canales=None, columnas=None, ordenado=False):
     """
     Info
-    -------
-    Devuelve una lista con el número correspondiente a la función.
+    ----------
+    Genera la consulta a la tabla Datos de get_data_raw() e iter_data_raw().
+    El texto de la consulta solo depende del número de estaciones y canales solicitados, no de
+    sus valores ni de las fechas, de forma que el servidor reutiliza el plan de ejecución.
+    
+    Parameters
+    ----------
+    numero_estacion, fecha_ini, fecha_fin, canales, columnas :
+        Ver get_data_raw().
+    ordenado : bool, opcional
+        Si es True, las filas se ordenan por fecha. Por defecto es False.
 
     Returns
     -------
-    funciones : pandas.DateFrame
-        DataFrame con NumFuncion y Nombre (de la función)
+    query_data : str
+    parametros : list
+        Valores de los marcadores '?' de la consulta.
 
     """
+
+    estaciones, canales = _estaciones_canales(numero_estacion, canales)
     
-    request = _request_ddbb()
+    # Las estaciones con canales indicados se filtran por ellos; el resto, solo por el número de estación
+    condiciones = []
+    parametros = []
+    for e in estaciones:
+        if e in canales:
+            filtro, parametros_filtro = _filtro_canales(canales[e])
+            condiciones.append("(NumEstacion = ? AND " + filtro + ")")
+            parametros += [int(e)] + parametros_filtro
+    sin_filtro = [int(e) for e in estaciones if e not in canales]
+    if len(sin_filtro) == 1:
+        condiciones.append("NumEstacion = ?")
+    elif len(sin_filtro) > 1:
+        condiciones.append("NumEstacion IN (" + ", ".join(['?'] * len(sin_filtro)) + ")")
+    parametros += sin_filtro
     
-    query_functions = (
-            'SELECT NumFuncion, Nombre FROM dbo.Funciones_MI '
-            'WHERE Ididioma = 1034' #Se solicita en nombre de las funciones en español; 2057, para inglés
-    )   
+    if columnas is None:
+        seleccion = "*"
+    else:
+        seleccion = ", ".join(columnas)
     
-    funciones = (
-            pd.read_sql(query_functions, pyodbc.connect(request))
-    )
+    query_data = (
+            "SELECT " + seleccion + " FROM Datos "
+            "WHERE (" + " OR ".join(condiciones) + ") AND "
+            "Fecha >= ? AND "
+            "Fecha < ?"
+    ) #Se solicitan las medidas, junto son su correspondiende NumParámetro, de un periodo determinado
+    parametros += [_fecha_sql(fecha_ini), _fecha_sql(fecha_fin)]
     
-    # Se establece 'NumFuncion' como índice
-    funciones.set_index('NumFuncion', inplace = True)
-    return funciones
+    if ordenado:
+        query_data += " ORDER BY Fecha"
+    
+    return query_data, parametros
+
 
+def _conecta_servidor():
+    # Fábrica de conexiones por defecto: servidor SQL de Geonica mediante pyodbc.
+    # pyodbc se importa al abrir la primera conexión, ya que no es necesario con otras fábricas
+    import pyodbc
+    return pyodbc.connect(_request_ddbb())
 
-def lee_dia_geonica_ddbb(dia, numero_estacion, lista_campos=None):
+
+class _PoolConexiones:
     """
     Info
     ----------
-    Se devuelven los datos de un día que se encuentran en la estación.
-
+    Pool de conexiones a la base de datos de Geonica, compartido por todas las funciones del módulo.
+    Mantiene abiertas las conexiones ya establecidas para reutilizarlas en las siguientes consultas,
+    evitando repetir la conexión TCP y el login con el servidor SQL en cada una de ellas.
+    
+    Por cada conexión se guarda además un registro de sentencias preparadas: un cursor por cada texto
+    de consulta ejecutado, de forma que al repetir la consulta con otros parámetros se reutiliza
+    la sentencia ya preparada en el servidor.
+    
     Parameters
     ----------
-    dia : datetime.date
-        Día del que se quieren extraer los datos.
-    numero_estacion : int
-        Número identificativo de la estación.
-    lista_campos : list, optional
-        lista con campos a obtener de la BBDD. 
-        Por defecto son todos los canales configurados en la estación.
-
-    Returns
-    -------
-    pandas.DataFrame
-        DataFrame con todos los datos de la estación, con la fecha y hora como índice.
+    fabrica : function, opcional
+        Función sin argumentos que devuelve una nueva conexión con la base de datos.
+        Por defecto se conecta al servidor SQL de Geonica mediante pyodbc.
+    tamano_max : int, opcional
+        Número máximo de conexiones abiertas a la vez. Si están todas en uso, se espera a que quede
+        libre alguna.
+    tiempo_inactividad : float, opcional
+        Segundos que puede permanecer libre una conexión antes de cerrarse.
+    tiempo_espera : float, opcional
+        Segundos máximos de espera a que quede libre una conexión.
 
     """
-
-    #Si el usuario no especifica ninguna lista de campos deseados, por defecto se devuelven todos los canales
-    # disponibles de la estación
-    formato_fecha = 'yyyy/mm/dd hh:mm'
-    if lista_campos == None:
-        lista_campos = get_channels_config(numero_estacion)['Abreviatura'].tolist()
-    # Se añade la fecha como columna, en el caso de que no esté incluida ya
-    if not formato_fecha in lista_campos:
-        lista_campos.insert(0, formato_fecha)
-    
-    dia_datetime = dt.datetime.combine(dia, dt.datetime.min.time())
-    formato_tiempo = '%Y-%m-%d %H:%M'
-    
-    # Como se lee hora UTC y la civil necesita de valores del día anterior, se leen minutos del día anterior
-    # El dataset tiene 1 día + 2 horas, que luego al convertir a hora civil se tomarán solo los minutos del día en cuestión
-    fecha_ini = (dia_datetime - dt.timedelta(hours=2)).strftime(formato_tiempo)
-    fecha_fin = (dia_datetime + dt.timedelta(hours=24)).strftime(formato_tiempo)
-                                                    
-    # https://docs.microsoft.com/es-es/sql/relational-databases/lesson-2-connecting-from-another-computer?view=sql-server-ver15
     
-    data = get_data_raw(numero_estacion, fecha_ini, fecha_fin)
+    def __init__(self, fabrica=_conecta_servidor, tamano_max=POOL_TAMANO_MAX,
+                 tiempo_inactividad=POOL_TIEMPO_INACTIVIDAD, tiempo_espera=POOL_TIEMPO_ESPERA):
+        self.fabrica = fabrica
+        self.tamano_max = tamano_max
+        self.tiempo_inactividad = tiempo_inactividad
+        self.tiempo_espera = tiempo_espera
+        
+        self._libres = []       # Lista de (conexión, instante del último uso), la última es la más reciente
+        self._en_uso = 0        # Número de conexiones entregadas y todavía no devueltas
+        self._sentencias = {}   # id(conexión) -> {texto de la consulta: cursor}, del más antiguo al más reciente
+        self._condicion = threading.Condition()
     
-    # Se procesa data solo si hay contenido
-    if len(data) != 0:
-        # dict_estacion tiene como indice el numero_estacion y contenido 'nombre_parametro_ficheros' y 'mtype'
-        # nombre, mtype
-        #   'mtype'     Measurement type: Enter an integer to determine which
-        #               information on each one minute interval to return.  Options are.
-        #               0       1   2   3   4   5
-        #               Ins.    Med Acu Int Max Min
-               
-        dict_estacion = get_channels_config(numero_estacion).set_index('NumParametro');
-           
-        def tipo_medida(d):
+    def _cierra(self, conexion):
+        with self._condicion:
+            sentencias = self._sentencias.pop(id(conexion), {})
+        for cursor in sentencias.values():
             try:
-                return dict_estacion.loc[d]['NumFuncion']
+                cursor.close()
             except:
-                pass        
+                pass
+        try:
+            conexion.close()
+        except:
+            pass
+    
+    @staticmethod
+    def _comprueba(conexion):
+        # Se comprueba que la conexión sigue viva antes de entregarla
+        try:
+            cursor = conexion.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except:
+            return False
+    
+    def obtiene(self):
+        """
+        Devuelve una conexión del pool, reutilizando una libre si la hay o abriendo una nueva
+        si no se ha alcanzado el tamaño máximo.
+        """
+        
+        limite = time.monotonic() + self.tiempo_espera
+        
+        with self._condicion:
+            while True:
+                # Se cierran las conexiones libres que llevan demasiado tiempo sin usarse
+                ahora = time.monotonic()
+                caducadas = [c for c, uso in self._libres if ahora - uso > self.tiempo_inactividad]
+                self._libres = [(c, uso) for c, uso in self._libres if ahora - uso <= self.tiempo_inactividad]
+                for conexion in caducadas:
+                    self._cierra(conexion)
+                
+                if self._libres:
+                    conexion = self._libres.pop()[0]
+                    break
+                if self._en_uso < self.tamano_max:
+                    conexion = None
+                    break
+                
+                restante = limite - ahora
+                if restante <= 0:
+                    raise TimeoutError('No hay conexiones libres con la base de datos.')
+                self._condicion.wait(restante)
             
-        # Selecciona las filas que tienen NumFuncion == el tipo de medida dado el NumParametro
-        data = data[data['NumFuncion'] ==
-                    data['NumParametro'].apply(tipo_medida)]
-
-        # Conversion de parametros en filas a columnas del Dataframe
-        data = data.pivot_table(index='Fecha', columns=[
-                                'NumParametro'], values='Valor')
-
-        # Si los valores son medias (mtype==1), sería el valor de hace 30 seg. Por lo tanto se toma el que realmente le corresponde.
-        # samplea cada 30seg, se interpola para que haya valor, se desplazan los valores 30seg para cuadrar y se reajusta de nuevo con el indice original.
+            self._en_uso += 1
+        
+        # La comprobación y la apertura de nuevas conexiones se hacen fuera del bloqueo,
+        # para no retener al resto de hilos mientras se espera al servidor
+        try:
+            if (conexion is not None) and (not self._comprueba(conexion)):
+                self._cierra(conexion)
+                conexion = None
+            if conexion is None:
+                conexion = self.fabrica()
+        except:
+            with self._condicion:
+                self._en_uso -= 1
+                self._condicion.notify()
+            raise
         
-        def adapta(columna):
+        return conexion
+    
+    def devuelve(self, conexion, valida=True):
+        """
+        Devuelve la conexión al pool. Si no es válida (p.ej. se ha producido un error durante
+        la consulta), se cierra en vez de reutilizarse.
+        """
+        
+        if valida:
             try:
-                #if dict_estacion[columna.name][1] == 1: Se sustituye por:
-                if dict_estacion.loc[columna.name]['NumFuncion'] == 1:
-                    return columna.resample('30S').interpolate(method='linear').shift(periods=-30, freq='S').reindex(data.index)
-                else:
-                    return columna
+                # Se cierra la transacción que haya podido abrir la consulta
+                conexion.rollback()
             except:
-                pass
-
-        data = data.apply(adapta, axis=0)
-        # El ultimo valor si se ha ajustado, se queda en NaN. Se arregla tomando el penultimo + diff
-        data.iloc[-1] = data.iloc[-2] + (data.diff().mean())
-
-        # Cambia codigo NumParametro de BBDD a su nombre de fichero
-        data_channels = get_parameters().set_index('NumParametro') #Se obtienen los números de los parámetros...
-        data.rename(columns = data_channels['Abreviatura'], inplace=True) #... y se sustituye el NumParametro por el Nombre
+                valida = False
         
-        # cambia index a hora civil
-        data.index = (data.index.tz_localize(pytz.utc).
-                      tz_convert(pytz.timezone('Europe/Madrid')).
-                      tz_localize(None))
-                
-        # quita los índices duplicados que se dan en el cambio de hora de otoño (se añade 1h)
-        data = data[~data.index.duplicated()]
+        with self._condicion:
+            self._en_uso -= 1
+            if valida and (len(self._libres) + self._en_uso < self.tamano_max):
+                self._libres.append((conexion, time.monotonic()))
+                conexion = None
+            self._condicion.notify()
         
-        # filtra y se queda solo con los minutos del dia en cuestion, una vez ya se han convertido a hora civil
-        data = data[str(dia)]
+        if conexion is not None:
+            self._cierra(conexion)
     
-    # Si data está vacio, se crea con valores NaN
-    indice_fecha = pd.Index(pd.date_range(
-        start=dia, end=dt.datetime.combine(dia, dt.time(23, 59)), freq='1T'))
-    if len(data) == 0:
-        data = pd.DataFrame(index=indice_fecha, columns=lista_campos)
+    def sentencia(self, conexion, sql):
+        """
+        Devuelve el cursor de la conexión con el que se ha ejecutado anteriormente la consulta sql,
+        o uno nuevo si es la primera vez. Al ejecutar de nuevo el mismo texto en el mismo cursor,
+        el driver reutiliza la sentencia ya preparada en vez de volver a prepararla.
+        Solo debe utilizarse con una conexión obtenida del pool y todavía no devuelta.
+        """
+        
+        with self._condicion:
+            sentencias = self._sentencias.setdefault(id(conexion), {})
+        
+        cursor = sentencias.pop(sql, None)
+        if cursor is None:
+            cursor = conexion.cursor()
+            # Si se supera el máximo, se cierra la sentencia utilizada hace más tiempo
+            if len(sentencias) >= SENTENCIAS_MAX:
+                antigua = sentencias.pop(next(iter(sentencias)))
+                try:
+                    antigua.close()
+                except:
+                    pass
+        # Se coloca al final, como la más reciente
+        sentencias[sql] = cursor
+        return cursor
+    
+    @contextmanager
+    def conexion(self):
+        """
+        Gestor de contexto que entrega una conexión y la devuelve al pool al terminar.
+        """
+        
+        conexion = self.obtiene()
+        try:
+            yield conexion
+        except:
+            self.devuelve(conexion, valida=False)
+            raise
+        else:
+            self.devuelve(conexion)
+    
+    def cierra(self):
+        """
+        Cierra todas las conexiones libres. Las que estén en uso se cerrarán al devolverse.
+        """
+        
+        with self._condicion:
+            libres = self._libres
+            self._libres = []
+            self.tamano_max = 0
+            self._condicion.notify_all()
+        
+        for conexion, _ in libres:
+            self._cierra(conexion)
 
-    # En caso de que el indice esté incompleto, se reindexa para que añada nuevos con valores NaN
-    if len(data) != len(indice_fecha):
-        data = data.reindex(index=indice_fecha)
 
-    # En caso de que el columns esté incompleto, se reindexa para que añada nuevos con valores NaN
+_pool = None
+_pool_pid = None        # Proceso en el que se ha creado el pool
+_pools_heredados = []   # Pools heredados del proceso padre, ver _obtiene_pool()
+_pool_lock = threading.Lock()
+_pool_parametros = {}   # Configuración indicada en configura_pool(), se mantiene aunque se cierren las conexiones
+_origen_servidor = None # Mientras se lee de una réplica, configuración del servidor que se restablece, ver configura_origen()
 
-    # lista_campos_corta = lista_campos.copy()
-    # lista_campos_corta.remove('yyyy/mm/dd hh:mm')
-    # lista_campos_corta.remove('yyyy/mm/dd')
-    # if set(lista_campos_corta).issuperset(data.columns):
-    #     data = data.reindex(columns=lista_campos)
-    if lista_campos != data.columns.tolist():
-        data = data.reindex(columns=lista_campos)
-    
-            
+def _obtiene_pool():
+    """
+    Devuelve el pool de conexiones del módulo, creándolo la primera vez que se utiliza.
+    Los procesos hijos (p.ej. genera_fichero_meteo() con workers) crean su propio pool, ya que
+    las conexiones heredadas del proceso padre no se pueden compartir.
+    """
     
-    # # Separa y crea en 2 columnas fecha y hora
-    # # tambien valdría data.index.strftime('%Y/%m/%d')
-    # data['yyyy/mm/dd'] = [d.strftime('%Y/%m/%d') for d in data.index]
-    # data['hh:mm'] = [d.strftime('%H:%M') for d in data.index]
-    data['yyyy/mm/dd hh:mm'] = [d.strftime('%Y/%m/%d %H:%M') for d in data.index]
+    global _pool, _pool_pid
+    with _pool_lock:
+        if (_pool is None) or (_pool_pid != os.getpid()):
+            # Las conexiones heredadas comparten el socket con el proceso padre, por lo que no se cierran;
+            # se mantiene una referencia al pool para que tampoco se cierren al liberarse
+            if _pool is not None:
+                _pools_heredados.append(_pool)
+            _pool = _PoolConexiones(**_pool_parametros)
+            _pool_pid = os.getpid()
+        return _pool
 
-    return data
+
+def _conexion():
+    """
+    Gestor de contexto con una conexión del pool. Uso:
+        with _conexion() as conexion:
+            cursor = conexion.cursor()
+    """
+    
+    return _obtiene_pool().conexion()
 
 
-def genera_fichero_meteo(dia_inicial, dia_final=None, nombre_fichero=None, path_fichero=DEFAULT_PATH):
+def _consulta(sql, params=(), pool=None):
     """
     Info
     ----------
-    Genera un fichero .txt por cada día del periodo solicitado.
-    
+    Ejecuta una consulta parametrizada con una conexión del pool, reutilizando la sentencia
+    preparada de la conexión si ya se ha ejecutado antes el mismo texto.
+
     Parameters
     ----------
-    dia_inicial : str(AAAA-MM-DD) o datetime-like
-    dia_final : str(AAAA-MM-DD) o datetime-like, opcional
-        Por defecto es el día antetior a la ejecución del código.
-    nombre_fichero : string, opcional
-        Por defecto es: meteo. Al nombre del fichero se añade la fecha del mismo.
-        Con lo que, por defecto, se generará un fichero: meteoAAAA_MM_DD.txt
-    path : string, opcional
-        Formato adecuado: 'C:/mi_usuario/mis_documentos/mi_carpeta/'
-        Rellenar en el caso de que el usuario
-        del script no sea el servidor.
+    sql : str
+        Consulta, con un marcador '?' por cada parámetro.
+    params : list, opcional
+        Valores de los marcadores, en orden.
+    pool : _PoolConexiones, opcional
+        Pool del que se obtiene la conexión. Por defecto es el del módulo.
 
     Returns
     -------
-    bool
-        True: Fichero creado correctamente
-        False: Error en la función
+    pandas.DataFrame
+        Filas devueltas por la consulta.
 
     """
     
-    #Si no se indica fecha del final del peridod deseado,
-    #se reciben los datos hasta el día anterior
-    if dia_final == None:
-        dia_final = dt.date.today() - dt.timedelta(days=1)
-
-    #En caso de no indicarse ningun nombre de fichero:
-    if nombre_fichero == None:
-        nombre_fichero = DEFAULT_NAME
-    
-    
-    # Generación fichero llamando a función lee_dia_geonica_ddbb(dia, lista_campos)
+    if pool is None:
+        pool = _obtiene_pool()
+    with pool.conexion() as conexion:
+        cursor = pool.sentencia(conexion, sql)
+        cursor.execute(sql, list(params))
+        nombres = [columna[0] for columna in cursor.description]
+        filas = cursor.fetchall()
     
-    # Se llama tantas veces a la funcion lee_dia_geonica_ddbb() como días haya en el perido indicado
-    for d in pd.date_range(start=dia_inicial, end=dia_final):
-        dia = d.date()
-        
-        # Listas con las estacinones en funcionamiento
-        estaciones = lee_config('Estaciones Operativas', PATH_CONFIG_PYGEONICA)
-        
-        i = 1 # Variable auxiliar
-        data = pd.DataFrame()
-        # Se obtiene las variabes que no se quieren incluir en el fichero generado
-        vars_excluidas = lee_config('Vars_Excluidas', PATH_CONFIG_PYGEONICA)
-        fecha = 'yyyy/mm/dd hh:mm'
-        # Lee BBDD y obtiene datos del dia por cada estación, y se añaden al DataFrame completo
-        for estacion in estaciones:
-            if i == 1:
-                data = lee_dia_geonica_ddbb(dia, estacion)
-                # Se eliminan las medidas que no se quieren almacenar
-                for var in vars_excluidas:
-                    if var in data.columns:
-                        data.drop(columns=var, inplace=True)
-            else:
-                data_estacion = lee_dia_geonica_ddbb(dia, estacion)
-                # Se eliminan las medidas que no se quieren almacenar, junto con la fecha, debido a que está se repite en cada estación
-                data_estacion.drop(columns = fecha, inplace=True)
-                for var in vars_excluidas:
-                    if var in data_estacion.columns:
-                        data_estacion.drop(columns=var, inplace=True)
-                #Para que no se produzcan errorres, se asigna el sufijo "_i"(>=2) a los parámetros que coinciden en alguna estación
-                data = data.join(data_estacion, rsuffix=('_' + str(i)))
-            i += 1
-            
-        #Como la fecha y la hora son columnas compartidas, e idénticas, se elimina los duplicados y canales innecesarios.
-        # data.drop(columns={'yyyy/mm/dd hh:mm_2', 'VRef Ext.', 'Bateria', 'Bateria_2', 'Est.Geo3K', 'Est.Geo3K_2'}, inplace=True)
-        
-        data.rename(columns=dict_renombrar, inplace=True)
-        
-        # Crear fichero .txt
-        # Escribe la cabecera. Pandas utiliza el index standard de tipo datenum y solo
-        # crea una columna y no dos como se usa normalmente con estos ficheros, por lo
-        # que se escribe antes manualmente
-        formato_fecha = '%Y_%m_%d'
-        nombre_fichero_texto = path_fichero + nombre_fichero + \
-            dia.strftime(formato_fecha) + '.txt'
+    return _crea_dataframe(filas, nombres)
+
+
+def _iter_consulta(sql, params=(), chunk=CHUNK_DATOS, pool=None):
+    """
+    Info
+    ----------
+    Igual que _consulta(), pero las filas se devuelven por bloques leídos del cursor según se van
+    necesitando. Mientras no se termine de recorrer, se mantiene ocupada una conexión del pool.
+
+    Parameters
+    ----------
+    sql, params, pool :
+        Ver _consulta().
+    chunk : int, opcional
+        Número de filas de cada bloque. Por defecto es CHUNK_DATOS.
+
+    Yields
+    -------
+    pandas.DataFrame
+        Bloque de, como máximo, chunk filas.
+
+    """
+    
+    if pool is None:
+        pool = _obtiene_pool()
+    with pool.conexion() as conexion:
+        cursor = pool.sentencia(conexion, sql)
+        with instrumentacion.etapa('consulta'):
+            cursor.execute(sql, list(params))
+        nombres = [columna[0] for columna in cursor.description]
+        
+        # Se leen las filas del cursor bloque a bloque
+        while True:
+            with instrumentacion.etapa('lectura') as medida:
+                filas = cursor.fetchmany(chunk)
+                medida.filas_salida = len(filas)
+                if len(filas) != 0:
+                    data = _crea_dataframe(filas, nombres)
+            if len(filas) == 0:
+                break
+            yield data
+
+
+def _crea_dataframe(filas, nombres):
+    if len(filas) == 0:
+        return _datos_vacios(nombres)
+    # Las filas del driver se convierten en tuplas para construir el DataFrame
+    data = pd.DataFrame.from_records([tuple(fila) for fila in filas], columns=nombres)
+    # Algunos drivers devuelven las fechas como texto
+    if ('Fecha' in data.columns) and (data['Fecha'].dtype == object):
+        data['Fecha'] = pd.to_datetime(data['Fecha'])
+    return data
+
+
+def _datos_vacios(columnas=None):
+    # DataFrame sin filas con las columnas indicadas (por defecto, las de la tabla Datos), con los tipos de
+    # TIPOS_DATOS, de forma que el resultado tiene los mismos tipos haya o no filas
+    if columnas is None:
+        columnas = COLUMNAS_DATOS
+    return pd.DataFrame({columna: pd.Series(dtype=TIPOS_DATOS.get(columna, object)) for columna in columnas},
+                        columns=list(columnas))
+
+
+def _compacta(data):
+    # Convierte las columnas de la tabla Datos a los tipos de TIPOS_COMPACTOS. Los identificadores que no
+    # caben en el tipo compacto se mantienen en su tipo original, para no alterar su valor
+    tipos = {}
+    for columna, tipo in TIPOS_COMPACTOS.items():
+        if columna not in data.columns:
+            continue
+        if (np.dtype(tipo).kind == 'i') and (len(data) != 0):
+            limites = np.iinfo(tipo)
+            if (data[columna].min() < limites.min) or (data[columna].max() > limites.max):
+                continue
+        tipos[columna] = tipo
+    return data.astype(tipos)
+
+
+def _iter_compacto(bloques):
+    # Igual que _compacta() para cada bloque de una lectura por bloques
+    try:
+        for bloque in bloques:
+            yield _compacta(bloque)
+    finally:
+        bloques.close()
+
+
+_cache_metadatos = {}   # Clave -> (instante de la consulta, DataFrame)
+_cache_metadatos_lock = threading.Lock()
+_cache_metadatos_path = None    # Fichero en el que se guarda una copia de la caché, None si no se guarda
+_fichero_metadatos_lock = threading.Lock()  # Serializa las escrituras del fichero, sin bloquear la caché
+
+def _metadatos(clave, consulta):
+    """
+    Info
+    ----------
+    Devuelve los metadatos guardados en la caché bajo la clave indicada. Si no están, o han pasado
+    más de TTL_METADATOS segundos desde que se consultaron, se vuelven a obtener de la base de datos.
+    
+    Parameters
+    ----------
+    clave : str o tuple
+        Identificador de los metadatos en la caché.
+    consulta : function
+        Función sin argumentos que obtiene los metadatos de la base de datos.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Copia de los metadatos, de forma que el usuario pueda modificarla sin alterar la caché.
+
+    """
+    
+    with _cache_metadatos_lock:
+        entrada = _cache_metadatos.get(clave)
+    
+    if (entrada is not None) and (time.time() - entrada[0] < TTL_METADATOS):
+        return entrada[1].copy()
+    
+    valor = consulta()
+    
+    with _cache_metadatos_lock:
+        _cache_metadatos[clave] = (time.time(), valor)
+    
+    _guarda_cache_metadatos()
+    
+    return valor.copy()
+
+
+def _guarda_cache_metadatos():
+    # Se escribe una copia de la caché fuera de su lock, de forma que las consultas de metadatos no esperen
+    # a la escritura. Las escrituras se serializan con su propio lock, para que el fichero tenga la última copia
+    with _fichero_metadatos_lock:
+        with _cache_metadatos_lock:
+            path = _cache_metadatos_path
+            copia = dict(_cache_metadatos)
+        if path is None:
+            return
+        # Se escribe en un fichero temporal y se renombra, para no dejar nunca un fichero a medias. El nombre
+        # del fichero temporal incluye el proceso, ya que los workers de genera_fichero_meteo() comparten el fichero
+        path_temporal = str(path) + '.' + str(os.getpid()) + '.tmp'
+        with open(path_temporal, 'wb') as f:
+            pickle.dump(copia, f)
+        os.replace(path_temporal, path)
+
+
+_cache_datos = None     # CacheDatos configurada con configura_cache_datos(), None si no se utiliza
+
+def _iter_datos_bd(numero_estacion, fecha_ini, fecha_fin, canales=None, columnas=None, chunk=CHUNK_DATOS):
+    """
+    Lectura por bloques de la tabla Datos directamente de la base de datos. Ver iter_data_raw().
+    """
+    
+    query_data, parametros = _query_datos(numero_estacion, fecha_ini, fecha_fin, canales, columnas, ordenado=True)
+    
+    return _iter_consulta(query_data, parametros, chunk)
+
+
+def _llena_cache_datos(cache, estaciones, dias, chunk=CHUNK_DATOS):
+    """
+    Info
+    ----------
+    Lee de la base de datos los días de las estaciones que todavía no están en la caché y los guarda en ella.
+    Cada racha de días consecutivos se lee en una única consulta, por bloques, y cada día se guarda en
+    cuanto se completa, de forma que la memoria utilizada no depende del número de días.
+
+    Parameters
+    ----------
+    cache : CacheDatos
+    estaciones : list
+        Números identificativos de las estaciones.
+    dias : list de pandas.Timestamp
+        Días (UTC) que se quieren tener en la caché.
+    chunk : int, opcional
+        Número de filas de cada bloque leído de la base de datos.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    faltan = {(estacion, dia) for estacion in estaciones for dia in dias if not cache.contiene(estacion, dia)}
+    if len(faltan) == 0:
+        return
+    
+    un_dia = pd.Timedelta(days=1)
+    dias_faltan = sorted({dia for _, dia in faltan})
+    
+    # Rachas de días consecutivos
+    rachas = [[dias_faltan[0], dias_faltan[0] + un_dia]]
+    for dia in dias_faltan[1:]:
+        if dia == rachas[-1][1]:
+            rachas[-1][1] = dia + un_dia
+        else:
+            rachas.append([dia, dia + un_dia])
+    
+    for ini, fin in rachas:
+        estaciones_racha = [e for e in estaciones
+                            if any((e, d) in faltan for d in pd.date_range(ini, fin - un_dia))]
+        
+        def guarda(dia, partes):
+            partes = [parte for parte in partes if len(parte) != 0]
+            data = pd.concat(partes, ignore_index=True) if len(partes) != 0 else _datos_vacios()
+            for estacion in estaciones_racha:
+                if (estacion, dia) in faltan:
+                    cache.guarda(estacion, dia, data[data['NumEstacion'] == estacion])
+        
+        # Todas las filas de las estaciones, sin filtrar canales ni columnas
+        dia_actual = ini
+        partes = []
+        for bloque in _iter_datos_bd(estaciones_racha, ini, fin, chunk=chunk):
+            for dia, parte in bloque.groupby(bloque['Fecha'].dt.floor('D')):
+                # Los días anteriores ya están completos
+                while dia_actual < dia:
+                    guarda(dia_actual, partes)
+                    partes = []
+                    dia_actual += un_dia
+                partes.append(parte)
+        while dia_actual < fin:
+            guarda(dia_actual, partes)
+            partes = []
+            dia_actual += un_dia
+
+
+def _iter_datos_cache(cache, numero_estacion, fecha_ini, fecha_fin, canales=None, columnas=None, chunk=CHUNK_DATOS):
+    """
+    Info
+    ----------
+    Lectura por bloques de la tabla Datos a través de la caché en disco. Los días que ya no pueden cambiar
+    se leen de la caché, guardando antes en ella los que falten, y se filtran localmente; el resto del
+    periodo se lee directamente de la base de datos. Ver iter_data_raw().
+    """
+    
+    estaciones, canales = _estaciones_canales(numero_estacion, canales)
+    ini = pd.Timestamp(fecha_ini)
+    fin = pd.Timestamp(fecha_fin)
+    if fin <= ini:
+        return
+    
+    un_dia = pd.Timedelta(days=1)
+    dias = [dia for dia in pd.date_range(ini.floor('D'), (fin - pd.Timedelta(1)).floor('D'))
+            if cache.cacheable(dia)]
+    
+    _llena_cache_datos(cache, estaciones, dias, chunk)
+    
+    for dia in dias:
+        partes = []
+        for estacion in estaciones:
+            with instrumentacion.etapa('lectura_cache', estacion=estacion, dia=dia.date()) as medida:
+                data = cache.lee(estacion, dia)
+                medida.filas_salida = None if data is None else len(data)
+            if data is None:
+                # El día se ha borrado de la caché después de guardarse
+                bloques = list(_iter_datos_bd(estacion, dia, dia + un_dia, chunk=chunk))
+                data = pd.concat(bloques, ignore_index=True) if len(bloques) != 0 else _datos_vacios()
+            if estacion in canales:
+                data = _filtra_canales(data, canales[estacion])
+            if len(data) != 0:
+                partes.append(data)
+        if len(partes) == 0:
+            continue
+        
+        data = pd.concat(partes, ignore_index=True)
+        if (ini > dia) or (fin < dia + un_dia):
+            data = data[(data['Fecha'] >= ini) & (data['Fecha'] < fin)]
+        # Mismo orden que la consulta a la base de datos
+        data = data.sort_values('Fecha', kind='mergesort')
+        if columnas is not None:
+            data = data[list(columnas)]
+        
+        for i in range(0, len(data), chunk):
+            yield data.iloc[i:i + chunk].reset_index(drop=True)
+    
+    # El final del periodo, que todavía puede cambiar, se lee de la base de datos
+    if len(dias) != 0:
+        ini = max(ini, dias[-1] + un_dia)
+    if ini < fin:
+        yield from _iter_datos_bd(estaciones, ini, fin, canales, columnas, chunk)
+
+#%%
+###########################################################################################################
+####
+####        INTERFAZ DE USUARIO
+####
+###########################################################################################################
+
+def configura_pool(tamano_max=None, tiempo_inactividad=None, tiempo_espera=None, fabrica=None):
+    """
+    Info
+    ----------
+    Configura el pool de conexiones que utilizan todas las funciones del módulo.
+    Las conexiones abiertas con la configuración anterior se cierran.
+
+    Parameters
+    ----------
+    tamano_max : int, opcional
+        Número máximo de conexiones abiertas a la vez. Por defecto es POOL_TAMANO_MAX.
+    tiempo_inactividad : float, opcional
+        Segundos que puede permanecer libre una conexión antes de cerrarse.
+        Por defecto es POOL_TIEMPO_INACTIVIDAD.
+    tiempo_espera : float, opcional
+        Segundos máximos de espera a que quede libre una conexión. Por defecto es POOL_TIEMPO_ESPERA.
+    fabrica : function, opcional
+        Función sin argumentos que devuelve una nueva conexión DB-API.
+        Por defecto se conecta mediante pyodbc al servidor del fichero de configuración.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    global _pool, _origen_servidor
+
+    parametros = {'fabrica': fabrica, 'tamano_max': tamano_max,
+                  'tiempo_inactividad': tiempo_inactividad, 'tiempo_espera': tiempo_espera}
+
+    with _pool_lock:
+        # La nueva configuración sustituye también a la réplica seleccionada con configura_origen()
+        _origen_servidor = None
+        _pool_parametros.clear()
+        _pool_parametros.update({k: v for k, v in parametros.items() if v is not None})
+        pool_anterior = _pool
+        _pool = None
+
+    if pool_anterior is not None:
+        pool_anterior.cierra()
+
+
+def cierra_conexiones():
+    """
+    Info
+    ----------
+    Cierra las conexiones abiertas con la base de datos. Si posteriormente se realiza
+    alguna consulta, se vuelven a abrir las conexiones necesarias.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    global _pool
+
+    with _pool_lock:
+        pool_anterior = _pool
+        _pool = None
+
+    if pool_anterior is not None:
+        pool_anterior.cierra()
+
+# Se cierran las conexiones al finalizar el intérprete
+atexit.register(cierra_conexiones)
+
+
+def configura_cache_metadatos(ttl=None, path=None):
+    """
+    Info
+    ----------
+    Configura la caché de los metadatos de la base de datos (parámetros, funciones y canales
+    configurados en las estaciones), que apenas cambian y se consultan en cada lectura de datos.
+
+    Parameters
+    ----------
+    ttl : float, opcional
+        Segundos durante los que se reutilizan los metadatos antes de volver a consultarlos.
+        Por defecto se mantiene el valor actual de TTL_METADATOS.
+    path : str, opcional
+        Fichero en el que se guarda una copia de la caché cada vez que se actualiza.
+        Si el fichero ya existe, se carga su contenido, de forma que otras ejecuciones
+        no tengan que consultar de nuevo los metadatos: los metadatos cargados se reutilizan
+        durante TTL_METADATOS segundos desde la carga. Por defecto no se guarda.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    global TTL_METADATOS, _cache_metadatos_path
+    
+    if ttl is not None:
+        TTL_METADATOS = ttl
+    
+    with _cache_metadatos_lock:
+        _cache_metadatos_path = path
+        if (path is not None) and os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    copia = pickle.load(f)
+            except:
+                print('Error en la lectura del fichero de caché de metadatos, se ignora su contenido.')
+            else:
+                # Los metadatos cargados se consideran consultados al cargarlos: si se mantuviera el instante
+                # de la consulta original, la copia caducaría en las ejecuciones posteriores a TTL_METADATOS
+                ahora = time.time()
+                _cache_metadatos.update({clave: (ahora, valor) for clave, (_, valor) in copia.items()})
+
+
+def configura_cache_datos(path=None, tamano_max=None, margen_dias=None):
+    """
+    Info
+    ----------
+    Configura la caché en disco de los datos en bruto de la tabla Datos. Los datos de días pasados no cambian,
+    por lo que cada día de cada estación se lee una única vez de la base de datos y se guarda en un fichero
+    Parquet; las siguientes lecturas de ese día (get_data_raw(), lee_dia_geonica_ddbb(), genera_fichero_meteo()...)
+    se hacen desde el disco. Necesita el paquete pyarrow.
+
+    Parameters
+    ----------
+    path : str, opcional
+        Carpeta de la caché. Por defecto es None, que desactiva la caché.
+    tamano_max : int, opcional
+        Tamaño máximo de la caché, en bytes. Al superarse, se borran los días leídos hace más tiempo.
+        Por defecto es cache.TAMANO_MAX.
+    margen_dias : int, opcional
+        Días que tienen que haber pasado desde el final de un día (UTC) para guardarlo en la caché,
+        para dar tiempo a que las estaciones descarguen sus datos. Por defecto es cache.MARGEN_DIAS.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    global _cache_datos
+    
+    if path is None:
+        _cache_datos = None
+        return
+    
+    parametros = {'tamano_max': tamano_max, 'margen_dias': margen_dias}
+    _cache_datos = CacheDatos(path, **{k: v for k, v in parametros.items() if v is not None})
+
+
+def configura_origen(replica=None):
+    """
+    Info
+    ----------
+    Selecciona la base de datos de la que leen todas las funciones del módulo (get_data_raw(),
+    get_channels_config(), genera_fichero_meteo()...): el servidor SQL de Geonica o una réplica local
+    creada y actualizada con replica.Replica, de forma que los análisis no carguen al servidor.
+    Se mantiene el resto de la configuración del pool y se cierran las conexiones abiertas. Al volver
+    al servidor se restablece la función de conexión que hubiera antes de seleccionar la réplica
+    (la indicada en configura_pool() o, por defecto, pyodbc).
+
+    Parameters
+    ----------
+    replica : str, opcional
+        Fichero de la réplica local. Por defecto (None) se vuelve a leer del servidor.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    global _pool, _origen_servidor
+    
+    if replica is not None:
+        from .replica import conecta
+        fabrica = functools.partial(conecta, str(replica))
+    
+    with _pool_lock:
+        if replica is not None:
+            # Se guarda la función de conexión con el servidor, salvo si ya se leía de otra réplica
+            if _origen_servidor is None:
+                _origen_servidor = {k: v for k, v in _pool_parametros.items() if k == 'fabrica'}
+            _pool_parametros['fabrica'] = fabrica
+        elif _origen_servidor is not None:
+            _pool_parametros.pop('fabrica', None)
+            _pool_parametros.update(_origen_servidor)
+            _origen_servidor = None
+        pool_anterior = _pool
+        _pool = None
+    
+    if pool_anterior is not None:
+        pool_anterior.cierra()
+    
+    # Los metadatos guardados pueden no coincidir con los de la nueva base de datos
+    invalida_cache_metadatos()
+
+
+def invalida_cache_metadatos():
+    """
+    Info
+    ----------
+    Borra los metadatos guardados en la caché, de forma que la siguiente consulta
+    los obtenga de nuevo de la base de datos. Útil tras modificar la configuración de
+    las estaciones en Teletrans o el apartado Tipo_Lectura_Canales del fichero de configuración.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    with _fichero_metadatos_lock, _cache_metadatos_lock:
+        _cache_metadatos.clear()
+        if (_cache_metadatos_path is not None) and os.path.isfile(_cache_metadatos_path):
+            os.remove(_cache_metadatos_path)
+
+
+def get_data_raw(numero_estacion, fecha_ini, fecha_fin = dt.date.today().strftime('%Y-%m-%d %H:%M'),
+                 canales=None, columnas=None, compacto=False):
+    """
+    Info
+    ----------
+    Se obtienen los datos en bruto de una estacion deseada, 
+        estos datos incluyen todos las funciones que estén configuradas en la estación.
+
+    Parameters
+    ----------
+    numero_estacion : int o list de int
+        El número identificativo de la estación. Si se indica una lista de estaciones,
+        se obtienen los datos de todas ellas en una única consulta.
+    fecha_ini : str de datatime.date
+        La fecha de incio del periodo deseado.
+    fecha_fin : str de datatime.date, opcional
+        Fecha final del periodo. Por defecto es la fecha de hoy.
+    canales : list o dict, opcional
+        Lista de pares (NumParametro, NumFuncion) que se quieren obtener, de forma que la base de datos
+        solo devuelva esas filas. Si se solicitan varias estaciones, diccionario con la lista de pares
+        de cada estación; las estaciones que no estén en el diccionario devuelven todos sus datos.
+        Por defecto se obtienen todas las funciones de todos los parámetros.
+    columnas : list, opcional
+        Columnas de la tabla Datos que se quieren obtener. Por defecto son todas.
+    compacto : bool, opcional
+        Si es True, Valor se devuelve como float32 y NumEstacion, NumParametro y NumFuncion como
+        enteros pequeños (ver TIPOS_COMPACTOS), de forma que el DataFrame ocupa menos de la mitad
+        de memoria. Por defecto es False.
+
+    Returns
+    -------
+    data_raw : pandas.DataFrame
+        DataFrame con todos los datos de la base de datos en el periodo
+        deseado.
+
+    """
+
+    # Si está activada la caché en disco, los días pasados se leen de ella
+    if _cache_datos is not None:
+        bloques = _iter_datos_cache(_cache_datos, numero_estacion, fecha_ini, fecha_fin,
+                                    canales, columnas, chunk=CHUNK_DATOS)
+        if compacto:
+            bloques = _iter_compacto(bloques)
+        bloques = list(bloques)
+        if len(bloques) == 0:
+            data_raw = _datos_vacios(columnas)
+            return _compacta(data_raw) if compacto else data_raw
+        return pd.concat(bloques, ignore_index=True)
+    
+    query_data, parametros = _query_datos(numero_estacion, fecha_ini, fecha_fin, canales, columnas)
+    
+    #Se construye el DataFrame con los valores pedidos a la base de datos
+    data_raw = _consulta(query_data, parametros)
+    
+    if compacto:
+        data_raw = _compacta(data_raw)
+    
+    return data_raw
+
+
+def iter_data_raw(numero_estacion, fecha_ini, fecha_fin = dt.date.today().strftime('%Y-%m-%d %H:%M'),
+                  canales=None, columnas=None, chunk=CHUNK_DATOS, compacto=False):
+    """
+    Info
+    ----------
+    Igual que get_data_raw(), pero los datos se devuelven por bloques ordenados por fecha,
+    leídos del cursor de la base de datos según se van necesitando. De esta forma la memoria
+    utilizada no depende de la longitud del periodo solicitado.
+    
+    Mientras no se termine de recorrer, se mantiene ocupada una conexión del pool.
+    Si está activada la caché en disco (configura_cache_datos()), los días pasados se leen de ella.
+
+    Parameters
+    ----------
+    numero_estacion, fecha_ini, fecha_fin, canales, columnas, compacto :
+        Ver get_data_raw().
+    chunk : int, opcional
+        Número de filas de cada bloque. Por defecto es CHUNK_DATOS.
+
+    Yields
+    -------
+    data_raw : pandas.DataFrame
+        DataFrame con un bloque de, como máximo, chunk filas.
+
+    """
+    
+    if _cache_datos is not None:
+        bloques = _iter_datos_cache(_cache_datos, numero_estacion, fecha_ini, fecha_fin, canales, columnas, chunk)
+    else:
+        bloques = _iter_datos_bd(numero_estacion, fecha_ini, fecha_fin, canales, columnas, chunk)
+    
+    if compacto:
+        return _iter_compacto(bloques)
+    return bloques
+
+
+def get_parameters():
+    """
+    Info
+    -------
+    Mediante esta función se obtienen las funciones que están disponibles en la estacion,
+    junto con su número de parametro y unidad.    
+    
+    Returns
+    -------
+    data_parameters : pandas.DateFrame
+        DataFrame formada por: NumParametro, Nombre, Abreviatura y Unidad
+
+    """
+    
+    def consulta():
+        query_parameters = (
+                'SELECT NumParametro, Nombre, Abreviatura, Unidad FROM Parametros_spanish '
+        )
+        
+        return _consulta(query_parameters)
+    
+    # Los parámetros apenas cambian, por lo que se obtienen de la caché de metadatos
+    data_parameters = _metadatos('parametros', consulta)
+    
+    #parametros = data_parameters.set_index('NumParametro')
+    return data_parameters
+    
+
+def get_channels_config(numero_estacion):
+    """
+    Info
+    ----------
+    Devuelve una lista de los canales configurasdos en la estación indicada,
+    estos canales están ordenados en el mismo orden en el que los devuelve la estación
+    cuando se le solicita (mediante puerto Serie, conexión IP, etc. ) los datos de los canales.
+
+    Parameters
+    ----------
+    numero_estacion : int
+        El número identificativo de la estación.
+
+    Returns
+    -------
+    canales : pandas.DataFrame
+        DataFrame con los canales configrados, formato: NumFuncion, Abreviatura y NumParametro
+
+    """
+
+    # La configuración de los canales apenas cambia, por lo que se obtiene de la caché de metadatos
+    return _metadatos(('canales', numero_estacion), lambda: _consulta_channels_config(numero_estacion))
+
+
+def _consulta_channels_config(numero_estacion):
+    """
+    Consulta en la base de datos la configuración de canales que devuelve get_channels_config().
+    """
+
+    query_channels_config = (
+            'SELECT Canales.NumFuncion, Canales.Canal, Parametros_spanish.Abreviatura, Parametros_spanish.NumParametro '
+            'FROM Canales '
+            'INNER JOIN Parametros_spanish ON Canales.NumParametro = Parametros_spanish.NumParametro '
+            'INNER JOIN Funciones ON Funciones.NumFuncion = Canales.NumFuncion '
+            'WHERE NumEstacion = ?'
+    )
+    
+    data_channels_config = _consulta(query_channels_config, [int(numero_estacion)])
+    
+    # Se obtiene la correspondecia Nombre de funcion -> número de función de la base de datos
+    numFunciones = get_functions().reset_index().set_index('Nombre')
+    
+    # Diccionario en el que se indica que tipo de medida se desea alacenar por cada canal
+    tipo_medidas = lee_config('Tipo_Lectura_Canales', PATH_CONFIG_PYGEONICA)[numero_estacion]
+   
+    data_channels_config.set_index('Abreviatura', inplace=True)
+
+    # Se modifica el NunFuncion de cada medida para obtener las medidas deseadas por cada canal
+    # Se recorre la lista de canales...
+    for dato in data_channels_config.index:
+        # Hasta que se encuentre el canal que se desee modificar...
+        if dato in tipo_medidas.keys():
+            # Si la medida deseada se ha configurado en la estación...
+            numFuncion = int(numFunciones.loc[tipo_medidas[dato]])
+            # Si sólo hay una medida configurada...
+            if type(data_channels_config.loc[dato, 'NumFuncion']) == np.int64:
+                if numFuncion == data_channels_config.loc[dato, 'NumFuncion']:
+                    # Se modifica el dataframe, para que se guarden solo los valores deseados
+                    data_channels_config.loc[dato, 'NumFuncion'] = numFuncion
+            else: # En el caso de que se hayan configurado varios tipos de medidas...
+                if numFuncion in data_channels_config.loc[dato, 'NumFuncion'].tolist():
+                    # Se modifica el dataframe, para que se guarden solo los valores deseados
+                    vals = [numFuncion] * len(data_channels_config.loc[dato, 'NumFuncion'])
+                    data_channels_config.loc[dato, 'NumFuncion'] = vals
+     
+    data_channels_config.reset_index(inplace=True)
+            
+    # Se ordenan los canales por el número del 'Canal' que le corresponde en a base de datos
+    data_channels_config.set_index('Canal', inplace = True)
+    data_channels_config.sort_values(by = 'Canal', inplace= True)
+    # Se borran los duplicados en la columna de 'Abreviatura', y se quita la columna 'Canal' que no aporta información
+    # útil, ya que son valores propios de la base de datos.
+    canales = data_channels_config.drop_duplicates(subset='Abreviatura').reset_index().drop(columns='Canal')
+    
+    return canales
+
+def get_functions():
+    """
+    Info
+    -------
+    Devuelve una lista con el número correspondiente a la función.
+
+    Returns
+    -------
+    funciones : pandas.DateFrame
+        DataFrame con NumFuncion y Nombre (de la función)
+
+    """
+    
+    def consulta():
+        query_functions = (
+                'SELECT NumFuncion, Nombre FROM Funciones_MI '
+                'WHERE Ididioma = ?'
+        )   
+        
+        #Se solicita en nombre de las funciones en español (1034); 2057, para inglés
+        funciones = _consulta(query_functions, [1034])
+        
+        # Se establece 'NumFuncion' como índice
+        funciones.set_index('NumFuncion', inplace = True)
+        return funciones
+    
+    return _metadatos('funciones', consulta)
+
+
+def _pares_canales(numero_estacion, lista_campos=None):
+    """
+    Info
+    ----------
+    Devuelve los pares (NumParametro, NumFuncion) que hay que solicitar a la base de datos para obtener
+    los campos indicados de una estación, con el tipo de medida configurado para cada canal.
+
+    Parameters
+    ----------
+    numero_estacion : int
+        Número identificativo de la estación.
+    lista_campos : list, opcional
+        Lista con las abreviaturas de los canales. Por defecto son todos los canales de la estación.
+
+    Returns
+    -------
+    list de (int, int)
+
+    """
+    
+    canales = get_channels_config(numero_estacion)
+    if lista_campos is not None:
+        canales = canales[canales['Abreviatura'].isin(lista_campos)]
+    
+    return list(zip(canales['NumParametro'], canales['NumFuncion']))
+
+
+def _realinea_medias(valores, posiciones):
+    """
+    Info
+    ----------
+    Ajusta los valores de los canales de medias (NumFuncion == 1): el valor guardado en un minuto es la media
+    del minuto anterior, por lo que se sustituye por el valor interpolado linealmente medio minuto después,
+    es decir, la media de ese minuto y el siguiente. Si faltan valores, se interpola entre los valores
+    válidos más cercanos; tras el último valor válido se mantiene ese valor, y antes del primero no hay valor.
+    
+    Equivale a resample('30S').interpolate(method='linear').shift(periods=-30, freq='S') sobre cada canal,
+    pero se calcula de una vez para todos los canales sobre el array, sin crear la serie cada 30 segundos.
+
+    Parameters
+    ----------
+    valores : numpy.ndarray
+        Array (filas x canales) con los valores de los canales de medias, NaN si faltan.
+    posiciones : numpy.ndarray
+        Posición de cada fila en intervalos de 30 segundos desde la primera fila.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array con los valores ajustados.
+
+    """
+    
+    n = len(valores)
+    resultado = np.full(valores.shape, np.nan)
+    if n == 0:
+        return resultado
+    
+    validos = ~np.isnan(valores)
+    filas = np.arange(n)[:, None]
+    # Último valor válido en la fila o anteriores, -1 si no hay
+    anterior = np.maximum.accumulate(np.where(validos, filas, -1), axis=0)
+    # Primer valor válido en las filas siguientes, n si no hay
+    siguiente = np.minimum.accumulate(np.where(validos, filas, n)[::-1], axis=0)[::-1]
+    siguiente = np.vstack([siguiente[1:], np.full((1, valores.shape[1]), n)])
+    
+    x = posiciones.astype(float) + 1
+    
+    # Entre dos valores válidos se interpola, con las mismas operaciones que numpy.interp
+    interior = (anterior >= 0) & (siguiente < n)
+    fila, canal = np.nonzero(interior)
+    i0 = anterior[fila, canal]
+    i1 = siguiente[fila, canal]
+    x0 = x[i0] - 1
+    pendiente = (valores[i1, canal] - valores[i0, canal]) / ((x[i1] - 1) - x0)
+    resultado[fila, canal] = pendiente * (x[fila] - x0) + valores[i0, canal]
+    
+    # Tras el último valor válido se mantiene, salvo en la última fila, que no tiene medio minuto posterior
+    final = (anterior >= 0) & (siguiente == n)
+    final[-1, :] = False
+    fila, canal = np.nonzero(final)
+    resultado[fila, canal] = valores[anterior[fila, canal], canal]
+    
+    return resultado
+
+
+@functools.lru_cache(maxsize=1024)
+def _desfases_dia(dia):
+    # Diferencia entre la hora civil de Madrid y la hora UTC en cada hora (UTC) del día.
+    # Los cambios de hora se producen a horas en punto UTC, por lo que basta una tabla horaria
+    horas = pd.date_range(pd.Timestamp(dia), periods=24, freq='H')
+    civil = horas.tz_localize(pytz.utc).tz_convert(pytz.timezone('Europe/Madrid')).tz_localize(None)
+    return (civil - horas).values
+
+
+def _hora_civil(fechas):
+    """
+    Info
+    ----------
+    Convierte fechas en hora UTC a hora civil de Madrid, sin zona horaria, a partir de la tabla
+    de desfases de cada día, que se guarda en caché.
+
+    Parameters
+    ----------
+    fechas : pandas.DatetimeIndex
+        Fechas en hora UTC, sin zona horaria.
+
+    Returns
+    -------
+    pandas.DatetimeIndex
+
+    """
+    
+    valores = fechas.values
+    if len(valores) == 0:
+        return fechas
+    
+    dias = valores.astype('datetime64[D]')
+    unicos, posicion = np.unique(dias, return_inverse=True)
+    tabla = np.stack([_desfases_dia(dia) for dia in unicos.tolist()])
+    horas = ((valores - dias) // np.timedelta64(1, 'h')).astype(np.int64)
+    
+    return pd.DatetimeIndex(valores + tabla[posicion, horas], name=fechas.name)
+
+
+class _ProcesadorEstacion:
+    """
+    Info
+    ----------
+    Procesa por bloques los datos en bruto de una estación, tal y como los devuelve iter_data_raw(),
+    y los convierte en DataFrames con una columna por canal y la fecha en hora civil como índice.
+    
+    Cada día se procesa con los minutos de su ventana de lectura, desde 2 horas antes del inicio del día
+    hasta el final del día (en hora UTC), igual que si se leyera ese único día. Así el resultado no depende
+    del tamaño de los bloques ni de la longitud del periodo: los canales de medias solo se interpolan con
+    valores de la ventana, de forma que tras su último valor en la ventana se mantiene ese valor y antes
+    del primero no hay valor. Entre bloques se guardan los minutos leídos que todavía forman parte
+    de la ventana de algún día por entregar.
+
+    Parameters
+    ----------
+    numero_estacion : int
+        Número identificativo de la estación.
+
+    """
+    
+    def __init__(self, numero_estacion):
+        # dict_estacion tiene como indice el numero_estacion y contenido 'nombre_parametro_ficheros' y 'mtype'
+        # nombre, mtype
+        #   'mtype'     Measurement type: Enter an integer to determine which
+        #               information on each one minute interval to return.  Options are.
+        #               0       1   2   3   4   5
+        #               Ins.    Med Acu Int Max Min
+        self.numero_estacion = numero_estacion
+        dict_estacion = get_channels_config(numero_estacion).set_index('NumParametro')
+        self.medias = set(dict_estacion.index[dict_estacion['NumFuncion'] == 1])
+        
+        # Plan de la conversión a columnas: los NumParametro de la estación, ordenados, cuya posición
+        # es la columna de la matriz en la que se colocan sus valores
+        self.parametros = np.unique(dict_estacion.index.to_numpy(dtype='int64'))
+        
+        # Correspondencia NumParametro de BBDD -> nombre de fichero
+        self.nombres = get_parameters().set_index('NumParametro')['Abreviatura']
+        
+        self._leidos = []           # Minutos leídos y no descartados, una columna por NumParametro, sin ajustar
+    
+    def procesa(self, data):
+        """
+        Convierte un bloque de datos en bruto a columnas y lo guarda hasta que se entreguen sus días.
+        
+        Parameters
+        ----------
+        data : pandas.DataFrame o None
+            Datos en bruto del bloque, con solo los canales de _pares_canales() y sin
+            minutos repartidos con el bloque siguiente.
+        """
+        
+        if (data is None) or (len(data) == 0):
+            return
+        # Conversion de parametros en filas a columnas del Dataframe
+        with instrumentacion.etapa('pivot', estacion=self.numero_estacion, filas_entrada=len(data)) as medida:
+            tabla = self._a_columnas(data)
+            medida.filas_salida = len(tabla)
+        self._leidos.append(tabla)
+    
+    def _minutos(self):
+        # Une los bloques guardados en un único DataFrame
+        if len(self._leidos) > 1:
+            self._leidos = [pd.concat(self._leidos)]
+        return self._leidos[0] if len(self._leidos) != 0 else None
+    
+    def ventana(self, inicio, fin):
+        """
+        Procesa los minutos leídos entre inicio (incluido) y fin (excluido), en hora UTC, que ya deben
+        haberse leído todos, y los devuelve en hora civil.
+        """
+        
+        leidos = self._minutos()
+        if leidos is None:
+            return pd.DataFrame()
+        i_ini, i_fin = leidos.index.searchsorted([inicio, fin])
+        if i_fin <= i_ini:
+            return pd.DataFrame()
+        
+        return self._ajusta(leidos.iloc[i_ini:i_fin])
+    
+    def descarta(self, hasta):
+        """
+        Descarta los minutos leídos anteriores a hasta (hora UTC), que ya no forman parte de ninguna ventana.
+        """
+        
+        leidos = self._minutos()
+        if leidos is not None:
+            self._leidos = [leidos.iloc[leidos.index.searchsorted(hasta):]]
+    
+    def _a_columnas(self, data):
+        """
+        Convierte los datos en bruto (una fila por minuto y canal) en un DataFrame con una fila por minuto
+        y una columna por NumParametro, con el mismo resultado que
+        data.pivot_table(index='Fecha', columns=['NumParametro'], values='Valor').
+        
+        Como los datos vienen ordenados por fecha y cada par (minuto, NumParametro) es único, en lugar de
+        agrupar y promediar se coloca cada valor directamente en su posición de una matriz minuto x canal:
+        la fila es el orden del minuto en el bloque y la columna, la posición del NumParametro en el plan
+        de la estación. Si no se cumplen esas condiciones, se utiliza pivot_table().
+        """
+        
+        # pivot_table() descarta los valores nulos, y con ellos los minutos y canales sin ningún valor
+        valores = data['Valor'].to_numpy(dtype=float)
+        validos = ~np.isnan(valores)
+        fechas = data['Fecha'].to_numpy(dtype='datetime64[ns]')[validos]
+        parametros = data['NumParametro'].to_numpy(dtype='int64')[validos]
+        valores = valores[validos]
+        if (len(valores) == 0) or (len(self.parametros) == 0):
+            return data.pivot_table(index='Fecha', columns=['NumParametro'], values='Valor')
+        
+        # Columna de cada valor en el plan
+        columnas = np.searchsorted(self.parametros, parametros)
+        conocidos = (columnas < len(self.parametros)) & \
+            (self.parametros[np.minimum(columnas, len(self.parametros) - 1)] == parametros)
+        
+        # Fila de cada valor: número de minutos distintos anteriores en el bloque
+        nuevos = np.empty(len(fechas), dtype=bool)
+        nuevos[0] = True
+        np.not_equal(fechas[1:], fechas[:-1], out=nuevos[1:])
+        filas = np.cumsum(nuevos) - 1
+        
+        n_columnas = len(self.parametros)
+        posiciones = filas * n_columnas + columnas
+        if (not conocidos.all()) or (fechas[1:] < fechas[:-1]).any() or \
+                (np.bincount(posiciones, minlength=(filas[-1] + 1) * n_columnas).max() > 1):
+            return data.pivot_table(index='Fecha', columns=['NumParametro'], values='Valor')
+        
+        matriz = np.full((filas[-1] + 1, n_columnas), np.nan)
+        matriz.flat[posiciones] = valores
+        
+        usadas = np.bincount(columnas, minlength=n_columnas) > 0
+        return pd.DataFrame(matriz[:, usadas],
+                            index=pd.DatetimeIndex(fechas[nuevos], name='Fecha'),
+                            columns=pd.Index(self.parametros[usadas], name='NumParametro'))
+    
+    def _ajusta(self, ventana):
+        
+        # Si los valores son medias (mtype==1), sería el valor de hace 30 seg. Por lo tanto se toma el que realmente le corresponde.
+        valores = ventana.to_numpy(dtype=float, copy=True)
+        medias = [i for i, columna in enumerate(ventana.columns) if columna in self.medias]
+        if len(medias) != 0:
+            with instrumentacion.etapa('ajuste_medias', estacion=self.numero_estacion, filas_entrada=len(ventana),
+                                       filas_salida=len(ventana)):
+                fechas = ventana.index.values
+                posiciones = (fechas - fechas[0]) // np.timedelta64(30, 's')
+                valores[:, medias] = _realinea_medias(valores[:, medias], posiciones)
+        
+        data = pd.DataFrame(valores, index=ventana.index, columns=ventana.columns)
+        
+        # Cambia codigo NumParametro de BBDD a su nombre de fichero
+        data = data.rename(columns=self.nombres)
+        
+        with instrumentacion.etapa('hora_civil', estacion=self.numero_estacion, filas_entrada=len(data)) as medida:
+            # cambia index a hora civil
+            data.index = _hora_civil(data.index)
+            
+            # quita los índices repetidos que se dan en el cambio de hora de otoño (se añade 1h)
+            fechas = data.index.values
+            anteriores = np.maximum.accumulate(np.concatenate([[fechas[0] - np.timedelta64(1, 'm')], fechas[:-1]]))
+            data = data[fechas > anteriores]
+            medida.filas_salida = len(data)
+        
+        return data
+
+
+def _en_segundo_plano(iterable, profundidad):
+    """
+    Info
+    ----------
+    Recorre el iterable en un hilo aparte, adelantando como máximo profundidad elementos, de forma
+    que la espera a la base de datos se solapa con el procesado de los elementos ya recibidos.
+    Los errores del iterable se propagan al recorrer el generador devuelto.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Si es un generador, se cierra en el propio hilo al terminar (p.ej. para liberar la conexión
+        de iter_data_raw()).
+    profundidad : int
+        Número máximo de elementos leídos por adelantado.
+
+    Yields
+    -------
+    Los elementos del iterable, en el mismo orden.
+
+    """
+    
+    cola = queue.Queue(maxsize=profundidad)
+    parar = threading.Event()
+    
+    def pon(elemento):
+        # Se espera a que haya hueco en la cola, salvo que se haya dejado de recorrer
+        while not parar.is_set():
+            try:
+                cola.put(elemento, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def productor():
+        try:
+            for elemento in iterable:
+                if not pon(('dato', elemento)):
+                    break
+            else:
+                pon(('fin', None))
+        except BaseException as error:
+            pon(('error', error))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    
+    hilo = threading.Thread(target=productor, daemon=True)
+    hilo.start()
+    try:
+        while True:
+            tipo, valor = cola.get()
+            if tipo == 'fin':
+                return
+            if tipo == 'error':
+                raise valor
+            yield valor
+    finally:
+        parar.set()
+        hilo.join()
+
+
+def _rondas(bloques, procesadores):
+    """
+    Info
+    ----------
+    Reparte entre los procesadores de cada estación los bloques de datos en bruto de iter_data_raw(),
+    de forma que ningún minuto quede repartido entre dos bloques.
+
+    Parameters
+    ----------
+    bloques : iterable de pandas.DataFrame
+        Bloques ordenados por fecha, con la columna NumEstacion.
+    procesadores : dict
+        _ProcesadorEstacion de cada estación, cuya clave es el número de la estación.
+
+    Yields
+    -------
+    hasta : pandas.Timestamp
+        Fecha (UTC) a partir de la cual todavía no se ha repartido ningún dato.
+
+    """
+    
+    def reparte(data):
+        grupos = dict(tuple(data.groupby('NumEstacion'))) if data is not None else {}
+        for estacion, procesador in procesadores.items():
+            procesador.procesa(grupos.get(estacion))
+    
+    resto = None
+    for bloque in bloques:
+        if resto is not None:
+            bloque = pd.concat([resto, bloque], ignore_index=True)
+        # Las filas del último minuto del bloque pueden continuar en el siguiente, por lo que se retienen
+        hasta = bloque['Fecha'].iloc[-1]
+        i = bloque['Fecha'].searchsorted(hasta)
+        resto = bloque.iloc[i:]
+        reparte(bloque.iloc[:i])
+        yield hasta
+    
+    reparte(resto)
+    yield pd.Timestamp.max
+
+
+def _lee_periodo(dias, campos, chunk=CHUNK_DATOS, profundidad_cola=0):
+    """
+    Info
+    ----------
+    Lee los datos de un periodo de una o varias estaciones en una única consulta, y los procesa
+    por bloques, devolviendo los días según se completan. La memoria utilizada no depende de la
+    longitud del periodo.
+
+    Parameters
+    ----------
+    dias : pandas.DatetimeIndex
+        Días del periodo.
+    campos : dict
+        Lista de campos de cada estación, cuya clave es el número de la estación.
+    chunk : int, opcional
+        Número de filas de cada bloque leído de la base de datos.
+    profundidad_cola : int, opcional
+        Si es mayor que 0, los bloques se leen en un hilo aparte, adelantando como máximo
+        ese número de bloques. Por defecto es 0.
+
+    Yields
+    -------
+    dia : datetime.date
+    datos : dict
+        Datos procesados, en hora civil, de cada estación en el día.
+
+    """
+    
+    estaciones = list(campos)
+    formato_tiempo = '%Y-%m-%d %H:%M'
+    
+    # Como se lee hora UTC y la civil necesita de valores del día anterior, se leen minutos del día anterior
+    # El dataset tiene el periodo + 2 horas, que luego al convertir a hora civil se tomarán solo los minutos del periodo
+    fecha_ini = (dias[0] - dt.timedelta(hours=2)).strftime(formato_tiempo)
+    fecha_fin = (dias[-1] + dt.timedelta(hours=24)).strftime(formato_tiempo)
+                                                    
+    # https://docs.microsoft.com/es-es/sql/relational-databases/lesson-2-connecting-from-another-computer?view=sql-server-ver15
+    
+    # Una única consulta para todas las estaciones, con solo las columnas y filas (parámetro y función) necesarias
+    canales = {estacion: _pares_canales(estacion, campos[estacion]) for estacion in estaciones}
+    bloques = iter_data_raw(estaciones, fecha_ini, fecha_fin, canales=canales,
+                            columnas=['NumEstacion', 'Fecha', 'NumParametro', 'Valor'], chunk=chunk)
+    if profundidad_cola > 0:
+        bloques = _en_segundo_plano(bloques, profundidad_cola)
+    
+    procesadores = {estacion: _ProcesadorEstacion(estacion) for estacion in estaciones}
+    rondas = _rondas(bloques, procesadores)
+    
+    hasta = None
+    try:
+        for d in dias:
+            dia = d.date()
+            inicio = pd.Timestamp(dia)
+            fin = inicio + pd.Timedelta(days=1)
+            # Ventana de lectura del día (hora UTC), la misma que si se leyera solo ese día
+            inicio_lectura = inicio - pd.Timedelta(hours=2)
+            fin_lectura = fin
+            
+            # Se leen bloques hasta haber repartido todos los minutos de la ventana
+            while (hasta is None) or (hasta < fin_lectura):
+                hasta = next(rondas)
+            
+            datos = {}
+            for estacion in estaciones:
+                data = procesadores[estacion].ventana(inicio_lectura, fin_lectura)
+                # Los minutos anteriores a la ventana del día siguiente ya no se necesitan
+                procesadores[estacion].descarta(fin_lectura - pd.Timedelta(hours=2))
+                # Se conservan solo los minutos del día en hora civil
+                if len(data) != 0:
+                    i_ini, i_fin = data.index.searchsorted([inicio, fin])
+                    data = data.iloc[i_ini:i_fin]
+                datos[estacion] = data
+            
+            yield dia, datos
+    finally:
+        # Si no se recorre el periodo completo, se libera la conexión con la base de datos
+        rondas.close()
+        bloques.close()
+
+
+def _formatea_dia(data, dia, lista_campos, columna_fecha=True):
+    """
+    Info
+    ----------
+    Selecciona los minutos de un día de los datos ya procesados, en hora civil, y les da el formato
+    que devuelve lee_dia_geonica_ddbb(): un minuto por fila, los campos solicitados como columnas
+    y la fecha como texto en la columna 'yyyy/mm/dd hh:mm'.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Datos procesados en hora civil, con el índice ordenado.
+    dia : datetime.date
+        Día que se quiere obtener.
+    lista_campos : list
+        Lista con los campos que tendrá el DataFrame.
+    columna_fecha : bool, opcional
+        Si es False, no se rellena la columna 'yyyy/mm/dd hh:mm'. Por defecto es True.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    """
+    
+    # Se filtra y se queda solo con los minutos del dia en cuestion, una vez ya se han convertido a hora civil
+    if len(data) != 0:
+        inicio = pd.Timestamp(dia)
+        i_ini, i_fin = data.index.searchsorted([inicio, inicio + pd.Timedelta(days=1)])
+        data = data.iloc[i_ini:i_fin]
+    
+    # Si data está vacio, se crea con valores NaN
+    indice_fecha = pd.Index(pd.date_range(
+        start=dia, end=dt.datetime.combine(dia, dt.time(23, 59)), freq='1T'))
+    if len(data) == 0:
+        data = pd.DataFrame(index=indice_fecha, columns=lista_campos)
+
+    # En caso de que el indice esté incompleto, se reindexa para que añada nuevos con valores NaN
+    if len(data) != len(indice_fecha):
+        data = data.reindex(index=indice_fecha)
+
+    # En caso de que el columns esté incompleto, se reindexa para que añada nuevos con valores NaN
+    if lista_campos != data.columns.tolist():
+        data = data.reindex(columns=lista_campos)
+    
+    # # Separa y crea en 2 columnas fecha y hora
+    # # tambien valdría data.index.strftime('%Y/%m/%d')
+    # data['yyyy/mm/dd'] = [d.strftime('%Y/%m/%d') for d in data.index]
+    # data['hh:mm'] = [d.strftime('%H:%M') for d in data.index]
+    if columna_fecha:
+        data['yyyy/mm/dd hh:mm'] = [d.strftime('%Y/%m/%d %H:%M') for d in data.index]
+
+    return data
+
+
+def lee_periodo_geonica_ddbb(dia_inicial, dia_final, numero_estacion, lista_campos=None, chunk=CHUNK_DATOS,
+                             compacto=False):
+    """
+    Info
+    ----------
+    Se devuelven, día a día, los datos de un periodo que se encuentran en la estación.
+    A diferencia de llamar a lee_dia_geonica_ddbb() por cada día, los datos de todo el periodo
+    se solicitan a la base de datos en una única consulta, y se leen y procesan por bloques según
+    se van devolviendo los días, de forma que la memoria utilizada no depende de la longitud del periodo.
+
+    Parameters
+    ----------
+    dia_inicial : str(AAAA-MM-DD) o datetime-like
+        Primer día del periodo.
+    dia_final : str(AAAA-MM-DD) o datetime-like
+        Último día del periodo, incluido.
+    numero_estacion : int
+        Número identificativo de la estación.
+    lista_campos : list, optional
+        lista con campos a obtener de la BBDD. 
+        Por defecto son todos los canales configurados en la estación.
+    chunk : int, opcional
+        Número de filas de cada bloque leído de la base de datos. Por defecto es CHUNK_DATOS.
+    compacto : bool, opcional
+        Si es True, los canales se devuelven como float32 y no se añade la columna de texto
+        'yyyy/mm/dd hh:mm', que puede obtenerse cuando se necesite del índice
+        (data.index.strftime('%Y/%m/%d %H:%M')). Ocupa menos de la mitad de memoria. Por defecto es False.
+
+    Yields
+    -------
+    dia : datetime.date
+    data : pandas.DataFrame
+        DataFrame con todos los datos de la estación en el día, con la fecha y hora como índice.
+
+    """
+    
+    dias = pd.date_range(start=dia_inicial, end=dia_final)
+    
+    #Si el usuario no especifica ninguna lista de campos deseados, por defecto se devuelven todos los canales
+    # disponibles de la estación
+    formato_fecha = 'yyyy/mm/dd hh:mm'
+    if lista_campos == None:
+        lista_campos = get_channels_config(numero_estacion)['Abreviatura'].tolist()
+    else:
+        lista_campos = list(lista_campos)
+    # Se añade la fecha como columna, en el caso de que no esté incluida ya. En modo compacto
+    # no se añade, ya que se obtiene del índice
+    if compacto:
+        lista_campos = [campo for campo in lista_campos if campo != formato_fecha]
+    elif not formato_fecha in lista_campos:
+        lista_campos.insert(0, formato_fecha)
+    
+    if len(dias) == 0:
+        return
+    
+    # Los datos se leen y procesan por bloques, y se devuelven según se completa cada día
+    for dia, datos in _lee_periodo(dias, {numero_estacion: lista_campos}, chunk):
+        with instrumentacion.etapa('formato_dia', estacion=numero_estacion, dia=dia,
+                                   filas_entrada=len(datos[numero_estacion])):
+            data = _formatea_dia(datos[numero_estacion], dia, lista_campos, columna_fecha=not compacto)
+            if compacto:
+                data = data.astype('float32')
+        yield dia, data
+
+
+def lee_dia_geonica_ddbb(dia, numero_estacion, lista_campos=None, compacto=False):
+    """
+    Info
+    ----------
+    Se devuelven los datos de un día que se encuentran en la estación.
+
+    Parameters
+    ----------
+    dia : datetime.date
+        Día del que se quieren extraer los datos.
+    numero_estacion : int
+        Número identificativo de la estación.
+    lista_campos : list, optional
+        lista con campos a obtener de la BBDD. 
+        Por defecto son todos los canales configurados en la estación.
+    compacto : bool, opcional
+        Ver lee_periodo_geonica_ddbb(). Por defecto es False.
+
+    Returns
+    -------
+    pandas.DataFrame
+        DataFrame con todos los datos de la estación, con la fecha y hora como índice.
+
+    """
+    
+    for _, data in lee_periodo_geonica_ddbb(dia, dia, numero_estacion, lista_campos, compacto=compacto):
+        return data
+
+
+def lee_periodo_estaciones_ddbb(dia_inicial, dia_final, estaciones=None, lista_campos=None, chunk=CHUNK_DATOS,
+                                profundidad_cola=0, compacto=False):
+    """
+    Info
+    ----------
+    Se devuelven, día a día, los datos de un periodo de varias estaciones. Los datos de todas las
+    estaciones se solicitan a la base de datos en una única consulta, y se leen y procesan por bloques.
+
+    Parameters
+    ----------
+    dia_inicial : str(AAAA-MM-DD) o datetime-like
+        Primer día del periodo.
+    dia_final : str(AAAA-MM-DD) o datetime-like
+        Último día del periodo, incluido.
+    estaciones : list, opcional
+        Lista con los números identificativos de las estaciones.
+        Por defecto son las 'Estaciones Operativas' del fichero de configuración.
+    lista_campos : dict, opcional
+        Diccionario con la lista de campos a obtener de cada estación, cuya clave es el número de la estación. 
+        Por defecto son todos los canales configurados en cada estación.
+    chunk : int, opcional
+        Número de filas de cada bloque leído de la base de datos. Por defecto es CHUNK_DATOS.
+    profundidad_cola : int, opcional
+        Si es mayor que 0, los bloques se leen de la base de datos en un hilo aparte, adelantando
+        como máximo ese número de bloques mientras se procesan los anteriores. Por defecto es 0.
+    compacto : bool, opcional
+        Si es True, los canales se devuelven como float32, con menos de la mitad de memoria.
+        Por defecto es False.
+
+    Yields
+    -------
+    dia : datetime.date
+    data : pandas.DataFrame
+        DataFrame con los datos de todas las estaciones en el día, con la fecha y hora como índice.
+        Las columnas tienen dos niveles: (número de estación, nombre del canal).
+
+    """
+    
+    if estaciones is None:
+        estaciones = lee_config('Estaciones Operativas', PATH_CONFIG_PYGEONICA)
+    estaciones = list(estaciones)
+    if lista_campos is None:
+        lista_campos = {}
+    
+    dias = pd.date_range(start=dia_inicial, end=dia_final)
+    if (len(dias) == 0) or (len(estaciones) == 0):
+        return
+    
+    # Campos de cada estación, por defecto todos sus canales configurados
+    campos = {}
+    for estacion in estaciones:
+        if lista_campos.get(estacion) is None:
+            campos[estacion] = get_channels_config(estacion)['Abreviatura'].tolist()
+        else:
+            campos[estacion] = [c for c in lista_campos[estacion] if c != 'yyyy/mm/dd hh:mm']
+    
+    # Los datos se leen y procesan por bloques, y se devuelven según se completa cada día
+    for dia, datos in _lee_periodo(dias, campos, chunk, profundidad_cola):
+        with instrumentacion.etapa('formato_dia', dia=dia,
+                                   filas_entrada=sum(len(datos[estacion]) for estacion in estaciones)):
+            bloques = [_formatea_dia(datos[estacion], dia, campos[estacion], columna_fecha=False)
+                       for estacion in estaciones]
+            # Se unen todas las estaciones en una única concatenación
+            data = pd.concat(bloques, axis=1, keys=estaciones)
+            if compacto:
+                data = data.astype('float32')
+        yield dia, data
+
+
+# Etiquetas 'hh:mm' de los minutos de un día, comunes a todos los días
+_MINUTOS_DIA = ['%02d:%02d' % (m // 60, m % 60) for m in range(24 * 60)]
+
+@functools.lru_cache(maxsize=64)
+def _etiquetas_dia(dia):
+    # Etiquetas 'yyyy/mm/dd hh:mm' de los minutos del día
+    prefijo = dia.strftime('%Y/%m/%d ')
+    return [prefijo + minuto for minuto in _MINUTOS_DIA]
+
+
+def _escribe_tsv_meteo(nombre_fichero_texto, data, dia=None):
+    """
+    Info
+    ----------
+    Escribe un fichero con el formato de genera_fichero_meteo(): separado por tabuladores, con la fecha
+    'yyyy/mm/dd hh:mm' como primera columna, los valores con 3 decimales y NaN en los que faltan.
+    
+    La cabecera y los datos se escriben de una vez, formateando todas las filas en una única operación,
+    en un fichero temporal que después se renombra, de forma que nunca queda un fichero a medias.
+
+    Parameters
+    ----------
+    nombre_fichero_texto : str
+        Ruta del fichero.
+    data : pandas.DataFrame
+        Datos numéricos, con la fecha y hora de cada minuto como índice.
+    dia : datetime.date, opcional
+        Día de los datos. Si se indica y el índice contiene todos los minutos del día, las etiquetas
+        de la fecha se toman de la caché en vez de formatearse.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    if (dia is not None) and (len(data) == len(_MINUTOS_DIA)) and (data.index[0] == pd.Timestamp(dia)):
+        etiquetas = _etiquetas_dia(dia)
+    else:
+        etiquetas = [d.strftime('%Y/%m/%d %H:%M') for d in data.index]
+    
+    # Todas las filas se formatean con una única operación de formato, y los NaN se escriben como 'NaN'
+    valores = np.empty((len(data), data.shape[1] + 1), dtype=object)
+    valores[:, 0] = etiquetas
+    valores[:, 1:] = data.to_numpy(dtype=float)
+    formato_fila = '\t'.join(['%s'] + ['%.3f'] * data.shape[1]) + os.linesep
+    cuerpo = (formato_fila * len(data)) % tuple(valores.ravel().tolist())
+    cuerpo = cuerpo.replace('nan', 'NaN')
+    
+    path_temporal = nombre_fichero_texto + '.tmp'
+    with open(path_temporal, 'w', newline='') as f:
+        # Escribe la cabecera
+        a = csv.writer(f, delimiter='\t')
+        a.writerow(['yyyy/mm/dd hh:mm'] + list(data.columns))
+        f.write(cuerpo)
+    os.replace(path_temporal, nombre_fichero_texto)
+
+
+def _escribe_fichero_meteo(dia, data, estaciones, vars_excluidas, dict_renombrar, nombre_fichero, path_fichero):
+    """
+    Info
+    ----------
+    Escribe el fichero de un día de genera_fichero_meteo() a partir de los datos de todas las estaciones,
+    tal y como los devuelve lee_periodo_estaciones_ddbb().
+
+    Returns
+    -------
+    str
+        Ruta del fichero escrito.
+
+    """
+    
+    # Se eliminan las medidas que no se quieren almacenar. Para que no se produzcan errorres,
+    # se asigna el sufijo "_i"(>=2) a los parámetros que coinciden con los de alguna estación anterior
+    columnas = []
+    nombres = []
+    for i, estacion in enumerate(estaciones, start=1):
+        nombres_previos = set(nombres)
+        for var in data[estacion].columns:
+            if var in vars_excluidas:
+                continue
+            columnas.append((estacion, var))
+            if (i > 1) and (var in nombres_previos):
+                nombres.append(var + '_' + str(i))
+            else:
+                nombres.append(var)
+    
+    data = data[columnas].set_axis(nombres, axis=1)
+        
+    #Como la fecha y la hora son columnas compartidas, e idénticas, se elimina los duplicados y canales innecesarios.
+    # data.drop(columns={'yyyy/mm/dd hh:mm_2', 'VRef Ext.', 'Bateria', 'Bateria_2', 'Est.Geo3K', 'Est.Geo3K_2'}, inplace=True)
+    
+    data.rename(columns=dict_renombrar, inplace=True)
+    
+    # Crear fichero .txt
+    # La fecha, compartida por todas las estaciones, se escribe como primera columna a partir del índice
+    formato_fecha = '%Y_%m_%d'
+    nombre_fichero_texto = path_fichero + nombre_fichero + \
+        dia.strftime(formato_fecha) + '.txt'
+    
+    with instrumentacion.etapa('escritura', dia=dia, filas_entrada=len(data)):
+        _escribe_tsv_meteo(nombre_fichero_texto, data, dia)
+    
+    # Grafica
+    '''
+    plt.figure(figsize=(8, 6))
+    plt.title('DNI+isotpyes - ' + nombre_fichero +
+              dia.strftime(formato_fecha))
+    plt.grid(which='minor')
+    plt.ylabel('Irradiance $\mathregular{[W·m^{-2}]}$')
+    data.Top.plot(legend=True)
+    data.Mid.plot(legend=True)
+    data.Bot.plot(legend=True)
+    data.Rad_Dir.plot(legend=True)
+    plt.ylim([0, 1100])
+    
+    nombre_fichero_imagen = path_fichero + 'img/' + \
+        nombre_fichero + dia.strftime(formato_fecha) + '.png'
+    plt.savefig(nombre_fichero_imagen)
+    
+    print('Ha escrito fichero ' + nombre_fichero_imagen)
+    '''
+    
+    return nombre_fichero_texto
+
+
+def _genera_dias(dias, estaciones, campos, vars_excluidas, dict_renombrar, nombre_fichero, path_fichero,
+                 profundidad_cola=PROFUNDIDAD_COLA):
+    """
+    Info
+    ----------
+    Genera los ficheros de genera_fichero_meteo() de una lista de días consecutivos, leyendo los datos en
+    una única consulta. Un error en un día no impide generar el resto: si falla la lectura, los días
+    que quedan se leen de uno en uno.
+    
+    Si profundidad_cola es mayor que 0, la lectura de la base de datos, el procesado y la escritura de los
+    ficheros se hacen en hilos distintos, comunicados por colas de esa longitud, de forma que la espera
+    a la base de datos y al disco se solapa con el procesado.
+
+    Returns
+    -------
+    fallos : list de (datetime.date, str)
+        Días cuyo fichero no se ha podido generar, con la descripción del error.
+
+    """
+    
+    fallos = []
+    pendientes = [d.date() for d in dias]
+    
+    def escribe(dia, data):
+        try:
+            nombre_fichero_texto = _escribe_fichero_meteo(dia, data, estaciones, vars_excluidas, dict_renombrar,
+                                                          nombre_fichero, path_fichero)
+            print('Ha escrito fichero ' + nombre_fichero_texto)
+        except Exception:
+            fallos.append((dia, traceback.format_exc()))
+    
+    if profundidad_cola > 0:
+        # Etapa de escritura en un hilo aparte, que recibe los días ya procesados
+        cola = queue.Queue(maxsize=profundidad_cola)
         
-        with open(nombre_fichero_texto, 'w', newline='') as f:
-            a = csv.writer(f, delimiter='\t')
-            a.writerow(data.columns)
+        def escritor():
+            while True:
+                elemento = cola.get()
+                if elemento is None:
+                    return
+                escribe(*elemento)
         
-        # Escribe los datos seleccionados en cols en modo append sin cabecera ni index
-        data.to_csv(nombre_fichero_texto, columns=data.columns, mode='a', sep='\t',
-                    float_format='%.3f', header=False, index=False, na_rep='NaN')
+        hilo = threading.Thread(target=escritor, daemon=True)
+        hilo.start()
+        entrega = cola.put
+    else:
+        entrega = lambda elemento: escribe(*elemento)
+    
+    def genera(dia_ini, dia_fin):
+        # Se lee el periodo completo de todas las estaciones, y se recorre día a día
+        for dia, data in lee_periodo_estaciones_ddbb(dia_ini, dia_fin, estaciones, campos,
+                                                     profundidad_cola=profundidad_cola):
+            pendientes.remove(dia)
+            entrega((dia, data))
+    
+    try:
+        try:
+            genera(pendientes[0], pendientes[-1])
+        except Exception:
+            # Se reintentan por separado los días que no se han llegado a leer
+            for dia in list(pendientes):
+                try:
+                    genera(dia, dia)
+                except Exception:
+                    # genera() quita el día de pendientes al entregarlo, por lo que el error puede ser posterior
+                    # a la entrega (p.ej. al cerrar la lectura), y el resultado del día es el de su escritura
+                    if dia in pendientes:
+                        pendientes.remove(dia)
+                        fallos.append((dia, traceback.format_exc()))
+                    else:
+                        print('Error tras leer el día ' + str(dia) + '.\n' + traceback.format_exc())
+    finally:
+        if profundidad_cola > 0:
+            # Se espera a que se escriban los días pendientes
+            cola.put(None)
+            hilo.join()
+    
+    return fallos
+
+
+def _configura_proceso(pool_parametros, cache_datos, cache_metadatos, metadatos):
+    # Inicialización de los procesos de genera_fichero_meteo(): en Windows los procesos no heredan
+    # la configuración del proceso padre, por lo que se repite aquí. El pool se crea en el primer uso
+    with _pool_lock:
+        _pool_parametros.clear()
+        _pool_parametros.update(pool_parametros)
+    if cache_datos is not None:
+        configura_cache_datos(**cache_datos)
+    configura_cache_metadatos(**cache_metadatos)
+    # Los metadatos ya consultados por el proceso padre se reutilizan, con el instante de su consulta
+    with _cache_metadatos_lock:
+        _cache_metadatos.update(metadatos)
+
+
+def genera_fichero_meteo(dia_inicial, dia_final=None, nombre_fichero=None, path_fichero=DEFAULT_PATH,
+                         workers=None, profundidad_cola=PROFUNDIDAD_COLA):
+    """
+    Info
+    ----------
+    Genera un fichero .txt por cada día del periodo solicitado.
+    
+    Parameters
+    ----------
+    dia_inicial : str(AAAA-MM-DD) o datetime-like
+    dia_final : str(AAAA-MM-DD) o datetime-like, opcional
+        Por defecto es el día antetior a la ejecución del código.
+    nombre_fichero : string, opcional
+        Por defecto es: meteo. Al nombre del fichero se añade la fecha del mismo.
+        Con lo que, por defecto, se generará un fichero: meteoAAAA_MM_DD.txt
+    path : string, opcional
+        Formato adecuado: 'C:/mi_usuario/mis_documentos/mi_carpeta/'
+        Rellenar en el caso de que el usuario
+        del script no sea el servidor.
+    workers : int, opcional
+        Número de procesos entre los que se reparten los días, cada uno con sus propias conexiones
+        a la base de datos. Por defecto (None o 1) los días se generan en el propio proceso.
+        Si se ha configurado una fábrica de conexiones con configura_pool(), en Windows
+        debe poder serializarse con pickle (p.ej. una función definida en un módulo).
+    profundidad_cola : int, opcional
+        En cada proceso, la lectura de la base de datos, el procesado y la escritura de los ficheros
+        se hacen en hilos distintos, adelantando como máximo este número de bloques leídos y de días
+        pendientes de escribir. Con 0 se hacen en un único hilo. Por defecto es PROFUNDIDAD_COLA.
+
+    Returns
+    -------
+    bool
+        True: Ficheros creados correctamente
+        False: Error en la función. Se indican los días cuyo fichero no se ha podido crear,
+        el resto de ficheros se crean igualmente.
+
+    """
+    
+    #Si no se indica fecha del final del peridod deseado,
+    #se reciben los datos hasta el día anterior
+    if dia_final == None:
+        dia_final = dt.date.today() - dt.timedelta(days=1)
+
+    #En caso de no indicarse ningun nombre de fichero:
+    if nombre_fichero == None:
+        nombre_fichero = DEFAULT_NAME
+    
+    
+    # Listas con las estacinones en funcionamiento
+    estaciones = lee_config('Estaciones Operativas', PATH_CONFIG_PYGEONICA)
+    # Se obtiene las variabes que no se quieren incluir en el fichero generado
+    vars_excluidas = lee_config('Vars_Excluidas', PATH_CONFIG_PYGEONICA)
+    # Se lee en cada llamada, para aplicar los cambios en el fichero de configuración
+    dict_renombrar = lee_config('Dict_Rename', PATH_CONFIG_PYGEONICA)
+    
+    # Generación fichero llamando a función lee_periodo_estaciones_ddbb(dia_inicial, dia_final, estaciones)
+    
+    # Las medidas que no se quieren almacenar no se solicitan a la base de datos
+    campos = {estacion: [c for c in get_channels_config(estacion)['Abreviatura'] if c not in vars_excluidas]
+              for estacion in estaciones}
+    
+    dias = pd.date_range(start=dia_inicial, end=dia_final)
+    if len(dias) == 0:
+        return True
+    argumentos = (estaciones, campos, vars_excluidas, dict_renombrar, nombre_fichero, path_fichero, profundidad_cola)
+    
+    if (workers is None) or (workers <= 1):
+        fallos = _genera_dias(dias, *argumentos)
+    else:
+        # Los días se reparten en tramos consecutivos, varios por proceso para equilibrar la carga,
+        # y cada tramo se lee en una única consulta
+        n_tramos = min(len(dias), 4 * workers)
+        tramos = [tramo for tramo in np.array_split(np.arange(len(dias)), n_tramos) if len(tramo) != 0]
         
-        print('Ha escrito fichero ' + nombre_fichero_texto)
+        cache_datos = None
+        if _cache_datos is not None:
+            cache_datos = {'path': str(_cache_datos.path), 'tamano_max': _cache_datos.tamano_max,
+                           'margen_dias': _cache_datos.margen_dias}
+        with _cache_metadatos_lock:
+            cache_metadatos = {'ttl': TTL_METADATOS, 'path': _cache_metadatos_path}
+            metadatos = dict(_cache_metadatos)
         
-        # Grafica
-        '''
-        plt.figure(figsize=(8, 6))
-        plt.title('DNI+isotpyes - ' + nombre_fichero +
-                  dia.strftime(formato_fecha))
-        plt.grid(which='minor')
-        plt.ylabel('Irradiance $\mathregular{[W·m^{-2}]}$')
-        data.Top.plot(legend=True)
-        data.Mid.plot(legend=True)
-        data.Bot.plot(legend=True)
-        data.Rad_Dir.plot(legend=True)
-        plt.ylim([0, 1100])
-        
-        nombre_fichero_imagen = path_fichero + 'img/' + \
-            nombre_fichero + dia.strftime(formato_fecha) + '.png'
-        plt.savefig(nombre_fichero_imagen)
-        
-        print('Ha escrito fichero ' + nombre_fichero_imagen)
-        '''
+        fallos = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_configura_proceso,
+                                                    initargs=(dict(_pool_parametros), cache_datos,
+                                                              cache_metadatos, metadatos)) as ejecutor:
+            futuros = {ejecutor.submit(_genera_dias, dias[tramo], *argumentos): tramo for tramo in tramos}
+            for futuro in concurrent.futures.as_completed(futuros):
+                try:
+                    fallos += futuro.result()
+                except Exception:
+                    # Error del propio proceso (p.ej. ha terminado inesperadamente)
+                    fallos += [(d.date(), traceback.format_exc()) for d in dias[futuros[futuro]]]
+    
+    for dia, error in sorted(fallos, key=lambda fallo: fallo[0]):
+        print('Error al generar el fichero del día ' + str(dia) + ':\n' + error)
     
-    return True
+    return len(fallos) == 0
 
 
 def comprueba_canales_fichero_config():
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Caché en disco de los datos en bruto de la tabla Datos, con un fichero Parquet por estación y día (UTC).
+
+@author: Martin
+"""
+
+import os
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+# Tamaño máximo por defecto de la caché, en bytes
+TAMANO_MAX = 1024**3
+
+# Días que tienen que haber pasado desde el final de un día (UTC) para guardarlo en la caché. Los datos
+# de días anteriores ya no cambian, pero las estaciones pueden tardar en descargarlos a la base de datos
+MARGEN_DIAS = 1
+
+
+class CacheDatos:
+    """
+    Info
+    ----------
+    Caché en disco de los datos en bruto de la tabla Datos. Guarda todas las filas de una estación en un
+    día (UTC) en el fichero <path>/<estación>/<AAAA-MM-DD>.parquet, de forma que las siguientes lecturas
+    de ese día no necesiten la base de datos.
+
+    Cuando el tamaño de los ficheros supera tamano_max, se borran los utilizados hace más tiempo
+    (la fecha de modificación de cada fichero se actualiza al leerlo).
+
+    Necesita el paquete pyarrow.
+
+    Parameters
+    ----------
+    path : str
+        Carpeta de la caché. Se crea si no existe.
+    tamano_max : int, opcional
+        Tamaño máximo de la caché, en bytes. Por defecto es TAMANO_MAX.
+    margen_dias : int, opcional
+        Días que tienen que haber pasado desde el final de un día para guardarlo. Por defecto es MARGEN_DIAS.
+
+    """
+
+    def __init__(self, path, tamano_max=TAMANO_MAX, margen_dias=MARGEN_DIAS):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('La caché de datos necesita el paquete pyarrow: pip install pygeonica[cache]')
+
+        self.path = Path(path)
+        self.tamano_max = tamano_max
+        self.margen_dias = margen_dias
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._tamano = sum(f.stat().st_size for f in self.path.glob('*/*.parquet'))
+
+    def _fichero(self, estacion, dia):
+        return self.path / str(estacion) / (dia.strftime('%Y-%m-%d') + '.parquet')
+
+    def cacheable(self, dia):
+        """
+        Indica si el día (UTC) ya no puede recibir datos nuevos y, por tanto, se puede guardar en la caché.
+        """
+
+        ahora = pd.Timestamp.now(tz='UTC').tz_localize(None)
+        return pd.Timestamp(dia) + pd.Timedelta(days=1 + self.margen_dias) <= ahora
+
+    def contiene(self, estacion, dia):
+        """
+        Indica si el día de la estación está en la caché.
+        """
+
+        return self._fichero(estacion, dia).is_file()
+
+    def lee(self, estacion, dia):
+        """
+        Devuelve las filas de la estación en el día, o None si no están en la caché.
+        """
+
+        fichero = self._fichero(estacion, dia)
+        try:
+            data = pd.read_parquet(fichero)
+            # Se actualiza la fecha de modificación, para que sea el último fichero en borrarse
+            os.utime(fichero)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            print('Error en la lectura del fichero de caché ' + str(fichero) + ', se descarta.')
+            self._borra(fichero)
+            return None
+
+        return data
+
+    def guarda(self, estacion, dia, data):
+        """
+        Guarda en la caché las filas de la estación en el día, que deben ser todas las de la tabla Datos.
+        """
+
+        fichero = self._fichero(estacion, dia)
+        fichero.parent.mkdir(parents=True, exist_ok=True)
+        # Si el día ya estaba en la caché, su fichero se sustituye y deja de ocupar espacio
+        try:
+            tamano_anterior = fichero.stat().st_size
+        except OSError:
+            tamano_anterior = 0
+
+        # Se escribe en un fichero temporal y se renombra, para no dejar nunca un fichero a medias
+        temporal = fichero.with_name(fichero.name + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp')
+        data.reset_index(drop=True).to_parquet(temporal, index=False)
+        tamano = temporal.stat().st_size
+        os.replace(temporal, fichero)
+
+        with self._lock:
+            self._tamano += tamano - tamano_anterior
+            excedido = self._tamano > self.tamano_max
+
+        if excedido:
+            self._limita()
+
+    def _borra(self, fichero):
+        try:
+            tamano = fichero.stat().st_size
+            fichero.unlink()
+        except OSError:
+            return
+        with self._lock:
+            self._tamano -= tamano
+
+    def _limita(self):
+        # Se vuelven a medir los ficheros, ya que otros procesos pueden estar usando la misma carpeta
+        ficheros = []
+        for fichero in self.path.glob('*/*.parquet'):
+            try:
+                estado = fichero.stat()
+            except OSError:
+                continue
+            ficheros.append((estado.st_mtime, estado.st_size, fichero))
+        ficheros.sort()
+
+        tamano = sum(f[1] for f in ficheros)
+        # Se borran los ficheros utilizados hace más tiempo hasta quedar por debajo del tamaño máximo
+        for _, tamano_fichero, fichero in ficheros:
+            if tamano <= self.tamano_max:
+                break
+            try:
+                fichero.unlink()
+            except OSError:
+                continue
+            tamano -= tamano_fichero
+
+        with self._lock:
+            self._tamano = tamano
+
+    def vacia(self):
+        """
+        Borra todos los ficheros de la caché.
+        """
+
+        for fichero in self.path.glob('*/*.parquet'):
+            self._borra(fichero)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Lectura de los ficheros de configuración de pygeonica.
+
+No importa pandas, pyodbc ni pyserial, de forma que puede utilizarse sin el coste de importarlos.
+
+@author: Martin
+"""
+
+import os
+import copy
+import threading
+from pathlib import Path
+
+import yaml
+
+module_path = os.path.dirname(__file__)
+PATH_CONFIG_PYGEONICA = str(Path(module_path, 'pygeonica_config.yaml'))
+PATH_CONFIG_SENSORES = str(Path(module_path, 'sensores_config.yaml'))
+
+
+class Configuracion:
+    """
+    Info
+    ----------
+    Contenido de un fichero de configuración YAML. El fichero se interpreta la primera vez que se consulta
+    y las siguientes consultas se sirven de memoria. Si se modifica el fichero (cambia su fecha de
+    modificación o su tamaño), se vuelve a leer automáticamente en la siguiente consulta, de forma que
+    los procesos de larga duración aplican los cambios sin reiniciarse.
+
+    Parameters
+    ----------
+    path : str
+        Ruta al fichero de configuración.
+
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._contenido = None
+        self._firma = None      # (fecha de modificación, tamaño) del fichero leído
+        self._lock = threading.Lock()
+
+    def contenido(self):
+        """
+        Devuelve el contenido del fichero, leyéndolo de nuevo si ha cambiado. No debe modificarse.
+        Si el fichero modificado tiene errores, se mantiene el contenido anterior.
+        """
+
+        estado = os.stat(self.path)
+        firma = (estado.st_mtime_ns, estado.st_size)
+
+        with self._lock:
+            if firma != self._firma:
+                try:
+                    with open(self.path, 'r', encoding='utf8') as config_file:
+                        contenido = yaml.load(config_file, Loader = yaml.FullLoader) #Se utiliza el FullLoader para evitar un mensaje de advertencia, ver https://msg.pyyaml.org/load para mas información
+                                                                                    #No se utiliza el BasicLoader debido a que interpreta todo como strings, con FullLoader los valores numéricos los intrepreta como int o float
+                except yaml.YAMLError:
+                    if self._contenido is None:
+                        raise
+                    print('Error en el fichero de configuración ' + self.path + ', se mantiene la configuración anterior.')
+                    contenido = self._contenido
+                self._contenido = contenido
+                self._firma = firma
+            return self._contenido
+
+    def __getitem__(self, dato):
+        # Se devuelve una copia, para que el usuario pueda modificarla sin alterar la configuración guardada
+        return copy.deepcopy(self.contenido()[dato])
+
+    def get(self, dato, defecto=None):
+        """
+        Devuelve el apartado dato de la configuración, o defecto si no existe.
+        """
+
+        contenido = self.contenido()
+        if dato not in contenido:
+            return defecto
+        return copy.deepcopy(contenido[dato])
+
+
+_configuraciones = {}   # Ruta del fichero -> Configuracion
+_configuraciones_lock = threading.Lock()
+
+
+def configuracion(path=PATH_CONFIG_PYGEONICA):
+    """
+    Info
+    ----------
+    Devuelve el objeto Configuracion del fichero indicado, compartido por todo el paquete.
+
+    Parameters
+    ----------
+    path : str, opcional
+        Ruta al fichero de configuración. Por defecto es pygeonica_config.yaml.
+
+    Returns
+    -------
+    Configuracion
+
+    """
+
+    path = str(path)
+    with _configuraciones_lock:
+        if path not in _configuraciones:
+            _configuraciones[path] = Configuracion(path)
+        return _configuraciones[path]
+
+
+def lee_config(dato, path):
+    '''
+    Lee del archuvo de configuración los datos que desee el usuario.
+    El fichero solo se vuelve a leer si se ha modificado, el resto de consultas se sirven de memoria.
+
+    Parameters
+    ----------
+    dato : str
+        Opciones: Estaciones, Sensores, Servidor, BBDD
+    path : str, optional
+        Ruta al archivo de configuración.
+        Por defecto es el archivo sensores_config.yaml que se encuentra
+        en la misma carpeta que el script.
+
+    Returns
+    -------
+    Dict
+        Diccionario con la configuración. Varía según la información solicitada.
+    '''
+
+    try:
+        return configuracion(path)[dato]
+    except yaml.YAMLError:
+        print ("Error en el fichero de configuración")
+    except:
+        print("Error en la lectura del fichero")
@@ -5,16 +5,18 @@ Created on Mon Mar 16 09:12:36 2020
 @author: Martin
 """
 
-import serial
 import socket
 import time
 import os
 import datetime as dt
 import struct
+import threading
+import atexit
+import asyncio
+import weakref
 from pathlib import Path
 
-from . import bbdd
-from .bbdd import lee_config
+from .configuracion import lee_config, PATH_CONFIG_PYGEONICA
 
 
 # %%
@@ -34,7 +36,6 @@ except yaml.YAMLError:
     print ("Error in configuration file.\n")
 '''    
 module_path = os.path.dirname(__file__)
-PATH_CONFIG_PYGEONICA = str(Path(module_path, 'pygeonica_config.yaml'))
 
 config = lee_config('Estacion', PATH_CONFIG_PYGEONICA)
 
@@ -49,6 +50,18 @@ NUMERO_USUARIO = config['NUMERO_USUARIO']
 PORT = config['PORT']
 TIEMPO_RTS_ACTIVO = config['TIEMPO_RTS_ACTIVO']
 TIEMPO_ESPERA_DATOS = config['TIEMPO_ESPERA_DATOS']
+TIEMPO_INACTIVIDAD_SESION = config.get('TIEMPO_INACTIVIDAD_SESION', 10)
+
+# Tiempo máximo de espera de la respuesta de la estación, el mismo que con la antigua espera fija
+# (2 * TIEMPO_ESPERA_DATOS) seguida de la espera de recepción (5 * TIEMPO_ESPERA_DATOS)
+PLAZO_RESPUESTA = 7 * TIEMPO_ESPERA_DATOS
+
+# Caracteres de control del protocolo
+_DLE = 16   #Data Link Escape
+_ETX = 3    #End of Text
+_EOT = 4    #End of Transmission
+_ENQ = 5    #Enquiry
+_NAK = 21   #Negative Acknowledge
 
 #%%
 ###########################################################################################################
@@ -355,19 +368,353 @@ def _decodificar_FechayHora(trama_bytes):
 ###########################################################################################################
 
 
+def _trama_completa(trama, n, num_bytes):
+    """
+    Info
+    ----------
+    Indica si los n primeros bytes recibidos forman una respuesta completa de la estación. El campo de
+    longitud de la cabecera (bytes 9 y 10) indica los bytes que siguen a los 20 primeros (cabecera, número
+    de canales, fecha y DLE STX):
+        - La respuesta de 13 bytes de sincronización o de error (EOT o NAK seguido de ENQ) está completa
+          sin tener en cuenta el campo de longitud.
+        - Si anuncia la trama de la longitud esperada, solo está completa al recibir num_bytes, aunque
+          los datos contengan bytes iguales al fin de trama.
+        - Si no, es una respuesta corta, completa con la longitud anunciada y terminada en
+          DLE ETX + checksum (2 bytes) + ENQ.
+
+    Parameters
+    ----------
+    trama : bytearray
+        Bytes recibidos.
+    n : int
+        Número de bytes recibidos.
+    num_bytes : int
+        Longitud esperada de la respuesta.
+
+    Returns
+    -------
+    bool
+
+    """
+    
+    if n >= num_bytes:
+        return True
+    if n < 13:
+        return False
+    # En la respuesta de 13 bytes, los bytes 9 y 10 no son la longitud (p.ej. el código de error)
+    if (n == 13) and (trama[12] == _ENQ) and (trama[11] in (_EOT, _NAK)):
+        return True
+    longitud = 20 + int.from_bytes(trama[9:11], byteorder=BYTEORDER)
+    if longitud >= num_bytes:
+        return False
+    if (n == longitud) and (trama[n - 1] == _ENQ) and (trama[n - 5] == _DLE) and (trama[n - 4] == _ETX):
+        return True
+    return False
+
+
+def _recibe_socket(sock, num_bytes, plazo=None):
+    """
+    Info
+    ----------
+    Recibe la respuesta de la estación en un buffer de num_bytes, según van llegando los bytes, hasta que
+    esté completa (ver _trama_completa()) o se supere el plazo. Así la lectura termina en cuanto responde
+    la estación, sin esperas fijas, y una respuesta recibida en varios fragmentos no se da por incompleta.
+
+    Parameters
+    ----------
+    sock : socket.socket
+        Socket conectado con la estación, tras enviar la trama.
+    num_bytes : int
+        Longitud esperada de la respuesta.
+    plazo : float, opcional
+        Segundos máximos de espera. Por defecto es PLAZO_RESPUESTA.
+
+    Returns
+    -------
+    lectura : bytes
+        Bytes recibidos, vacío si la estación ha cerrado la conexión sin responder.
+        Si se supera el plazo sin recibir nada, se lanza socket.timeout.
+
+    """
+    
+    limite = time.monotonic() + (PLAZO_RESPUESTA if plazo is None else plazo)
+    buffer = bytearray(num_bytes)
+    vista = memoryview(buffer)
+    n = 0
+    
+    while not _trama_completa(buffer, n, num_bytes):
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            break
+        sock.settimeout(restante)
+        try:
+            recibidos = sock.recv_into(vista[n:])
+        except socket.timeout:
+            break
+        if recibidos == 0:
+            # La estación ha cerrado la conexión
+            return bytes(buffer[:n])
+        n += recibidos
+    
+    if n == 0:
+        raise socket.timeout('Sin respuesta de la estación')
+    return bytes(buffer[:n])
+
+
+def _configura_socket(sock):
+    # Keepalive de TCP, con tiempos cortos donde el sistema operativo permite configurarlos
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for opcion, valor in (('TCP_KEEPIDLE', 10), ('TCP_KEEPINTVL', 5), ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, opcion):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opcion), valor)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class SesionEstacion:
+    """
+    Info
+    ----------
+    Conexión TCP con una estación que se mantiene abierta entre lecturas, de forma que las consultas
+    repetidas (p.ej. cada segundo) no repiten la conexión con la estación.
+    
+    La conexión se abre en la primera consulta, con keepalive de TCP para detectar las conexiones caídas,
+    y se cierra si se produce un error (la siguiente consulta vuelve a conectar) o si pasa
+    tiempo_inactividad segundos sin usarse, para no dejar ocupada la estación. Un único hilo cierra
+    las conexiones inactivas de todas las sesiones, a partir del instante en que se usó cada una.
+    Puede utilizarse desde varios hilos; las consultas se hacen de una en una.
+
+    Parameters
+    ----------
+    dir_socket : tuple
+        Dirección IP y puerto de la estación.
+    tiempo_inactividad : float, opcional
+        Segundos sin usarse tras los que se cierra la conexión. Con 0 se cierra tras cada consulta.
+        Por defecto es TIEMPO_INACTIVIDAD_SESION.
+
+    """
+    
+    def __init__(self, dir_socket, tiempo_inactividad=None):
+        self.dir_socket = dir_socket
+        self.tiempo_inactividad = TIEMPO_INACTIVIDAD_SESION if tiempo_inactividad is None else tiempo_inactividad
+        
+        self._sock = None
+        self._lock = threading.Lock()
+        self._ultimo_uso = time.monotonic()     # Instante en que terminó la última consulta
+    
+    def _conecta(self):
+        sock = socket.create_connection(self.dir_socket, timeout=5 * TIEMPO_ESPERA_DATOS)
+        _configura_socket(sock)
+        return sock
+    
+    def _cierra_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except:
+                print('Error al cerrar el socket.\n')
+            self._sock = None
+    
+    def _inactiva(self, ahora):
+        return ahora - self._ultimo_uso >= self.tiempo_inactividad
+    
+    def _limite_inactividad(self):
+        # Instante en que se cerrará la conexión si no se vuelve a usar, None si no hay conexión abierta
+        if self._sock is None:
+            return None
+        return self._ultimo_uso + self.tiempo_inactividad
+    
+    def _cierra_si_inactiva(self, ahora):
+        # Se llama desde el hilo que cierra las conexiones inactivas, que no espera a las sesiones en uso.
+        # Devuelve True si la conexión está cerrada
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if (self._sock is not None) and self._inactiva(ahora):
+                self._cierra_socket()
+            return self._sock is None
+        finally:
+            self._lock.release()
+    
+    def _intercambia(self, trama, num_bytes):
+        # Envía la trama y recibe la respuesta por la conexión abierta
+        self._sock.settimeout(PLAZO_RESPUESTA)
+        self._sock.sendall(trama)
+        return _recibe_socket(self._sock, num_bytes)
+    
+    def consulta(self, trama, num_bytes):
+        """
+        Info
+        ----------
+        Envía la trama a la estación y recibe su respuesta, conectando antes si no hay conexión abierta.
+        Si la conexión abierta ya no es válida (la estación la ha cerrado), se vuelve a conectar
+        y se repite la consulta una vez.
+
+        Parameters
+        ----------
+        trama : bytes
+            La trama que se desea enviar.
+        num_bytes : int
+            Número de bytes de la respuesta.
+
+        Returns
+        -------
+        lectura : bytes
+            La lectura de la estación en bruto, o -1 si se produce un error.
+
+        """
+        
+        with self._lock:
+            # Si la conexión ha pasado el tiempo de inactividad y todavía no se ha cerrado, se abre una nueva
+            if (self._sock is not None) and self._inactiva(time.monotonic()):
+                self._cierra_socket()
+            
+            try:
+                lectura = self._consulta(trama, num_bytes)
+            finally:
+                self._ultimo_uso = time.monotonic()
+                if self.tiempo_inactividad <= 0:
+                    self._cierra_socket()
+                abierta = self._sock is not None
+        
+        # Fuera del lock de la sesión, que el hilo de vigilancia no espera
+        if abierta:
+            _vigila(self)
+        return lectura
+    
+    def _consulta(self, trama, num_bytes):
+        # Envía la trama y recibe la respuesta, volviendo a conectar una vez si hace falta (ver consulta()).
+        # Se llama con el lock de la sesión tomado
+        for intento in range(2):
+            reutilizada = self._sock is not None
+            if not reutilizada:
+                try:
+                    self._sock = self._conecta()
+                except socket.error as err:
+                    print('Error en la conexión del socket.\n %s' %(err))
+                    return -1
+            
+            try:
+                lectura = self._intercambia(trama, num_bytes)
+            except socket.timeout:
+                print('Tiempo de espera de datos sobrepasado.\n')
+                self._cierra_socket()
+                return -1
+            except socket.error as err:
+                self._cierra_socket()
+                # Una conexión reutilizada puede haberse cerrado por la estación: se reintenta con una nueva
+                if reutilizada:
+                    continue
+                print('Error en la comunicación por el socket.\n %s' %(err))
+                return -1
+            
+            # Una respuesta vacía indica que la estación ha cerrado la conexión
+            if (len(lectura) == 0) and reutilizada:
+                self._cierra_socket()
+                continue
+            # Si la respuesta está incompleta, el resto llegaría en la siguiente consulta, por lo
+            # que se descarta la conexión
+            if len(lectura) != num_bytes:
+                self._cierra_socket()
+            return lectura
+        
+        print('Error en la comunicación por el socket.\n')
+        return -1
+    
+    def cierra(self):
+        """
+        Cierra la conexión con la estación, si está abierta.
+        """
+        
+        with self._lock:
+            self._cierra_socket()
+
+
+_vigiladas = weakref.WeakSet()      # Sesiones con la conexión abierta, que se cierran por inactividad
+_vigilancia = threading.Condition()
+_vigilante = None                   # Hilo que cierra las conexiones inactivas
+
+
+def _vigila(sesion):
+    """
+    Añade la sesión a las que vigila el hilo que cierra las conexiones inactivas, creándolo si no existe.
+    """
+    
+    global _vigilante
+    
+    with _vigilancia:
+        if sesion in _vigiladas:
+            # El hilo ya la vigila; su nuevo límite de inactividad es posterior, por lo que no hace falta avisarle
+            return
+        _vigiladas.add(sesion)
+        if _vigilante is None:
+            _vigilante = threading.Thread(target=_cierra_inactivas, name='SesionEstacion', daemon=True)
+            _vigilante.start()
+        else:
+            _vigilancia.notify()
+
+
+def _cierra_inactivas():
+    """
+    Hilo que cierra las conexiones de las sesiones vigiladas que pasan su tiempo de inactividad sin usarse.
+    Espera hasta el primer límite de inactividad y termina cuando no queda ninguna conexión abierta.
+    """
+    
+    global _vigilante
+    
+    with _vigilancia:
+        while True:
+            ahora = time.monotonic()
+            proximo = None
+            for sesion in list(_vigiladas):
+                limite = sesion._limite_inactividad()
+                if (limite is not None) and (limite <= ahora):
+                    if sesion._cierra_si_inactiva(ahora):
+                        limite = None
+                    else:
+                        # En uso o usada después de calcular el límite: se vuelve a comprobar más tarde
+                        limite = max(sesion._limite_inactividad() or ahora, ahora + sesion.tiempo_inactividad / 2)
+                if limite is None:
+                    _vigiladas.discard(sesion)
+                else:
+                    proximo = limite if proximo is None else min(proximo, limite)
+            
+            if proximo is None:
+                _vigilante = None
+                return
+            _vigilancia.wait(proximo - ahora)
+
+
+_sesiones = {}      # (IP, puerto) -> SesionEstacion
+_sesiones_lock = threading.Lock()
+
+
+def _sesion(dir_socket):
+    """
+    Devuelve la sesión compartida con la estación en dir_socket (IP, puerto), creándola si no existe.
+    """
+    
+    with _sesiones_lock:
+        if dir_socket not in _sesiones:
+            _sesiones[dir_socket] = SesionEstacion(dir_socket)
+        return _sesiones[dir_socket]
+
+
 def _socket(dir_socket, trama, num_bytes):
     """
     Info
     ----------
-    Esta función se encarga de abrir y configurar el socket, establecer la conexión con la estación, 
-    enviar la trama deseada y recibir la respuesta de la estación.
+    Esta función se encarga de enviar la trama deseada a la estación y recibir su respuesta,
+    mediante la conexión de la sesión con la estación, que se abre si no lo está y se reutiliza
+    en las siguientes llamadas (ver SesionEstacion).
 
     Parameters
     ----------
-    dir_socket : string
-        La dirrección IP de la estación
+    dir_socket : tuple
+        La dirrección IP de la estación y el puerto
     trama : bytearray
         La trama que se desea enviar
+    num_bytes : int
+        Número de bytes de la respuesta
         
     Returns
     -------
@@ -376,39 +723,10 @@ def _socket(dir_socket, trama, num_bytes):
 
     """
     
-    #Se crear el scoket y se conceta con la estación
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    except socket.error as err:
-        print('Error en la creación del socket.\n %s' %(err))
-        return -1
-    try:
-        sock.connect(dir_socket)
-    except socket.error as err:
-        print('Error en la conexión del socket.\n %s' %(err))
-        return -1
-    
-    #Se envía la trama a la estación
-    sock.sendall(trama)
-    
-    #Se espera hasta que se reciban el numero de bytes deseados
-    try:
-        time.sleep(2 * TIEMPO_ESPERA_DATOS)
-        sock.settimeout(5 * TIEMPO_ESPERA_DATOS)
-        lectura = sock.recv(num_bytes)
-    except:
-        print('Tiempo de espera de datos sobrepasado.\n')
-        return -1
-    try:
-        sock.close()
-    except:
-        print('Error al cerrar el socket.\n')
-    
-    #Se devuelve la lectura obtenida
-    return lectura
+    return _sesion(dir_socket).consulta(trama, num_bytes)
 
 
-def _serial(dir_serial, trama):
+def _serial(dir_serial, trama, num_bytes=193):
     """
     De forma similar a _socket(), pero mediante el puerto de comunicación Serie.
 
@@ -417,6 +735,10 @@ def _serial(dir_serial, trama):
     dir_serial : string
         La dirrección del puerto serie por el 
         cual se va a producir la comunicación con la estación
+    trama : bytearray
+        La trama que se desea enviar
+    num_bytes : int, opcional
+        Longitud esperada de la respuesta. Por defecto es 193.
 
     Returns
     -------
@@ -424,6 +746,9 @@ def _serial(dir_serial, trama):
         La lectura de la estación en bruto
 
     """
+    # pyserial solo se importa al utilizar el puerto serie
+    import serial
+    
     #Se confiura y abre el puerto serie
     try:
         ser = serial.Serial(
@@ -443,18 +768,281 @@ def _serial(dir_serial, trama):
     time.sleep(TIEMPO_RTS_ACTIVO)
     ser.rts = False
     
-    #Se escribe en el buffer de salida la trama deseada y se espera un tiempo para que la estación responda
+    #Se escribe en el buffer de salida la trama deseada
     ser.write(trama)      
-    time.sleep(TIEMPO_ESPERA_DATOS)
     
-    #Se lee el buffer de entrada donde debería estar la informacion recibida
-    lectura = ser.read_all()
+    #Se lee la respuesta según llega, hasta que esté completa o se supere el plazo
+    limite = time.monotonic() + PLAZO_RESPUESTA
+    lectura = bytearray()
+    while not _trama_completa(lectura, len(lectura), num_bytes):
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            break
+        ser.timeout = restante
+        datos = ser.read(max(1, min(ser.in_waiting, num_bytes - len(lectura))))
+        if len(datos) == 0:
+            break
+        lectura += datos
+    lectura = bytes(lectura)
     ser.close()
     
     #Se devuelve la lectura obtenida
     return lectura
 
 
+#%%
+###########################################################################################################
+####
+####        FUNCIONES INTERNAS DE LECTURA, COMUNES A LAS INTERFACES SÍNCRONA Y ASÍNCRONA
+####
+###########################################################################################################
+
+
+def _trama_lectura(num_estacion, modo):
+    """
+    Devuelve la trama de lectura de los canales en el modo indicado, o None si el modo no es válido.
+    """
+    
+    if (modo == 1) | ((modo >= 12) & (modo <= 22)):
+        return _genera_trama(num_estacion, modo)
+    print('Error en el modo seleccionado.\n')
+    return None
+
+
+def _ip_valida(dir_socket):
+    """
+    Comprueba que la dirección IP tiene un formato adecuado.
+    """
+    
+    for num in dir_socket.split('.'):
+        if (int(num) < 0) | (int(num) > 255):
+            print('Error en el formato de la dirrección IP.\n')
+            return False
+    return True
+
+
+def _decodifica_lectura(lectura, num_estacion):
+    """
+    Info
+    ----------
+    Comprueba la respuesta de la estación a una trama de lectura y obtiene su fecha y sus medidas.
+
+    Parameters
+    ----------
+    lectura : bytes
+        La lectura de la estación en bruto.
+    num_estacion : int
+        El número identificativo de la estación.
+
+    Returns
+    -------
+    (fecha, medidas) : (datetime, list de float)
+        Si la lectura es correcta. En otro caso, el estado de la recepción
+        (ver _comprobar_recepcion()) o -1.
+
+    """
+    
+    #Se comprueba si la transmisión ha sido correcta
+    estado_recepcion = _comprobar_recepcion(lectura, num_estacion)
+    
+    '''
+    En caso de que se produzca un error, se devuelve el número del error
+    Si el estado de la recepcion es correcto se devuelve un True
+    En cualquier otro caso, p.ej. el número de bytes recibidos no es el esperado, el valor devuelto es un False
+    ''' 
+    if estado_recepcion != True:
+        print("Error en la comunicacion con la estación.\n")
+        return estado_recepcion
+    
+    #Si hay algo que leer...
+    if lectura:
+        #Obtencion de la fecha de la estación
+        fecha = _decodificar_FechayHora(lectura)
+        print('La fecha de la estación es: ')
+        print(fecha)
+        
+        #Obtencion de las medidas instantáneas
+        medidas = _decodificar_medidas(lectura)
+        # print('Las medidas obtenidas son:\n')
+        # print(medidas)
+        
+    else:
+        print("Error en la recepción.\n")
+        return -1
+    
+    return fecha, medidas
+
+
+def _asigna_canales(num_estacion, medidas):
+    """
+    Info
+    ----------
+    Asigna a cada medida el nombre de su canal y sus unidades, según la configuración de la estación
+    en la base de datos.
+
+    Returns
+    -------
+    medidas : dict (str : (float + str))
+        Ver lee_canales().
+
+    """
+    
+    # El módulo bbdd (pandas, pyodbc) solo se importa cuando se necesita
+    from . import bbdd
+    
+    canales = bbdd.get_channels_config(num_estacion)['Abreviatura'].tolist()
+    
+    #Se crea un lista con las unidades de las variables
+    unidades = []
+    param = bbdd.get_parameters().set_index('Abreviatura')['Unidad']
+    for medida in canales:
+        unidades.append(param.loc[medida])
+    
+    #Se crea un diccionario cuya clave es el nombre del canal y contiene la medida correspondiente a dicho canal
+    med =[list(x) for x in zip(medidas,unidades)]
+    return dict(zip(canales, med))
+
+
+#%%
+###########################################################################################################
+####
+####        COMUNICACIÓN ASÍNCRONA (asyncio)
+####
+###########################################################################################################
+
+
+async def _recibe_async(lector, num_bytes, plazo=None):
+    """
+    Igual que _recibe_socket(), pero con un asyncio.StreamReader. Si se supera el plazo sin recibir nada,
+    se lanza asyncio.TimeoutError.
+    """
+    
+    loop = asyncio.get_running_loop()
+    limite = loop.time() + (PLAZO_RESPUESTA if plazo is None else plazo)
+    lectura = bytearray()
+    
+    while not _trama_completa(lectura, len(lectura), num_bytes):
+        restante = limite - loop.time()
+        if restante <= 0:
+            break
+        try:
+            datos = await asyncio.wait_for(lector.read(num_bytes - len(lectura)), restante)
+        except asyncio.TimeoutError:
+            break
+        if len(datos) == 0:
+            # La estación ha cerrado la conexión
+            return bytes(lectura)
+        lectura += datos
+    
+    if len(lectura) == 0:
+        raise asyncio.TimeoutError()
+    return bytes(lectura)
+
+
+class _SesionAsync:
+    """
+    Igual que SesionEstacion, pero con sockets no bloqueantes de asyncio, para un bucle de eventos.
+    """
+    
+    def __init__(self, dir_socket, tiempo_inactividad=None):
+        self.dir_socket = dir_socket
+        self.tiempo_inactividad = TIEMPO_INACTIVIDAD_SESION if tiempo_inactividad is None else tiempo_inactividad
+        
+        self._lector = None
+        self._escritor = None
+        self._lock = asyncio.Lock()
+        self._cierre = None     # Cierre de la conexión por inactividad
+    
+    def _cierra_conexion(self):
+        if self._escritor is not None:
+            try:
+                self._escritor.close()
+            except:
+                print('Error al cerrar el socket.\n')
+            self._lector = None
+            self._escritor = None
+    
+    def _programa_cierre(self):
+        if self._cierre is not None:
+            self._cierre.cancel()
+            self._cierre = None
+        if self.tiempo_inactividad <= 0:
+            self._cierra_conexion()
+        elif self._escritor is not None:
+            self._cierre = asyncio.get_running_loop().call_later(self.tiempo_inactividad, self._cierra_conexion)
+    
+    async def consulta(self, trama, num_bytes):
+        """
+        Ver SesionEstacion.consulta().
+        """
+        
+        async with self._lock:
+            if self._cierre is not None:
+                self._cierre.cancel()
+                self._cierre = None
+            
+            try:
+                for intento in range(2):
+                    reutilizada = self._escritor is not None
+                    if not reutilizada:
+                        try:
+                            self._lector, self._escritor = await asyncio.wait_for(
+                                    asyncio.open_connection(*self.dir_socket), 5 * TIEMPO_ESPERA_DATOS)
+                        except (OSError, asyncio.TimeoutError) as err:
+                            print('Error en la conexión del socket.\n %s' %(err))
+                            return -1
+                        _configura_socket(self._escritor.get_extra_info('socket'))
+                    
+                    try:
+                        self._escritor.write(trama)
+                        await self._escritor.drain()
+                        lectura = await _recibe_async(self._lector, num_bytes)
+                    except asyncio.TimeoutError:
+                        print('Tiempo de espera de datos sobrepasado.\n')
+                        self._cierra_conexion()
+                        return -1
+                    except OSError as err:
+                        self._cierra_conexion()
+                        # Una conexión reutilizada puede haberse cerrado por la estación: se reintenta con una nueva
+                        if reutilizada:
+                            continue
+                        print('Error en la comunicación por el socket.\n %s' %(err))
+                        return -1
+                    except BaseException:
+                        # Consulta cancelada (p.ej. por el plazo de lee_todas()): la respuesta podría llegar
+                        # después, por lo que se descarta la conexión
+                        self._cierra_conexion()
+                        raise
+                    
+                    # Una respuesta vacía indica que la estación ha cerrado la conexión
+                    if (len(lectura) == 0) and reutilizada:
+                        self._cierra_conexion()
+                        continue
+                    # Si la respuesta está incompleta, se descarta la conexión
+                    if len(lectura) != num_bytes:
+                        self._cierra_conexion()
+                    return lectura
+                
+                print('Error en la comunicación por el socket.\n')
+                return -1
+            finally:
+                self._programa_cierre()
+
+
+_sesiones_async = weakref.WeakKeyDictionary()     # Bucle de eventos -> {(IP, puerto): _SesionAsync}
+
+
+def _sesion_async(dir_socket):
+    """
+    Devuelve la sesión asíncrona con la estación en dir_socket, compartida dentro del bucle de eventos actual.
+    """
+    
+    sesiones = _sesiones_async.setdefault(asyncio.get_running_loop(), {})
+    if dir_socket not in sesiones:
+        sesiones[dir_socket] = _SesionAsync(dir_socket)
+    return sesiones[dir_socket]
+
+
 #%%
 ###########################################################################################################
 ####
@@ -504,13 +1092,10 @@ def lee_canales(num_estacion, modo_comm='socket', dir_socket=None, dir_serie=Non
     """
     
     #Se define la trama que se va a enviar, en función de la información deseada
-    if (modo == 1) | ((modo >= 12) & (modo <= 22)):
-        trama = _genera_trama(num_estacion, modo)
-    else:
-        print('Error en el modo seleccionado.\n')
+    trama = _trama_lectura(num_estacion, modo)
+    if trama is None:
         return -1
     
-    
     #Se comprueba que la estación pertenece a las estaciones existentes
     if not num_estacion in Estaciones:
         print('Error en la selección de la estación, número de estación incorrecto.\n')
@@ -523,10 +1108,8 @@ def lee_canales(num_estacion, modo_comm='socket', dir_socket=None, dir_serie=Non
         #Se comprueba que dir_socket es válido
         if type(dir_socket) == str:
             #Se comprueba que la dirrecion tiene un formato adecuado
-            for num in dir_socket.split('.'):
-                if (int(num) < 0) | (int(num) > 255):
-                    print('Error en el formato de la dirrección IP.\n')
-                    return -1
+            if not _ip_valida(dir_socket):
+                return -1
             
             num_bytes = 193 #Según el protocolo de geonica, la trama recibida por la estacion es de 193 bytes (Esto no se cumple si se solicita sincronización de hora)
             #Una vez hechas las comprbaciones, comienza la comunicación
@@ -559,7 +1142,7 @@ def lee_canales(num_estacion, modo_comm='socket', dir_socket=None, dir_serie=Non
                     return -1
             
             #Una vez hechas las comprbaciones, comienza la comunicación
-            lectura = _serial(dir_serie,trama)
+            lectura = _serial(dir_serie, trama, 193)
             
             #Lectura errónea
             if lectura == -1:
@@ -573,51 +1156,348 @@ def lee_canales(num_estacion, modo_comm='socket', dir_socket=None, dir_serie=Non
         return -1
     
     #Tratamiento de la lectura de la estación
+    decodificada = _decodifica_lectura(lectura, num_estacion)
+    if not isinstance(decodificada, tuple):
+        return decodificada
+    fecha, medidas = decodificada
     
-    #Se comprueba si la transmisión ha sido correcta
-    estado_recepcion = _comprobar_recepcion(lectura, num_estacion)
+    #Al finalizar la comunicación, se devuelve la fecha y las medidas obtenidas, junto con sus unidades
+    return fecha, _asigna_canales(num_estacion, medidas)
+
+
+async def lee_canales_async(num_estacion, dir_socket=None, modo=1, plazo=None):
+    """
+    Info
+    ----------
+    Igual que lee_canales() por socket, pero como corrutina de asyncio, de forma que se pueden leer varias
+    estaciones a la vez (ver lee_todas()). La conexión con cada estación se mantiene abierta entre
+    lecturas dentro del mismo bucle de eventos, igual que en lee_canales().
+
+    Parameters
+    ----------
+    num_estacion : int
+    dir_socket : str, opcional
+        Por defecto es None. Se obtiene del fichero de configuración.
+    modo : int, opcional
+        Ver lee_canales(). Por defecto es 1(Medidas instantáneas).
+    plazo : float, opcional
+        Segundos máximos que puede durar la lectura, incluidos los reintentos. Por defecto no hay
+        más límite que los de cada intento (conexión y PLAZO_RESPUESTA).
+
+    Returns
+    -------
+    Ver lee_canales().
+
+    """
     
-    '''
-    En caso de que se produzca un error, se devuelve el número del error
-    Si el estado de la recepcion es correcto se devuelve un True
-    En cualquier otro caso, p.ej. el número de bytes recibidos no es el esperado, el valor devuelto es un False
-    ''' 
-    if estado_recepcion != True:
-        print("Error en la comunicacion con la estación.\n")
-        return estado_recepcion
+    if plazo is not None:
+        try:
+            return await asyncio.wait_for(lee_canales_async(num_estacion, dir_socket, modo), plazo)
+        except asyncio.TimeoutError:
+            print('Tiempo de lectura de la estación ' + str(num_estacion) + ' sobrepasado.\n')
+            return -1
     
-    #Si hay algo que leer...
-    if lectura:
-        #Obtencion de la fecha de la estación
-        fecha = _decodificar_FechayHora(lectura)
-        print('La fecha de la estación es: ')
-        print(fecha)
-        
-        #Obtencion de las medidas instantáneas
-        medidas = _decodificar_medidas(lectura)
-        # print('Las medidas obtenidas son:\n')
-        # print(medidas)
-        
-    else:
-        print("Error en la recepción.\n")
+    #Se define la trama que se va a enviar, en función de la información deseada
+    trama = _trama_lectura(num_estacion, modo)
+    if trama is None:
         return -1
     
-    canales = bbdd.get_channels_config(num_estacion)['Abreviatura'].tolist()
+    #Se comprueba que la estación pertenece a las estaciones existentes
+    if not num_estacion in Estaciones:
+        print('Error en la selección de la estación, número de estación incorrecto.\n')
+        return -1
     
-    #Se crea un lista con las unidades de las variables
-    unidades = []
-    for medida in canales:
-        param = bbdd.get_parameters().set_index('Abreviatura')['Unidad']
-        unidades.append(param.loc[medida])
+    if dir_socket == None:
+        dir_socket = Estaciones[num_estacion]
+    if (type(dir_socket) != str) or (not _ip_valida(dir_socket)):
+        print('Por favor, indique una dirreción IP válida.\n')
+        return -1
     
-    #Se crea un diccionario cuya clave es el nombre del canal y contiene la medida correspondiente a dicho canal
-    med =[list(x) for x in zip(medidas,unidades)]
-    res = dict(zip(canales, med))
+    #Se intenta realizar la comunicación hasta un número máximo de intentos(5)
+    num_bytes = 193
+    sesion = _sesion_async((dir_socket, PORT))
+    lectura = []
+    intentos = 0
+    while len(lectura) != num_bytes:
+        lectura = await sesion.consulta(trama, num_bytes)
+        intentos += 1
+        if (intentos > 5) | (lectura == -1):
+            break
     
-    #Al finalizar la comunicación, se devuelve la fecha y las medidas obtenidas, junto con sus unidades
+    #Lectura errónea
+    if lectura == -1:
+        return -1
+    
+    decodificada = _decodifica_lectura(lectura, num_estacion)
+    if not isinstance(decodificada, tuple):
+        return decodificada
+    fecha, medidas = decodificada
+    
+    # La configuración de los canales puede necesitar una consulta a la base de datos, que se hace en un hilo
+    # para no detener el resto de lecturas
+    res = await asyncio.get_running_loop().run_in_executor(None, _asigna_canales, num_estacion, medidas)
     return fecha, res
 
 
+async def lee_todas(estaciones=None, modo=1, plazo=None):
+    """
+    Info
+    ----------
+    Lee a la vez los canales de varias estaciones, de forma que el tiempo de lectura es el de la estación
+    más lenta y no la suma de todas. El error o la falta de respuesta de una estación no afecta al resto, cuyo resultado es -1.
+    
+    Uso:
+        lecturas = asyncio.run(estacion.lee_todas())
+
+    Parameters
+    ----------
+    estaciones : list o dict, opcional
+        Lista de números de estación, o diccionario con la IP de cada número de estación.
+        Por defecto son todas las Estaciones del fichero de configuración.
+    modo : int, opcional
+        Ver lee_canales(). Por defecto es 1(Medidas instantáneas).
+    plazo : float, opcional
+        Segundos máximos de lectura de cada estación. Por defecto es el tiempo de conexión
+        (5 * TIEMPO_ESPERA_DATOS) más PLAZO_RESPUESTA.
+
+    Returns
+    -------
+    lecturas : dict
+        Resultado de lee_canales_async() de cada estación, cuya clave es el número de la estación.
+
+    """
+    
+    if estaciones is None:
+        estaciones = Estaciones
+    if not isinstance(estaciones, dict):
+        estaciones = {num_estacion: None for num_estacion in estaciones}
+    if plazo is None:
+        plazo = 5 * TIEMPO_ESPERA_DATOS + PLAZO_RESPUESTA
+    
+    resultados = await asyncio.gather(*[lee_canales_async(num_estacion, dir_socket, modo, plazo)
+                                        for num_estacion, dir_socket in estaciones.items()],
+                                      return_exceptions=True)
+    
+    lecturas = {}
+    for num_estacion, resultado in zip(estaciones, resultados):
+        if isinstance(resultado, Exception):
+            print('Error en la lectura de la estación ' + str(num_estacion) + ': ' + repr(resultado) + '\n')
+            resultado = -1
+        lecturas[num_estacion] = resultado
+    return lecturas
+
+
+async def cierra_sesiones_async(direcciones=None):
+    """
+    Cierra las conexiones abiertas con las estaciones por lee_canales_async() en el bucle de eventos actual.
+    
+    Parameters
+    ----------
+    direcciones : list de (IP, puerto), opcional
+        Conexiones que se cierran. Por defecto son todas las del bucle de eventos actual.
+    """
+    
+    loop = asyncio.get_running_loop()
+    sesiones = _sesiones_async.get(loop, {})
+    if direcciones is None:
+        direcciones = list(sesiones)
+    for dir_socket in direcciones:
+        sesion = sesiones.pop(dir_socket, None)
+        if sesion is None:
+            continue
+        async with sesion._lock:
+            if sesion._cierre is not None:
+                sesion._cierre.cancel()
+                sesion._cierre = None
+            sesion._cierra_conexion()
+    if not sesiones:
+        _sesiones_async.pop(loop, None)
+
+
+class Adquisicion:
+    """
+    Info
+    ----------
+    Muestreo periódico de los canales de varias estaciones a ritmo fijo, alineado con el reloj: con
+    periodo=1 las lecturas empiezan en cada segundo exacto, con periodo=60 en cada minuto, etc.
+    
+    Cada instante de muestreo se calcula a partir de la hora actual y no sumando el periodo a la espera
+    anterior, de forma que la duración de las lecturas no acumula retraso. Si un ciclo dura más que el
+    periodo, no se acumulan los ciclos pendientes: se omiten los instantes ya pasados, se indica en la
+    siguiente muestra (campo 'saltados') y se continúa en el siguiente instante.
+    
+    Las estaciones se leen a la vez con lee_canales_async(), y cada lectura se entrega a la función
+    destino, que recibe un diccionario con:
+        'instante': datetime.datetime, instante de muestreo programado
+        'estacion': int, número de la estación
+        'modo': int, tipo de medidas (ver lee_canales())
+        'fecha': datetime.datetime, fecha de la estación, o None si la lectura es errónea
+        'medidas': dict, medidas de los canales (ver lee_canales()), o None si la lectura es errónea
+        'error': None, o el valor devuelto por lee_canales_async() si la lectura es errónea
+        'retraso': float, segundos desde el instante de muestreo hasta recibir la lectura
+        'saltados': int, instantes de muestreo omitidos antes de este por sobrepasar el periodo
+    
+    Uso:
+        adquisicion = estacion.Adquisicion(1, print, modos=[1])
+        adquisicion.inicia()        # En un hilo aparte
+        ...
+        adquisicion.detiene()
+    o, dentro de un bucle de eventos:
+        await adquisicion.ejecuta()
+
+    Parameters
+    ----------
+    periodo : float
+        Segundos entre muestras.
+    destino : function
+        Función (o corrutina) a la que se entrega cada lectura. Sus errores no detienen el muestreo.
+    estaciones : list o dict, opcional
+        Ver lee_todas(). Por defecto son todas las Estaciones del fichero de configuración.
+    modos : list de int, opcional
+        Tipos de medidas que se leen de cada estación en cada muestra. Por defecto es [1] (instantáneas).
+    plazo : float, opcional
+        Segundos máximos de lectura de cada estación. Por defecto es el periodo, de forma que una estación
+        que no responde no retrasa las siguientes muestras.
+
+    """
+    
+    def __init__(self, periodo, destino, estaciones=None, modos=(1,), plazo=None):
+        if periodo <= 0:
+            raise ValueError('El periodo debe ser positivo: ' + repr(periodo))
+        if estaciones is None:
+            estaciones = Estaciones
+        if not isinstance(estaciones, dict):
+            estaciones = {num_estacion: None for num_estacion in estaciones}
+        
+        self.periodo = periodo
+        self.destino = destino
+        self.estaciones = dict(estaciones)
+        self.modos = list(modos)
+        self.plazo = periodo if plazo is None else plazo
+        
+        self._loop = None
+        self._parada = None
+        self._hilo = None
+    
+    def _siguiente(self, ahora):
+        # Primer instante de muestreo, múltiplo del periodo, posterior a ahora
+        return (ahora // self.periodo + 1) * self.periodo
+    
+    async def _entrega(self, muestra):
+        try:
+            resultado = self.destino(muestra)
+            if asyncio.iscoroutine(resultado):
+                await resultado
+        except Exception as err:
+            print('Error en la función de destino de la adquisición.\n %s' %(err))
+    
+    async def _lee(self, instante, num_estacion, dir_socket, modo, saltados):
+        lectura = await lee_canales_async(num_estacion, dir_socket, modo, self.plazo)
+        muestra = {'instante': dt.datetime.fromtimestamp(instante), 'estacion': num_estacion, 'modo': modo,
+                   'fecha': None, 'medidas': None, 'error': None,
+                   'retraso': time.time() - instante, 'saltados': saltados}
+        if isinstance(lectura, tuple):
+            muestra['fecha'], muestra['medidas'] = lectura
+        else:
+            muestra['error'] = lectura
+        await self._entrega(muestra)
+    
+    async def _ciclo(self, instante, saltados):
+        tareas = []
+        for num_estacion, dir_socket in self.estaciones.items():
+            for modo in self.modos:
+                tareas.append(self._lee(instante, num_estacion, dir_socket, modo, saltados))
+        resultados = await asyncio.gather(*tareas, return_exceptions=True)
+        for resultado in resultados:
+            if isinstance(resultado, Exception):
+                print('Error en la adquisición.\n %s' %(resultado))
+    
+    async def ejecuta(self, ciclos=None):
+        """
+        Info
+        ----------
+        Realiza el muestreo en el bucle de eventos actual hasta que se llama a detiene()
+        o se completan los ciclos indicados.
+
+        Parameters
+        ----------
+        ciclos : int, opcional
+            Número de muestras. Por defecto no hay límite.
+
+        Returns
+        -------
+        None.
+
+        """
+        
+        # detiene() usa _parada en cuanto ve _loop, por lo que _loop se asigna al final
+        self._parada = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        # Solo se cierran al terminar las conexiones de las estaciones de esta adquisición, no las de otros
+        # usuarios del mismo bucle de eventos
+        direcciones = {(Estaciones.get(num_estacion) if dir_socket is None else dir_socket, PORT)
+                       for num_estacion, dir_socket in self.estaciones.items()}
+        
+        try:
+            instante = self._siguiente(time.time())
+            saltados = 0
+            realizados = 0
+            while (ciclos is None) or (realizados < ciclos):
+                # Se espera hasta el instante de muestreo, salvo que se detenga la adquisición
+                try:
+                    await asyncio.wait_for(self._parada.wait(), max(0, instante - time.time()))
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                
+                await self._ciclo(instante, saltados)
+                realizados += 1
+                
+                # Los instantes que ya han pasado durante el ciclo se omiten
+                siguiente = self._siguiente(time.time())
+                saltados = max(0, int(round((siguiente - instante) / self.periodo)) - 1)
+                if saltados > 0:
+                    print('Ciclo de adquisición sobrepasado, se omiten ' + str(saltados) + ' muestras.\n')
+                instante = siguiente
+        finally:
+            await cierra_sesiones_async(direcciones)
+    
+    def inicia(self, ciclos=None):
+        """
+        Inicia el muestreo en un hilo aparte, con su propio bucle de eventos. Ver ejecuta().
+        """
+        
+        if (self._hilo is not None) and self._hilo.is_alive():
+            raise RuntimeError('La adquisición ya está en marcha')
+        self._loop = None
+        self._parada = None
+        self._hilo = threading.Thread(target=asyncio.run, args=(self.ejecuta(ciclos),),
+                                      name='Adquisicion', daemon=True)
+        self._hilo.start()
+    
+    def detiene(self, espera=True):
+        """
+        Detiene el muestreo tras el ciclo en curso.
+
+        Parameters
+        ----------
+        espera : bool, opcional
+            Si es True, se espera a que termine el hilo iniciado con inicia(). Por defecto es True.
+        """
+        
+        # El hilo puede no haber creado todavía su bucle de eventos
+        while (self._hilo is not None) and self._hilo.is_alive() and (self._loop is None):
+            time.sleep(0.01)
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._parada.set)
+            except RuntimeError:
+                # El bucle de eventos ya ha terminado
+                pass
+        if espera and (self._hilo is not None) and (self._hilo is not threading.current_thread()):
+            self._hilo.join()
+
+
 def sincroniza_hora(num_estacion, hora, modo_comm='socket', dir_socket=None, dir_serie=None):
     """
     Info
@@ -695,7 +1575,7 @@ def sincroniza_hora(num_estacion, hora, modo_comm='socket', dir_socket=None, dir
             
             
             #Una vez hechas las comprbaciones, comienza la comunicación
-            lectura = _serial(dir_serie,trama)
+            lectura = _serial(dir_serie, trama, 13)
             
             #Lectura errónea
             if lectura == -1:
@@ -716,4 +1596,27 @@ def sincroniza_hora(num_estacion, hora, modo_comm='socket', dir_socket=None, dir
     else:   
         print("Error en la comunicacion con la estación.\n")
         print(estado_recepcion)
-        return False
\ No newline at end of file
+        return False
+
+def cierra_sesiones():
+    """
+    Info
+    ----------
+    Cierra las conexiones abiertas con las estaciones. Las siguientes lecturas vuelven a conectar.
+    Se llama automáticamente al terminar el programa.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    with _sesiones_lock:
+        sesiones = list(_sesiones.values())
+        _sesiones.clear()
+    
+    for sesion in sesiones:
+        sesion.cierra()
+
+
+atexit.register(cierra_sesiones)
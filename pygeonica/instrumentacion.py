@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Medida del tiempo, las filas y la memoria de cada etapa de la lectura y exportación de datos de bbdd.
+
+Uso:
+    with instrumentacion.Colector(memoria=True) as colector:
+        bbdd.genera_fichero_meteo('2020-10-01', '2020-10-31')
+    print(colector.resumen())
+    colector.exporta_json('etapas.json')
+
+También se pueden registrar funciones que reciben cada medida según se produce, con registra().
+Mientras no hay ningún colector ni función registrada, las etapas no miden nada.
+
+@author: Martin
+"""
+
+import os
+import csv
+import json
+import time
+import threading
+import tracemalloc
+
+# Campos de cada medida, en el orden en que se exportan
+CAMPOS = ['etapa', 'estacion', 'dia', 'inicio', 'duracion', 'filas_entrada', 'filas_salida', 'memoria',
+          'hilo', 'proceso', 'error']
+
+_funciones = []         # Funciones registradas, que reciben cada medida
+_funciones_lock = threading.Lock()
+_activo = False         # True si hay alguna función registrada
+
+_etapas_memoria = set() # Etapas en curso que miden la memoria
+_memoria_lock = threading.Lock()
+
+
+class _EtapaNula:
+    """
+    Etapa que no mide nada, utilizada mientras la instrumentación está desactivada.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        return False
+
+    def __setattr__(self, nombre, valor):
+        pass
+
+
+_ETAPA_NULA = _EtapaNula()
+
+
+class _Etapa:
+    """
+    Medida de una etapa. Dentro del bloque with se pueden indicar las filas de salida
+    (atributo filas_salida) o cualquier otro dato de la medida.
+    """
+
+    def __init__(self, nombre, datos):
+        self.etapa = nombre
+        self.estacion = None
+        self.dia = None
+        self.filas_entrada = None
+        self.filas_salida = None
+        self.__dict__.update(datos)
+
+    def __enter__(self):
+        self._memoria = None
+        # tracemalloc.reset_peak() existe desde Python 3.9; en versiones anteriores no se mide la memoria
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            with _memoria_lock:
+                actual, pico = tracemalloc.get_traced_memory()
+                # El pico de tracemalloc es único para todo el proceso: antes de reiniciarlo para medir esta
+                # etapa, se guarda en las etapas en curso (p.ej. la que contiene a esta)
+                for etapa in _etapas_memoria:
+                    etapa._pico = max(etapa._pico, pico)
+                tracemalloc.reset_peak()
+                self._memoria = actual
+                self._pico = actual
+                _etapas_memoria.add(self)
+        self.inicio = time.time()
+        self._t = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        duracion = time.perf_counter() - self._t
+
+        medida = {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+        medida['duracion'] = duracion
+        medida['memoria'] = None
+        if self._memoria is not None:
+            with _memoria_lock:
+                _etapas_memoria.discard(self)
+                if tracemalloc.is_tracing():
+                    medida['memoria'] = max(self._pico, tracemalloc.get_traced_memory()[1]) - self._memoria
+        medida['hilo'] = threading.current_thread().name
+        medida['proceso'] = os.getpid()
+        medida['error'] = None if tipo is None else tipo.__name__
+        if medida['dia'] is not None:
+            medida['dia'] = str(medida['dia'])
+
+        _notifica(medida)
+        return False
+
+
+def _notifica(medida):
+    with _funciones_lock:
+        funciones = list(_funciones)
+    for funcion in funciones:
+        try:
+            funcion(medida)
+        except Exception as error:
+            # Un error en la instrumentación no debe interrumpir la lectura de datos
+            print('Error en la función de instrumentación ' + repr(funcion) + ': ' + repr(error))
+
+
+def etapa(nombre, **datos):
+    """
+    Info
+    ----------
+    Gestor de contexto que mide el tiempo (y la memoria, si está activo tracemalloc) de una etapa.
+    La memoria es el pico de memoria reservada durante la etapa por encima de la reservada al empezar,
+    incluida la reservada por otros hilos mientras tanto.
+    Si la instrumentación está desactivada, devuelve una etapa que no mide nada, con un coste despreciable.
+
+    Parameters
+    ----------
+    nombre : str
+        Nombre de la etapa.
+    **datos :
+        Datos de la medida, p.ej. estacion, dia o filas_entrada.
+
+    Returns
+    -------
+    Gestor de contexto, cuyo valor permite indicar datos que se conocen al terminar, p.ej. filas_salida.
+
+    """
+
+    if not _activo:
+        return _ETAPA_NULA
+    return _Etapa(nombre, datos)
+
+
+def registra(funcion):
+    """
+    Registra una función que recibirá cada medida (un diccionario con los campos de CAMPOS).
+    Puede llamarse desde varios hilos a la vez.
+    """
+
+    global _activo
+    with _funciones_lock:
+        _funciones.append(funcion)
+        _activo = True
+
+
+def elimina(funcion):
+    """
+    Elimina una función registrada con registra().
+    """
+
+    global _activo
+    with _funciones_lock:
+        if funcion in _funciones:
+            _funciones.remove(funcion)
+        _activo = len(_funciones) != 0
+
+
+class Colector:
+    """
+    Info
+    ----------
+    Gestor de contexto que guarda las medidas de las etapas que se ejecutan dentro del bloque with,
+    en cualquier hilo del proceso. Las etapas ejecutadas en otros procesos (genera_fichero_meteo()
+    con workers) no se registran.
+
+    Parameters
+    ----------
+    memoria : bool, opcional
+        Si es True, se activa tracemalloc durante el bloque para medir la memoria de cada etapa: el pico de
+        memoria reservada durante la etapa por encima de la reservada al empezar. Ralentiza la ejecución.
+        Por defecto es False.
+
+    """
+
+    def __init__(self, memoria=False):
+        self.memoria = memoria
+        self.medidas = []
+        self._lock = threading.Lock()
+        self._tracemalloc = False
+
+    def __call__(self, medida):
+        with self._lock:
+            self.medidas.append(medida)
+
+    def __enter__(self):
+        if self.memoria and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracemalloc = True
+        registra(self)
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        elimina(self)
+        if self._tracemalloc:
+            tracemalloc.stop()
+            self._tracemalloc = False
+        return False
+
+    def tabla(self):
+        """
+        Devuelve las medidas en un pandas.DataFrame, una fila por medida.
+        """
+
+        import pandas as pd
+
+        with self._lock:
+            medidas = list(self.medidas)
+        return pd.DataFrame(medidas, columns=CAMPOS)
+
+    def resumen(self, por=('etapa',)):
+        """
+        Info
+        ----------
+        Resumen de las medidas agrupadas por etapa (o por los campos indicados, p.ej. ('etapa', 'estacion')).
+
+        Returns
+        -------
+        pandas.DataFrame
+            Número de medidas, tiempo total y medio (s), filas de entrada y salida y memoria (mayor pico
+            de las medidas, en bytes) de cada grupo, ordenado por tiempo total.
+
+        """
+
+        tabla = self.tabla()
+        por = list(por)
+        if len(tabla) == 0:
+            return tabla
+        for campo in ['filas_entrada', 'filas_salida', 'memoria']:
+            tabla[campo] = tabla[campo].astype(float)
+        resumen = tabla.groupby(por, dropna=False).agg(
+                medidas=('duracion', 'size'),
+                tiempo=('duracion', 'sum'),
+                tiempo_medio=('duracion', 'mean'),
+                filas_entrada=('filas_entrada', 'sum'),
+                filas_salida=('filas_salida', 'sum'),
+                memoria=('memoria', 'max'),
+        )
+        return resumen.sort_values('tiempo', ascending=False)
+
+    def exporta_json(self, path):
+        """
+        Guarda las medidas en un fichero JSON, como una lista de diccionarios.
+        """
+
+        with self._lock:
+            medidas = list(self.medidas)
+        with open(path, 'w') as f:
+            json.dump(medidas, f, indent=1, default=str)
+
+    def exporta_csv(self, path):
+        """
+        Guarda las medidas en un fichero CSV, una fila por medida con las columnas de CAMPOS.
+        """
+
+        with self._lock:
+            medidas = list(self.medidas)
+        with open(path, 'w', newline='') as f:
+            escritor = csv.DictWriter(f, fieldnames=CAMPOS, extrasaction='ignore')
+            escritor.writeheader()
+            escritor.writerows(medidas)
@@ -0,0 +1,534 @@
+# -*- coding: utf-8 -*-
+"""
+Copia local, en SQLite, de los datos de la base de datos de Geonica.
+
+La réplica contiene la tabla Datos y las tablas de metadatos con los mismos nombres y columnas que en
+el servidor, de forma que todas las funciones de bbdd pueden leer de ella en lugar del servidor:
+    r = replica.Replica('geonica.db')
+    r.sincroniza()
+    bbdd.configura_origen(replica='geonica.db')
+
+Además mantiene los agregados horarios y diarios de cada canal, que se consultan con get_aggregates():
+    r.get_aggregates(316, '2020-01-01', '2021-01-01', freq='D')
+
+@author: Martin
+"""
+
+import datetime as dt
+import decimal
+import sqlite3
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+from . import bbdd, cache
+
+# Formato con el que se guardan las fechas en la base de datos local, que permite compararlas como texto
+FORMATO_FECHA = '%Y-%m-%d %H:%M:%S'
+
+# Periodo que se lee en la primera sincronización de una estación, si no se indica el inicio
+PERIODO_INICIAL = pd.Timedelta(days=1)
+
+# Periodo anterior a la marca de cada estación que se vuelve a leer en cada sincronización, ya que las
+# estaciones pueden tardar en descargar sus datos a la base de datos (igual que cache.MARGEN_DIAS)
+MARGEN = pd.Timedelta(days=cache.MARGEN_DIAS)
+
+# Frecuencias de los agregados: duración del periodo y longitud del prefijo de la fecha (texto) que lo identifica
+FRECUENCIAS = {'H': (pd.Timedelta(hours=1), len('AAAA-MM-DD HH')),
+               'D': (pd.Timedelta(days=1), len('AAAA-MM-DD'))}
+
+# Columnas de los agregados, en el orden en que se devuelven
+COLUMNAS_AGREGADOS = ['NumEstacion', 'Fecha', 'NumParametro', 'NumFuncion', 'Media', 'Minimo', 'Maximo', 'Suma', 'Cuenta']
+
+# Tablas de metadatos que utiliza bbdd, que se copian completas en cada sincronización
+TABLAS_METADATOS = ['Parametros_spanish', 'Canales', 'Funciones', 'Funciones_MI']
+
+_ESQUEMA = '''
+CREATE TABLE IF NOT EXISTS Datos (
+    NumEstacion INTEGER NOT NULL,
+    Fecha TEXT NOT NULL,
+    NumParametro INTEGER NOT NULL,
+    NumFuncion INTEGER NOT NULL,
+    Valor REAL,
+    PRIMARY KEY (NumEstacion, Fecha, NumParametro, NumFuncion)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS Marcas (
+    NumEstacion INTEGER PRIMARY KEY,
+    Fecha TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Inicios (
+    NumEstacion INTEGER PRIMARY KEY,
+    Fecha TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Agregados (
+    Frecuencia TEXT NOT NULL,
+    NumEstacion INTEGER NOT NULL,
+    NumParametro INTEGER NOT NULL,
+    NumFuncion INTEGER NOT NULL,
+    Fecha TEXT NOT NULL,
+    Media REAL,
+    Minimo REAL,
+    Maximo REAL,
+    Suma REAL,
+    Cuenta INTEGER NOT NULL,
+    PRIMARY KEY (Frecuencia, NumEstacion, Fecha, NumParametro, NumFuncion)
+) WITHOUT ROWID;
+'''
+
+# Recalcula los agregados de una frecuencia, estación y periodo a partir de la tabla Datos local
+_ACTUALIZA_AGREGADOS = '''
+INSERT OR REPLACE INTO Agregados
+SELECT :frecuencia, NumEstacion, NumParametro, NumFuncion, substr(Fecha, 1, :n) || substr('0000-00-00 00:00:00', :n + 1),
+       AVG(Valor), MIN(Valor), MAX(Valor), SUM(Valor), COUNT(Valor)
+FROM Datos
+WHERE NumEstacion = :estacion AND Fecha >= :ini AND Fecha < :fin
+GROUP BY NumEstacion, NumParametro, NumFuncion, substr(Fecha, 1, :n)
+'''
+
+
+def _parametros_sqlite(parametros):
+    # Las fechas de las consultas de bbdd se pasan a SQLite como texto, igual que el adaptador por defecto
+    # de sqlite3 (obsoleto desde Python 3.12), que se puede comparar con las fechas guardadas
+    def convierte(valor):
+        return valor.isoformat(' ') if isinstance(valor, dt.datetime) else valor
+    if isinstance(parametros, dict):
+        return {clave: convierte(valor) for clave, valor in parametros.items()}
+    return [convierte(valor) for valor in parametros]
+
+
+class _Cursor(sqlite3.Cursor):
+    """
+    Cursor de las conexiones de conecta(), que convierte las fechas de los parámetros de las consultas.
+    Se hace en las conexiones de la réplica y no con sqlite3.register_adapter(), que cambiaría cómo
+    se pasan las fechas a SQLite en todo el proceso.
+    """
+
+    def execute(self, sql, parametros=()):
+        return super().execute(sql, _parametros_sqlite(parametros))
+
+    def executemany(self, sql, filas):
+        return super().executemany(sql, (_parametros_sqlite(fila) for fila in filas))
+
+
+class _Conexion(sqlite3.Connection):
+    """
+    Conexión de conecta(), cuyos cursores son _Cursor.
+    """
+
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, filas):
+        return self.cursor().executemany(sql, filas)
+
+
+def conecta(path):
+    """
+    Info
+    ----------
+    Abre una conexión de solo lectura con la réplica, que puede utilizarse desde varios hilos.
+    Es la función de conexión del pool de bbdd cuando se lee de la réplica, ver bbdd.configura_origen().
+
+    Parameters
+    ----------
+    path : str
+        Fichero de la réplica.
+
+    Returns
+    -------
+    sqlite3.Connection
+
+    """
+
+    path = Path(path)
+    if not path.is_file():
+        raise FileNotFoundError('No existe la réplica ' + str(path))
+    return sqlite3.connect(path.resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False,
+                           factory=_Conexion)
+
+
+def _valor_sqlite(valor):
+    # Convierte los valores devueltos por el driver del servidor en tipos que admite SQLite
+    if (valor is None) or isinstance(valor, (int, float, str, bytes)):
+        return valor
+    if isinstance(valor, decimal.Decimal):
+        return float(valor)
+    if isinstance(valor, dt.datetime):
+        return valor.strftime(FORMATO_FECHA)
+    if isinstance(valor, dt.date):
+        return valor.isoformat()
+    return str(valor)
+
+
+class Replica:
+    """
+    Info
+    ----------
+    Copia local de la tabla Datos y de las tablas de metadatos en una base de datos SQLite, que se
+    actualiza de forma incremental. Por cada estación se guarda la última Fecha recibida (marca), de forma
+    que cada sincronización solo solicita al servidor las filas posteriores (y las de un margen anterior,
+    ver MARGEN) y su coste depende de los datos nuevos, no del periodo.
+
+    La base de datos local se abre en modo WAL, de forma que se puede leer (p.ej. con
+    bbdd.configura_origen()) mientras se sincroniza.
+
+    Parameters
+    ----------
+    path : str
+        Fichero de la base de datos local. Se crea si no existe.
+    fabrica : function, opcional
+        Función sin argumentos que devuelve una nueva conexión con el servidor.
+        Por defecto se conecta mediante pyodbc al servidor del fichero de configuración.
+
+    """
+
+    def __init__(self, path, fabrica=None):
+        self.path = str(path)
+        self._conexion = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # Pool propio, para leer siempre del servidor aunque bbdd lea de la réplica
+        self._pool = bbdd._PoolConexiones(fabrica=bbdd._conecta_servidor if fabrica is None else fabrica)
+
+        with self._lock, self._conexion:
+            self._conexion.execute('PRAGMA journal_mode=WAL')
+            self._conexion.executescript(_ESQUEMA)
+            sin_agregados = self._conexion.execute(
+                    'SELECT EXISTS (SELECT 1 FROM Datos) AND NOT EXISTS (SELECT 1 FROM Agregados)').fetchone()[0]
+
+        # Réplicas creadas antes de que se mantuvieran los agregados
+        if sin_agregados:
+            self.reconstruye_agregados()
+
+    def cierra(self):
+        """
+        Cierra la base de datos local y las conexiones con el servidor.
+        """
+
+        self._pool.cierra()
+        with self._lock:
+            self._conexion.close()
+
+    def marcas(self):
+        """
+        Devuelve la última Fecha (UTC) sincronizada de cada estación.
+
+        Returns
+        -------
+        dict
+            Diccionario cuya clave es el número de la estación y su valor un pandas.Timestamp.
+        """
+
+        with self._lock:
+            filas = self._conexion.execute('SELECT NumEstacion, Fecha FROM Marcas').fetchall()
+
+        return {estacion: pd.Timestamp(fecha) for estacion, fecha in filas}
+
+    def sincroniza(self, estaciones=None, desde=None, chunk=bbdd.CHUNK_DATOS, metadatos=True, margen=MARGEN):
+        """
+        Info
+        ----------
+        Solicita al servidor, en una única consulta, las filas de la tabla Datos posteriores a la marca
+        de cada estación menos el margen, y por cada bloque leído añade a la base de datos local las filas
+        que no tiene, recalcula los agregados de los días del bloque y actualiza las marcas. Así no se
+        guarda en memoria más que un bloque, y las filas que las estaciones descargan con retraso, con
+        una Fecha anterior a la marca, se reciben en las siguientes sincronizaciones mientras estén dentro
+        del margen. Antes se copian las tablas de metadatos, ver sincroniza_metadatos().
+
+        Parameters
+        ----------
+        estaciones : int o list de int, opcional
+            Estaciones a sincronizar. Por defecto son las 'Estaciones Operativas' del fichero de configuración.
+        desde : str o datetime-like, opcional
+            Fecha (UTC) a partir de la cual se leen los datos de las estaciones que todavía no tienen marca.
+            Por defecto es PERIODO_INICIAL antes de la hora actual.
+        chunk : int, opcional
+            Número de filas de cada bloque leído del servidor.
+        metadatos : bool, opcional
+            Si es False, no se copian las tablas de metadatos. Por defecto es True.
+        margen : pandas.Timedelta, opcional
+            Periodo anterior a la marca que se vuelve a leer. Por defecto es MARGEN.
+
+        Returns
+        -------
+        nuevas : dict
+            Número de filas nuevas de cada estación, cuya clave es el número de la estación.
+
+        """
+
+        if metadatos:
+            self.sincroniza_metadatos()
+
+        if estaciones is None:
+            estaciones = bbdd.lee_config('Estaciones Operativas', bbdd.PATH_CONFIG_PYGEONICA)
+        elif not isinstance(estaciones, (list, tuple)):
+            estaciones = [estaciones]
+
+        if desde is None:
+            desde = pd.Timestamp.now(tz='UTC').tz_localize(None) - PERIODO_INICIAL
+
+        marcas = self.marcas()
+
+        condiciones = []
+        parametros = []
+        for estacion in estaciones:
+            condiciones.append('(NumEstacion = ? AND Fecha > ?)')
+            inicio = (marcas[estacion] - margen) if estacion in marcas else desde
+            parametros += [int(estacion), bbdd._fecha_sql(inicio)]
+
+        query_data = (
+                'SELECT ' + ', '.join(bbdd.COLUMNAS_DATOS) + ' FROM Datos '
+                'WHERE ' + ' OR '.join(condiciones) + ' '
+                'ORDER BY Fecha'
+        )
+
+        # Cada bloque se guarda con sus agregados y sus marcas en una transacción. Como los bloques llegan
+        # ordenados por fecha, una sincronización interrumpida no deja filas sin su marca ni marcas sin sus filas
+        inicios = {int(estacion): desde for estacion in estaciones if estacion not in marcas}
+        nuevas = {int(estacion): 0 for estacion in estaciones}
+        for bloque in bbdd._iter_consulta(query_data, parametros, chunk, pool=self._pool):
+            if len(bloque) != 0:
+                for estacion, n in self._inserta(bloque, inicios).items():
+                    nuevas[estacion] += n
+
+        return nuevas
+
+    def sincroniza_metadatos(self, tablas=TABLAS_METADATOS):
+        """
+        Info
+        ----------
+        Copia completas las tablas de metadatos del servidor, que son pequeñas, sustituyendo las de la
+        base de datos local en una única transacción.
+
+        Parameters
+        ----------
+        tablas : list of str, opcional
+            Tablas que se copian. Por defecto son TABLAS_METADATOS.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        copias = {}
+        with self._pool.conexion() as conexion:
+            cursor = conexion.cursor()
+            for tabla in tablas:
+                cursor.execute('SELECT * FROM ' + tabla)
+                columnas = [columna[0] for columna in cursor.description]
+                filas = [tuple(_valor_sqlite(valor) for valor in fila) for fila in cursor.fetchall()]
+                copias[tabla] = (columnas, filas)
+            cursor.close()
+
+        with self._lock, self._conexion:
+            # sqlite3 no abre la transacción antes de DROP y CREATE, por lo que se abre explícitamente
+            self._conexion.execute('BEGIN')
+            for tabla, (columnas, filas) in copias.items():
+                self._conexion.execute('DROP TABLE IF EXISTS ' + tabla)
+                self._conexion.execute('CREATE TABLE ' + tabla + ' (' + ', '.join('"' + c + '"' for c in columnas) + ')')
+                self._conexion.executemany('INSERT INTO ' + tabla + ' VALUES (' + ', '.join(['?'] * len(columnas)) + ')',
+                                           filas)
+
+    def _inserta(self, data, inicios={}):
+        # Añade a la tabla Datos local las filas que no tiene (la clave primaria descarta las ya guardadas),
+        # recalcula los agregados de los días que contienen y actualiza las marcas de sus estaciones.
+        # inicios tiene la fecha a partir de la cual se han leído las estaciones que se sincronizan por
+        # primera vez. Devuelve el número de filas nuevas de cada estación
+        estaciones = data['NumEstacion'].astype(int)
+        fechas = data['Fecha'].dt.strftime(FORMATO_FECHA)
+        limites = data['Fecha'].groupby(estaciones).agg(['min', 'max'])
+        nuevas = {}
+
+        with self._lock, self._conexion:
+            for estacion, filas in data.groupby(estaciones, sort=False).groups.items():
+                cambios = self._conexion.total_changes
+                self._conexion.executemany(
+                        'INSERT OR IGNORE INTO Datos VALUES (?, ?, ?, ?, ?)',
+                        zip(estaciones[filas].tolist(), fechas[filas].tolist(),
+                            data.loc[filas, 'NumParametro'].astype(int).tolist(),
+                            data.loc[filas, 'NumFuncion'].astype(int).tolist(),
+                            data.loc[filas, 'Valor'].astype(float).tolist()))
+                nuevas[int(estacion)] = self._conexion.total_changes - cambios
+            for estacion, (primera, ultima) in limites.iterrows():
+                # Se recalculan completos los días con filas nuevas, que contienen sus horas
+                self._actualiza_agregados(estacion, primera.floor('D'), ultima.floor('D') + pd.Timedelta(days=1))
+            self._conexion.executemany(
+                    'INSERT OR IGNORE INTO Inicios VALUES (?, ?)',
+                    [(int(estacion), pd.Timestamp(inicios[estacion]).strftime(FORMATO_FECHA))
+                     for estacion in limites.index if estacion in inicios])
+            self._conexion.executemany(
+                    'INSERT INTO Marcas VALUES (?, ?) '
+                    'ON CONFLICT(NumEstacion) DO UPDATE SET Fecha = MAX(Fecha, excluded.Fecha)',
+                    [(int(estacion), ultima.strftime(FORMATO_FECHA)) for estacion, ultima in limites['max'].items()])
+
+        return nuevas
+
+    def _actualiza_agregados(self, estacion, ini, fin):
+        # Recalcula los agregados de todas las frecuencias de la estación entre ini y fin, que deben ser
+        # inicios de periodo. Se llama con el lock tomado y dentro de una transacción
+        for frecuencia, (_, n) in FRECUENCIAS.items():
+            self._conexion.execute(_ACTUALIZA_AGREGADOS, {
+                    'frecuencia': frecuencia, 'n': n, 'estacion': int(estacion),
+                    'ini': ini.strftime(FORMATO_FECHA), 'fin': fin.strftime(FORMATO_FECHA)})
+
+    def reconstruye_agregados(self):
+        """
+        Recalcula todos los agregados a partir de la tabla Datos local.
+        """
+
+        with self._lock, self._conexion:
+            limites = self._conexion.execute(
+                    'SELECT NumEstacion, MIN(Fecha), MAX(Fecha) FROM Datos GROUP BY NumEstacion').fetchall()
+            self._conexion.execute('DELETE FROM Agregados')
+            for estacion, primera, ultima in limites:
+                self._actualiza_agregados(estacion, pd.Timestamp(primera).floor('D'),
+                                          pd.Timestamp(ultima).floor('D') + pd.Timedelta(days=1))
+
+    def _completos(self, estacion, duracion):
+        # Periodo [ini, fin) de los agregados completos de la estación en la réplica: desde el primer periodo
+        # posterior al inicio de la sincronización hasta el último cuyo minuto final ya se ha recibido
+        with self._lock:
+            marca = self._conexion.execute('SELECT Fecha FROM Marcas WHERE NumEstacion = ?', (estacion,)).fetchone()
+            inicio = self._conexion.execute('SELECT Fecha FROM Inicios WHERE NumEstacion = ?', (estacion,)).fetchone()
+            if inicio is None:
+                # Réplicas creadas antes de que se guardara el inicio: se toma el primer dato
+                inicio = self._conexion.execute('SELECT MIN(Fecha) FROM Datos WHERE NumEstacion = ?',
+                                                (estacion,)).fetchone()
+        if marca is None:
+            return None, None
+
+        ini = pd.Timestamp(inicio[0]).floor(duracion) + duracion
+        fin = (pd.Timestamp(marca[0]) + pd.Timedelta(minutes=1)).floor(duracion)
+        if fin <= ini:
+            return None, None
+        return ini, fin
+
+    def _agregados_bd(self, estacion, freq, ini, fin):
+        # Calcula los agregados a partir de los datos en bruto del servidor, con el mismo resultado que en SQLite
+        duracion = FRECUENCIAS[freq][0]
+        sql, params = bbdd._query_datos(estacion, ini, fin, columnas=bbdd.COLUMNAS_DATOS)
+        bloques = [bloque for bloque in bbdd._iter_consulta(sql, params, pool=self._pool) if len(bloque) != 0]
+        if len(bloques) == 0:
+            return pd.DataFrame(columns=COLUMNAS_AGREGADOS)
+
+        data = pd.concat(bloques, ignore_index=True)
+        data['Fecha'] = data['Fecha'].dt.floor(duracion)
+        valor = data.groupby(['NumEstacion', 'Fecha', 'NumParametro', 'NumFuncion'])['Valor']
+        agregados = pd.DataFrame({'Media': valor.mean(), 'Minimo': valor.min(), 'Maximo': valor.max(),
+                                  'Suma': valor.sum(min_count=1), 'Cuenta': valor.count()})
+        return agregados.reset_index()[COLUMNAS_AGREGADOS]
+
+    def get_aggregates(self, numero_estacion, fecha_ini, fecha_fin, freq='H'):
+        """
+        Info
+        ----------
+        Devuelve la media, el mínimo, el máximo, la suma y el número de valores de cada canal (NumParametro
+        y NumFuncion) por hora o por día (UTC). Los periodos completos en la réplica se leen de los agregados
+        ya calculados; los demás (anteriores al inicio de la réplica o posteriores a su última
+        sincronización) se calculan a partir de los datos en bruto del servidor.
+
+        Parameters
+        ----------
+        numero_estacion : int o list de int
+            Número identificativo de la estación o lista de estaciones.
+        fecha_ini : str o datetime-like
+            Fecha (UTC) de inicio. Se incluye el periodo (hora o día) que la contiene.
+        fecha_fin : str o datetime-like
+            Fecha (UTC) final, excluida. Se incluyen completos los periodos que empiezan antes.
+        freq : str, opcional
+            'H' para agregados horarios o 'D' para diarios. Por defecto es 'H'.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Una fila por estación, periodo y canal con las columnas de COLUMNAS_AGREGADOS,
+            siendo Fecha el inicio del periodo.
+
+        """
+
+        freq = freq.upper()
+        if freq not in FRECUENCIAS:
+            raise ValueError('freq debe ser una de ' + ', '.join(FRECUENCIAS) + ': ' + repr(freq))
+        if not isinstance(numero_estacion, (list, tuple)):
+            numero_estacion = [numero_estacion]
+        duracion = FRECUENCIAS[freq][0]
+
+        ini = pd.Timestamp(fecha_ini).floor(duracion)
+        fin = pd.Timestamp(fecha_fin).ceil(duracion)
+        partes = []
+        for estacion in numero_estacion:
+            estacion = int(estacion)
+            ini_completos, fin_completos = self._completos(estacion, duracion)
+            if ini_completos is None:
+                ini_completos = fin_completos = fin
+            ini_completos = min(max(ini_completos, ini), fin)
+            fin_completos = max(min(fin_completos, fin), ini_completos)
+
+            # Periodos sin agregados completos antes y después de los de la réplica
+            if ini < ini_completos:
+                partes.append(self._agregados_bd(estacion, freq, ini, ini_completos))
+            if ini_completos < fin_completos:
+                with self._lock:
+                    data = pd.read_sql(
+                            'SELECT ' + ', '.join(COLUMNAS_AGREGADOS) + ' FROM Agregados '
+                            'WHERE Frecuencia = ? AND NumEstacion = ? AND Fecha >= ? AND Fecha < ? '
+                            'ORDER BY Fecha, NumParametro, NumFuncion',
+                            self._conexion, params=[freq, estacion, ini_completos.strftime(FORMATO_FECHA),
+                                                    fin_completos.strftime(FORMATO_FECHA)])
+                data['Fecha'] = pd.to_datetime(data['Fecha'])
+                partes.append(data)
+            if fin_completos < fin:
+                partes.append(self._agregados_bd(estacion, freq, fin_completos, fin))
+
+        partes = [parte for parte in partes if len(parte) != 0]
+        if len(partes) == 0:
+            return pd.DataFrame(columns=COLUMNAS_AGREGADOS)
+        agregados = pd.concat(partes, ignore_index=True)
+        return agregados.sort_values(['Fecha', 'NumEstacion', 'NumParametro', 'NumFuncion'],
+                                     ignore_index=True)
+
+    def lee(self, numero_estacion, fecha_ini, fecha_fin):
+        """
+        Info
+        ----------
+        Devuelve los datos guardados en la base de datos local, con el mismo formato que bbdd.get_data_raw().
+
+        Parameters
+        ----------
+        numero_estacion : int o list de int
+            Número identificativo de la estación o lista de estaciones.
+        fecha_ini : str o datetime-like
+            Fecha (UTC) de inicio del periodo, incluida.
+        fecha_fin : str o datetime-like
+            Fecha (UTC) final del periodo, excluida.
+
+        Returns
+        -------
+        pandas.DataFrame
+
+        """
+
+        if not isinstance(numero_estacion, (list, tuple)):
+            numero_estacion = [numero_estacion]
+
+        query_data = (
+                'SELECT ' + ', '.join(bbdd.COLUMNAS_DATOS) + ' FROM Datos '
+                'WHERE NumEstacion IN (' + ', '.join(['?'] * len(numero_estacion)) + ') AND '
+                'Fecha >= ? AND Fecha < ? '
+                'ORDER BY Fecha'
+        )
+        parametros = [int(e) for e in numero_estacion] + [pd.Timestamp(fecha_ini).strftime(FORMATO_FECHA),
+                                                         pd.Timestamp(fecha_fin).strftime(FORMATO_FECHA)]
+
+        with self._lock:
+            data = pd.read_sql(query_data, self._conexion, params=parametros)
+
+        data['Fecha'] = pd.to_datetime(data['Fecha'])
+        return data
@@ -18,7 +18,7 @@ setup_args = dict(
         "Programming Language :: Python :: 3",
         "Operating System :: Windows",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     packages=['pygeonica'],
     zip_safe=False,
     package_data={'': ['*.txt','*.yaml']},
@@ -35,6 +35,11 @@ install_requires = [
     'pyserial'
 ]
 
+# Dependencias opcionales: pip install pygeonica[cache]
+extras_require = {
+    'cache': ['pyarrow'],
+}
+
 if __name__ == '__main__':
-    setup(**setup_args, install_requires=install_requires)
+    setup(**setup_args, install_requires=install_requires, extras_require=extras_require)
 
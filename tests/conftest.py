@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Utilidades comunes de las pruebas: una base de datos SQLite con las tablas de Geonica y datos sintéticos,
+que sustituye al servidor SQL mediante bbdd.configura_pool(fabrica=...).
+
+Las pruebas se ejecutan desde la carpeta del repositorio con:
+    python -m pytest tests
+"""
+
+import datetime as dt
+import functools
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pygeonica import bbdd
+
+# Funciones de la tabla Funciones_MI (Ididioma 1034)
+FUNCIONES = {0: 'Ins.', 1: 'Med', 2: 'Acu', 3: 'Int', 4: 'Max', 5: 'Min', 9: 'OR Lógica'}
+
+# Canales de las estaciones de prueba, que deben estar en Tipo_Lectura_Canales del fichero de configuración
+CANALES = {316: [('Temp. Ai 1', 'Med'), ('Celula Top', 'Med'), ('Top - Cal ', 'Ins.'), ('Est.Geo3K', 'OR Lógica')],
+           2169: [('Temp. Ai 2', 'Med'), ('Lluvia', 'Acu'), ('Elev.Sol', 'Ins.')]}
+
+# Periodo de los datos (UTC), que incluye el cambio de hora del 27 de octubre de 2019
+INICIO = dt.datetime(2019, 10, 24)
+DIAS = 5
+
+# Canal de medias sin datos durante más de un día: (estación, canal, desde, hasta), ambos excluidos
+HUECO = (316, 'Temp. Ai 1', dt.datetime(2019, 10, 26, 4, 59), dt.datetime(2019, 10, 27, 12, 0))
+
+# Fracción de minutos sin dato de cada canal, para que se interpolen los valores medios
+FRACCION_HUECOS = 0.01
+
+
+def conecta(path):
+    # Fábrica de conexiones del pool, a nivel de módulo para poder usarse con workers
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+def crea_bbdd(path, inicio=INICIO, dias=DIAS, huecos=(HUECO,)):
+    """
+    Crea una base de datos SQLite con las tablas de Geonica y los datos de CANALES durante los días
+    indicados, un valor por minuto y canal (los de medias, con sus máximos y mínimos), salvo los minutos
+    de FRACCION_HUECOS y de los huecos indicados.
+    """
+
+    numero_funcion = {nombre: numero for numero, nombre in FUNCIONES.items()}
+
+    conexion = sqlite3.connect(path)
+    conexion.executescript('''
+        CREATE TABLE Datos (NumEstacion INTEGER, Fecha TIMESTAMP, NumParametro INTEGER, NumFuncion INTEGER, Valor REAL);
+        CREATE TABLE Parametros_spanish (NumParametro INTEGER, Nombre TEXT, Abreviatura TEXT, Unidad TEXT);
+        CREATE TABLE Canales (NumEstacion INTEGER, Canal INTEGER, NumParametro INTEGER, NumFuncion INTEGER);
+        CREATE TABLE Funciones (NumFuncion INTEGER, Nombre TEXT);
+        CREATE TABLE Funciones_MI (NumFuncion INTEGER, Nombre TEXT, Ididioma INTEGER);
+    ''')
+    for numero, nombre in FUNCIONES.items():
+        conexion.execute('INSERT INTO Funciones VALUES (?, ?)', (numero, nombre))
+        conexion.execute('INSERT INTO Funciones_MI VALUES (?, ?, 1034)', (numero, nombre))
+
+    parametros = {}
+    filas = []
+    rng = np.random.default_rng(0)
+    minutos = np.arange(dias * 24 * 60)
+    fechas = np.datetime64(inicio, 'm') + minutos
+    texto = np.char.replace(np.datetime_as_string(fechas, unit='s'), 'T', ' ')
+    for estacion, canales in CANALES.items():
+        for canal, (abreviatura, tipo) in enumerate(canales, start=1):
+            if abreviatura not in parametros:
+                parametros[abreviatura] = len(parametros) + 1
+                conexion.execute('INSERT INTO Parametros_spanish VALUES (?, ?, ?, ?)',
+                                 (parametros[abreviatura], abreviatura, abreviatura, 'u'))
+            parametro = parametros[abreviatura]
+            funciones = [4, 1, 5] if tipo == 'Med' else [numero_funcion[tipo]]
+
+            presentes = rng.random(len(minutos)) > FRACCION_HUECOS
+            for hueco in huecos:
+                if hueco[:2] == (estacion, abreviatura):
+                    presentes &= (fechas <= np.datetime64(hueco[2])) | (fechas >= np.datetime64(hueco[3]))
+            presentes = np.nonzero(presentes)[0]
+
+            base = 100 * np.sin(minutos / 300.0 + parametro) + 10 * parametro
+            for funcion in funciones:
+                conexion.execute('INSERT INTO Canales VALUES (?, ?, ?, ?)', (estacion, canal, parametro, funcion))
+                valores = base + (funcion - 1) * 3 + rng.normal(0, 1, len(minutos))
+                filas += zip([estacion] * len(presentes), texto[presentes].tolist(), [parametro] * len(presentes),
+                             [funcion] * len(presentes), valores[presentes].tolist())
+
+    conexion.executemany('INSERT INTO Datos VALUES (?, ?, ?, ?, ?)', filas)
+    conexion.execute('CREATE INDEX ix_datos ON Datos (NumEstacion, Fecha)')
+    conexion.commit()
+    conexion.close()
+
+
+@pytest.fixture(scope='session')
+def path_bbdd(tmp_path_factory):
+    """
+    Fichero de la base de datos sintética, común a todas las pruebas, que no deben modificarlo.
+    """
+
+    path = str(tmp_path_factory.mktemp('bbdd') / 'geonica.db')
+    crea_bbdd(path)
+    return path
+
+
+@pytest.fixture
+def servidor(path_bbdd):
+    """
+    Configura bbdd para leer de la base de datos sintética, y restablece la configuración al terminar.
+    """
+
+    bbdd.configura_pool(fabrica=functools.partial(conecta, path_bbdd))
+    bbdd.invalida_cache_metadatos()
+    yield path_bbdd
+    bbdd.configura_pool()
+    bbdd.invalida_cache_metadatos()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del ajuste vectorizado de los canales de medias y de la conversión a hora civil,
+frente a las operaciones de pandas a las que sustituyen.
+"""
+
+import numpy as np
+import pandas as pd
+import pytz
+import pytest
+
+from pygeonica import bbdd
+
+
+def _realinea_pandas(columna):
+    # Ajuste original de lee_dia_geonica_ddbb(), canal a canal
+    return columna.resample('30S').interpolate(method='linear').shift(periods=-30, freq='S').reindex(columna.index)
+
+
+@pytest.mark.parametrize('semilla', range(5))
+def test_realinea_medias_igual_que_pandas(semilla):
+    rng = np.random.default_rng(semilla)
+    # Minutos con huecos, también al principio y al final, y canales con valores nulos
+    fechas = pd.date_range('2019-10-26 22:00', periods=600, freq='T')
+    fechas = fechas[rng.random(len(fechas)) > 0.1]
+    valores = rng.normal(0, 10, (len(fechas), 4))
+    valores[rng.random(valores.shape) < 0.2] = np.nan
+    valores[:15, 0] = np.nan
+    valores[-15:, 1] = np.nan
+    valores[:, 2] = np.nan
+    data = pd.DataFrame(valores, index=fechas)
+
+    posiciones = (fechas.values - fechas.values[0]) // np.timedelta64(30, 's')
+    obtenido = bbdd._realinea_medias(data.to_numpy(), posiciones)
+    esperado = data.apply(_realinea_pandas).to_numpy()
+
+    np.testing.assert_allclose(obtenido, esperado, rtol=1e-12, atol=1e-9, equal_nan=True)
+
+
+@pytest.mark.parametrize('inicio', ['2019-03-30', '2019-10-26', '2020-03-28', '2020-10-24'])
+def test_hora_civil_igual_que_pytz(inicio):
+    # Tres días alrededor de cada cambio de hora, con minutos desordenados y repetidos
+    fechas = pd.date_range(inicio, periods=3 * 1440, freq='T')
+    fechas = pd.DatetimeIndex(np.random.default_rng(0).permutation(fechas.values)[:3000], name='Fecha')
+
+    esperado = fechas.tz_localize(pytz.utc).tz_convert(pytz.timezone('Europe/Madrid')).tz_localize(None)
+    obtenido = bbdd._hora_civil(fechas)
+
+    pd.testing.assert_index_equal(obtenido, esperado.rename('Fecha'))
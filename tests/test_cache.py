@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la caché en disco de los datos en bruto (CacheDatos y get_data_raw() con la caché activada).
+"""
+
+import pandas as pd
+import pytest
+
+from pygeonica import bbdd
+from pygeonica.cache import CacheDatos
+
+pytest.importorskip('pyarrow')
+
+
+@pytest.fixture
+def cache_datos(servidor, tmp_path):
+    bbdd.configura_cache_datos(str(tmp_path / 'cache'))
+    yield bbdd._cache_datos
+    bbdd.configura_cache_datos(None)
+
+
+def _ordena(data):
+    return data.sort_values(bbdd.COLUMNAS_DATOS[:4], ignore_index=True)
+
+
+def test_tamano_al_sustituir_un_dia(tmp_path):
+    cache = CacheDatos(str(tmp_path))
+    dia = pd.Timestamp('2019-10-25')
+    data = bbdd._datos_vacios()
+    cache.guarda(316, dia, data)
+    cache.guarda(316, dia, data)
+
+    assert cache._tamano == sum(f.stat().st_size for f in tmp_path.glob('*/*.parquet'))
+
+
+def test_limite_de_tamano(tmp_path):
+    cache = CacheDatos(str(tmp_path))
+    data = pd.DataFrame({'NumEstacion': [316] * 100, 'Fecha': pd.date_range('2019-10-25', periods=100, freq='T'),
+                         'NumParametro': 1, 'NumFuncion': 1, 'Valor': range(100)})
+    cache.guarda(316, pd.Timestamp('2019-10-25'), data)
+    cache.tamano_max = cache._tamano
+    cache.guarda(316, pd.Timestamp('2019-10-25'), data)
+
+    # Sustituir el único día no supera el tamaño máximo, por lo que no se borra
+    assert cache.contiene(316, pd.Timestamp('2019-10-25'))
+    cache.guarda(316, pd.Timestamp('2019-10-26'), data)
+    assert not cache.contiene(316, pd.Timestamp('2019-10-25'))
+
+
+def test_get_data_raw_igual_que_sin_cache(servidor, cache_datos):
+    esperado = _ordena(bbdd.get_data_raw([316, 2169], '2019-10-25 12:00', '2019-10-27 06:00'))
+
+    for _ in range(2):
+        # La primera lectura llena la caché y la segunda lee de ella
+        data = _ordena(bbdd.get_data_raw([316, 2169], '2019-10-25 12:00', '2019-10-27 06:00'))
+        pd.testing.assert_frame_equal(data, esperado)
+    assert cache_datos.contiene(316, pd.Timestamp('2019-10-26'))
+
+
+def test_dias_sin_datos_mantienen_los_tipos(servidor, cache_datos):
+    # Días anteriores a los datos de la base de datos, que se guardan vacíos en la caché
+    for _ in range(2):
+        data = bbdd.get_data_raw(316, '2019-10-01', '2019-10-03')
+        assert len(data) == 0
+        assert data.dtypes.astype(str).to_dict() == bbdd.TIPOS_DATOS
+    assert cache_datos.lee(316, pd.Timestamp('2019-10-01')).dtypes.astype(str).to_dict() == bbdd.TIPOS_DATOS
+
+    bbdd.configura_cache_datos(None)
+    assert bbdd.get_data_raw(316, '2019-10-01', '2019-10-03').dtypes.astype(str).to_dict() == bbdd.TIPOS_DATOS
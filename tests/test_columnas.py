@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la conversión de los datos en bruto a columnas de _ProcesadorEstacion, frente a pivot_table().
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pygeonica import bbdd
+
+
+@pytest.fixture
+def procesador(servidor):
+    return bbdd._ProcesadorEstacion(316)
+
+
+@pytest.fixture
+def data(servidor):
+    canales = bbdd._pares_canales(316)
+    data = bbdd.get_data_raw(316, '2019-10-26 00:00', '2019-10-26 06:00', canales=canales,
+                             columnas=['NumEstacion', 'Fecha', 'NumParametro', 'Valor'])
+    return data.sort_values('Fecha', kind='mergesort', ignore_index=True)
+
+
+def _pivot(data):
+    return data.pivot_table(index='Fecha', columns=['NumParametro'], values='Valor')
+
+
+def _compara(obtenido, esperado):
+    pd.testing.assert_frame_equal(obtenido, esperado, check_names=False, check_column_type=False)
+
+
+def test_igual_que_pivot_table(procesador, data, monkeypatch):
+    data.loc[::7, 'Valor'] = np.nan
+    # Minutos en los que ningún canal tiene valor
+    data.loc[data['Fecha'] == data['Fecha'].iloc[100], 'Valor'] = np.nan
+    esperado = _pivot(data)
+
+    # La conversión directa no utiliza pivot_table()
+    def falla(*args, **kwargs):
+        raise AssertionError('Se ha utilizado pivot_table()')
+    monkeypatch.setattr(pd.DataFrame, 'pivot_table', falla)
+
+    _compara(procesador._a_columnas(data), esperado)
+
+
+@pytest.mark.parametrize('caso', ['desconocido', 'desordenado', 'repetido', 'vacio'])
+def test_casos_con_pivot_table(procesador, data, caso):
+    # Casos que no cumplen las condiciones de la conversión directa, con el mismo resultado que pivot_table()
+    if caso == 'desconocido':
+        data.loc[5, 'NumParametro'] = 999
+    elif caso == 'desordenado':
+        data = data.iloc[::-1].reset_index(drop=True)
+    elif caso == 'repetido':
+        data = pd.concat([data, data.iloc[[10]]]).sort_values('Fecha', kind='mergesort', ignore_index=True)
+    else:
+        data['Valor'] = np.nan
+
+    _compara(procesador._a_columnas(data), _pivot(data))
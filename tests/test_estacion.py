@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la comunicación con la estación, frente a una estación Meteodata simulada en un socket local.
+"""
+
+import asyncio
+import datetime as dt
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from pygeonica import estacion
+
+FECHA = dt.datetime(2020, 10, 25, 12, 30, 15)
+
+
+def trama_datos(numero_estacion, comando, num_canales=24):
+    # Respuesta de 193 bytes a una trama de lectura: cabecera, fecha, medidas y fin de trama
+    trama = bytes([16, 22, 16, 1]) + numero_estacion.to_bytes(2, 'big') + (1).to_bytes(2, 'big')
+    trama += bytes([comando]) + (173).to_bytes(2, 'big') + bytes([num_canales])
+    trama += bytes([FECHA.year - 2000, FECHA.month, FECHA.day, FECHA.hour, FECHA.minute, FECHA.second, 16, 2])
+    trama += b''.join(struct.pack('>f', i + comando / 100) for i in range(num_canales))
+    return trama.ljust(188, b'\x00') + bytes([16, 3, 0, 0, 5])
+
+
+def trama_corta(numero_estacion, fin=4):
+    # Respuesta de 13 bytes de sincronización (EOT) o de error (NAK)
+    return bytes([16, 22, 16, 1]) + numero_estacion.to_bytes(2, 'big') + (1).to_bytes(2, 'big') + bytes([0, 0, 0, fin, 5])
+
+
+class EstacionSimulada:
+    """
+    Servidor TCP que responde a cada trama recibida con trama_datos() o trama_corta(), en varios fragmentos.
+    """
+
+    def __init__(self, partes=1):
+        self.partes = partes
+        self.conexiones = 0
+        self._servidor = socket.socket()
+        self._servidor.bind(('127.0.0.1', 0))
+        self._servidor.listen(8)
+        self.dir_socket = self._servidor.getsockname()
+        threading.Thread(target=self._acepta, daemon=True).start()
+
+    def _acepta(self):
+        while True:
+            try:
+                conexion, _ = self._servidor.accept()
+            except OSError:
+                return
+            self.conexiones += 1
+            threading.Thread(target=self._atiende, args=(conexion,), daemon=True).start()
+
+    def _atiende(self, conexion):
+        with conexion:
+            while True:
+                try:
+                    peticion = conexion.recv(64)
+                except OSError:
+                    return
+                if not peticion:
+                    return
+                numero_estacion, comando = int.from_bytes(peticion[2:4], 'big'), peticion[4]
+                respuesta = trama_corta(numero_estacion) if comando == 0 else trama_datos(numero_estacion, comando)
+                paso = len(respuesta) // self.partes + 1
+                for i in range(0, len(respuesta), paso):
+                    conexion.sendall(respuesta[i:i + paso])
+                    time.sleep(0.005)
+
+    def cierra(self):
+        self._servidor.close()
+
+
+@pytest.fixture
+def estacion_simulada():
+    simulada = EstacionSimulada(partes=3)
+    yield simulada
+    simulada.cierra()
+
+
+def _espera(condicion, plazo=3):
+    limite = time.monotonic() + plazo
+    while not condicion():
+        if time.monotonic() > limite:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_sesion_reutiliza_la_conexion_y_la_cierra_por_inactividad(estacion_simulada):
+    trama = estacion._trama_lectura(316, 1)
+    sesiones = [estacion.SesionEstacion(estacion_simulada.dir_socket, tiempo_inactividad=t) for t in (0.2, 0.6)]
+    for sesion in sesiones:
+        assert sesion.consulta(trama, 193) == trama_datos(316, 1)
+    hilos = threading.active_count()
+
+    for _ in range(20):
+        for sesion in sesiones:
+            assert sesion.consulta(trama, 193) == trama_datos(316, 1)
+    # Una conexión por sesión y un único hilo, ya creado, para vigilar la inactividad de todas
+    assert estacion_simulada.conexiones == 2
+    assert threading.active_count() == hilos
+
+    assert _espera(lambda: sesiones[0]._sock is None)
+    assert sesiones[1]._sock is not None
+    assert _espera(lambda: sesiones[1]._sock is None)
+    # Sin conexiones abiertas termina el hilo de vigilancia, y se vuelve a crear al reconectar
+    assert _espera(lambda: estacion._vigilante is None)
+
+    assert sesiones[0].consulta(trama, 193) == trama_datos(316, 1)
+    assert estacion_simulada.conexiones == 3
+    assert estacion._vigilante is not None
+    for sesion in sesiones:
+        sesion.cierra()
+
+
+def test_trama_completa():
+    datos = trama_datos(316, 1)
+    assert estacion._trama_completa(datos, 193, 193)
+    assert not estacion._trama_completa(datos, 150, 193)
+    assert estacion._trama_completa(trama_corta(316, fin=4), 13, 193)
+    assert estacion._trama_completa(trama_corta(316, fin=21), 13, 193)
+    assert not estacion._trama_completa(trama_corta(316), 12, 193)
+
+    # Una trama de datos con el fin de trama entre sus datos no está completa hasta num_bytes
+    datos = bytearray(datos)
+    datos[96:101] = bytes([16, 3, 0, 0, 5])
+    assert not estacion._trama_completa(datos, 101, 193)
+
+    # Respuesta de error cuyos bytes 9 y 10 no son una longitud
+    error = bytearray(trama_corta(316, fin=21))
+    error[9:11] = bytes([0xFF, 0xF0])
+    assert estacion._trama_completa(error, 13, 193)
+
+    # Respuesta corta con la longitud anunciada en la cabecera
+    corta = bytearray(trama_datos(316, 1)[:20]) + bytes([1, 2, 3, 16, 3, 0, 0, 5])
+    corta[9:11] = (8).to_bytes(2, 'big')
+    assert estacion._trama_completa(corta, 28, 193)
+    assert not estacion._trama_completa(corta, 24, 193)
+
+
+def test_recibe_trama_en_fragmentos():
+    datos = bytearray(trama_datos(316, 1))
+    # Fin de trama entre los datos, justo al final del primer fragmento
+    datos[96:101] = bytes([16, 3, 0, 0, 5])
+    estacion_sock, local = socket.socketpair()
+    with estacion_sock, local:
+        def envia():
+            for inicio, fin in ((0, 5), (5, 101), (101, 150), (150, 193)):
+                estacion_sock.sendall(datos[inicio:fin])
+                time.sleep(0.05)
+        hilo = threading.Thread(target=envia)
+        hilo.start()
+        assert estacion._recibe_socket(local, 193, plazo=3) == bytes(datos)
+        hilo.join()
+
+        # La respuesta de error termina la recepción sin esperar al plazo
+        error = bytearray(trama_corta(316, fin=21))
+        error[9:11] = bytes([0xFF, 0xF0])
+        estacion_sock.sendall(error)
+        inicio = time.monotonic()
+        assert estacion._recibe_socket(local, 193, plazo=3) == bytes(error)
+        assert time.monotonic() - inicio < 1
+
+        # Sin respuesta se supera el plazo
+        with pytest.raises(socket.timeout):
+            estacion._recibe_socket(local, 193, plazo=0.1)
+
+
+@pytest.fixture
+def lecturas(monkeypatch):
+    # Lecturas simuladas de las estaciones, sin comunicación
+    llamadas = []
+
+    async def lee_canales_async(num_estacion, dir_socket=None, modo=1, plazo=None):
+        llamadas.append(time.time())
+        return FECHA, {'Canal': [float(num_estacion), 'u']}
+    monkeypatch.setattr(estacion, 'lee_canales_async', lee_canales_async)
+    return llamadas
+
+
+def test_adquisicion_alineada_con_el_reloj(lecturas):
+    muestras = []
+    adquisicion = estacion.Adquisicion(0.2, muestras.append, {316: '127.0.0.1', 2169: '127.0.0.2'}, modos=[1, 14])
+    asyncio.run(adquisicion.ejecuta(ciclos=3))
+
+    assert len(muestras) == 3 * 2 * 2
+    instantes = sorted({m['instante'].timestamp() for m in muestras})
+    assert len(instantes) == 3
+    for instante in instantes:
+        assert instante / 0.2 == pytest.approx(round(instante / 0.2))
+    assert all(m['saltados'] == 0 and m['error'] is None and m['retraso'] < 0.2 for m in muestras)
+
+
+def test_adquisicion_omite_los_ciclos_sobrepasados(lecturas):
+    muestras = []
+
+    def destino(muestra):
+        muestras.append(muestra)
+        if len(muestras) == 1:
+            time.sleep(0.5)
+
+    asyncio.run(estacion.Adquisicion(0.2, destino, {316: '127.0.0.1'}).ejecuta(ciclos=3))
+
+    intervalos = [round((b['instante'] - a['instante']).total_seconds() / 0.2) for a, b in zip(muestras, muestras[1:])]
+    assert intervalos[0] >= 3
+    assert intervalos[1] == 1
+    assert muestras[1]['saltados'] == intervalos[0] - 1
+    assert muestras[2]['saltados'] == 0
+
+
+def test_adquisicion_detiene_nada_mas_iniciar(lecturas):
+    # detiene() justo después de inicia() no falla aunque el hilo no haya creado todavía su bucle de eventos
+    for _ in range(20):
+        adquisicion = estacion.Adquisicion(0.05, lambda muestra: None, {316: '127.0.0.1'})
+        adquisicion.inicia()
+        adquisicion.detiene()
+        assert not adquisicion._hilo.is_alive()
+
+
+def test_adquisicion_cierra_solo_sus_conexiones(monkeypatch):
+    async def prueba():
+        loop = asyncio.get_running_loop()
+        ajena = estacion._sesion_async(('127.0.0.9', estacion.PORT))
+        estacion._sesion_async(('127.0.0.1', estacion.PORT))
+        await estacion.Adquisicion(0.05, lambda muestra: None, {316: '127.0.0.1'}).ejecuta(ciclos=1)
+        return estacion._sesiones_async[loop], ajena
+
+    async def lee_canales_async(num_estacion, dir_socket=None, modo=1, plazo=None):
+        return -1
+    monkeypatch.setattr(estacion, 'lee_canales_async', lee_canales_async)
+
+    sesiones, ajena = asyncio.run(prueba())
+    assert sesiones == {('127.0.0.9', estacion.PORT): ajena}
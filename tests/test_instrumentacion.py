@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la medida por etapas de instrumentacion.
+"""
+
+import datetime as dt
+
+import numpy as np
+
+from pygeonica import bbdd, instrumentacion
+
+
+def test_pico_de_memoria_de_etapas_anidadas():
+    with instrumentacion.Colector(memoria=True) as colector:
+        with instrumentacion.etapa('fuera'):
+            permanente = np.ones(10**6)
+            with instrumentacion.etapa('temporal'):
+                temporal = np.ones(4 * 10**6)
+                del temporal
+            with instrumentacion.etapa('vacia'):
+                pass
+    memoria = colector.tabla().set_index('etapa')['memoria']
+
+    # La memoria liberada al terminar la etapa cuenta en su pico y en el de la etapa que la contiene
+    assert memoria['temporal'] >= 32 * 10**6
+    assert memoria['fuera'] >= 40 * 10**6
+    assert memoria['vacia'] < 10**5
+    del permanente
+
+
+def test_etapas_de_la_lectura(servidor):
+    with instrumentacion.Colector() as colector:
+        bbdd.lee_dia_geonica_ddbb(dt.date(2019, 10, 26), 316)
+    etapas = set(colector.tabla()['etapa'])
+
+    assert {'consulta', 'lectura', 'pivot', 'ajuste_medias', 'hora_civil', 'formato_dia'} <= etapas
+    assert colector.tabla()['memoria'].isna().all()
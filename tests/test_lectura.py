@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la lectura de periodos por bloques: el resultado no depende del tamaño de los bloques
+ni de la longitud del periodo, y es el mismo que leyendo cada día por separado.
+"""
+
+import pandas as pd
+import pytest
+
+from pygeonica import bbdd
+
+from conftest import CANALES
+
+ESTACIONES = list(CANALES)
+DIA_INICIAL = '2019-10-25'
+DIA_FINAL = '2019-10-28'
+
+
+def _lee_periodo(**kwargs):
+    return pd.concat([data for _, data in bbdd.lee_periodo_estaciones_ddbb(DIA_INICIAL, DIA_FINAL, ESTACIONES,
+                                                                          **kwargs)])
+
+
+@pytest.mark.parametrize('chunk', [5000, 777])
+@pytest.mark.parametrize('profundidad_cola', [0, 2])
+def test_periodo_no_depende_del_chunk(servidor, chunk, profundidad_cola):
+    referencia = _lee_periodo(chunk=10**8)
+    data = _lee_periodo(chunk=chunk, profundidad_cola=profundidad_cola)
+
+    pd.testing.assert_frame_equal(data, referencia)
+
+
+def test_periodo_igual_que_por_dias(servidor):
+    data = _lee_periodo(chunk=5000)
+
+    for dia in pd.date_range(DIA_INICIAL, DIA_FINAL):
+        for estacion in ESTACIONES:
+            esperado = bbdd.lee_dia_geonica_ddbb(dia.date(), estacion).drop(columns='yyyy/mm/dd hh:mm')
+            obtenido = data[estacion].loc[str(dia.date())]
+            pd.testing.assert_frame_equal(obtenido, esperado, check_names=False, check_freq=False)
+
+
+def test_hueco_de_medias_mayor_que_un_dia(servidor):
+    # Temp. Ai 1 no tiene datos desde 2019-10-26 04:59 hasta 2019-10-27 12:00 (UTC): el día 26 se mantiene
+    # el último valor, y el día 27 no hay valor hasta el primer minuto con datos, a las 13:00 en hora civil
+    temperatura = _lee_periodo(chunk=5000)[(316, 'Temp. Ai 1')]
+
+    mantenido = temperatura.loc['2019-10-26 06:59':'2019-10-26 23:59']
+    assert mantenido.notna().all()
+    assert mantenido.nunique() == 1
+    assert temperatura.loc['2019-10-27 00:00':'2019-10-27 12:59'].isna().all()
+    assert temperatura.loc['2019-10-27 13:00':'2019-10-27 13:10'].notna().all()
+
+
+def test_cambio_de_hora(servidor):
+    # Todos los días tienen sus 1440 minutos, también los de cambio de hora, sin minutos repetidos
+    data = _lee_periodo()
+
+    assert len(data) == 4 * 1440
+    assert data.index.is_unique
+
+
+@pytest.mark.parametrize('profundidad_cola', [0, 2])
+def test_genera_dias_con_error_tras_entregar_un_dia(monkeypatch, profundidad_cola):
+    # La lectura del periodo falla, y al reintentar cada día la lectura falla después de entregarlo
+    dias = pd.date_range(DIA_INICIAL, DIA_FINAL)
+    escritos = []
+
+    def lee_periodo(dia_ini, dia_fin, *args, **kwargs):
+        if dia_ini != dia_fin:
+            raise RuntimeError('Error en la lectura del periodo')
+        yield dia_ini, None
+        raise RuntimeError('Error tras entregar el día')
+
+    def escribe(dia, *args):
+        escritos.append(dia)
+        return str(dia)
+
+    monkeypatch.setattr(bbdd, 'lee_periodo_estaciones_ddbb', lee_periodo)
+    monkeypatch.setattr(bbdd, '_escribe_fichero_meteo', escribe)
+    fallos = bbdd._genera_dias(dias, ESTACIONES, None, [], {}, None, None, profundidad_cola=profundidad_cola)
+
+    assert fallos == []
+    assert escritos == [dia.date() for dia in dias]
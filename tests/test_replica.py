@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la réplica local: sincronización incremental con la marca de cada estación
+y lectura de bbdd desde la réplica.
+"""
+
+import datetime as dt
+import functools
+import shutil
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from pygeonica import bbdd, replica
+
+from conftest import conecta
+
+ESTACIONES = [316, 2169]
+DESDE = '2019-10-23 23:59'
+CORTES = ['2019-10-25 10:30:00', '2019-10-26 03:17:00']
+
+
+@pytest.fixture
+def servidor_parcial(path_bbdd, tmp_path):
+    """
+    Copia de la base de datos sintética con las filas anteriores al primer corte, a la que se añaden filas
+    con anade(hasta).
+    """
+
+    path = str(tmp_path / 'servidor.db')
+    shutil.copy(path_bbdd, path)
+    with sqlite3.connect(path) as conexion:
+        conexion.execute('DELETE FROM Datos WHERE Fecha >= ?', (CORTES[0],))
+    conexion.close()
+
+    def anade(desde, hasta):
+        conexion = sqlite3.connect(path)
+        conexion.execute('ATTACH DATABASE ? AS original', (path_bbdd,))
+        conexion.execute('INSERT INTO Datos SELECT * FROM original.Datos WHERE Fecha >= ? AND Fecha < ?',
+                         (desde, hasta))
+        conexion.commit()
+        conexion.close()
+
+    return path, anade
+
+
+def _ordena(data):
+    return data.sort_values(bbdd.COLUMNAS_DATOS[:4], ignore_index=True)
+
+
+def _datos_servidor(path, desde='2019-01-01', hasta='2020-01-01'):
+    conexion = sqlite3.connect(path)
+    data = pd.read_sql('SELECT * FROM Datos WHERE Fecha >= ? AND Fecha < ?', conexion, params=[desde, hasta])
+    conexion.close()
+    data['Fecha'] = pd.to_datetime(data['Fecha'])
+    return _ordena(data)
+
+
+def _agregados_servidor(path, desde, hasta, freq):
+    data = _datos_servidor(path, desde, hasta)
+    data['Fecha'] = data['Fecha'].dt.floor(freq)
+    valor = data.groupby(['NumEstacion', 'Fecha', 'NumParametro', 'NumFuncion'])['Valor']
+    agregados = pd.DataFrame({'Media': valor.mean(), 'Minimo': valor.min(), 'Maximo': valor.max(),
+                              'Suma': valor.sum(), 'Cuenta': valor.count()}).reset_index()
+    return agregados[replica.COLUMNAS_AGREGADOS].sort_values(['Fecha', 'NumEstacion', 'NumParametro', 'NumFuncion'],
+                                                             ignore_index=True)
+
+
+def _filas(data):
+    return data['NumEstacion'].value_counts().reindex(ESTACIONES, fill_value=0).to_dict()
+
+
+@pytest.mark.parametrize('chunk', [bbdd.CHUNK_DATOS, 777])
+def test_sincronizacion_incremental(servidor_parcial, tmp_path, chunk):
+    path_servidor, anade = servidor_parcial
+    r = replica.Replica(str(tmp_path / 'replica.db'), fabrica=functools.partial(conecta, path_servidor))
+    try:
+        nuevas = r.sincroniza(ESTACIONES, desde=DESDE, chunk=chunk)
+        assert nuevas == _filas(_datos_servidor(path_servidor))
+        marcas = r.marcas()
+        assert marcas[316] == pd.Timestamp(CORTES[0]) - pd.Timedelta(minutes=1)
+
+        # Solo se añaden las filas nuevas, aunque se vuelva a leer el margen anterior a la marca
+        anade(CORTES[0], CORTES[1])
+        nuevas = r.sincroniza(ESTACIONES, chunk=chunk)
+        assert nuevas == _filas(_datos_servidor(path_servidor, CORTES[0]))
+        assert r.marcas()[316] == pd.Timestamp(CORTES[1]) - pd.Timedelta(minutes=1)
+
+        # Sin filas nuevas
+        assert r.sincroniza(ESTACIONES, chunk=chunk) == {estacion: 0 for estacion in ESTACIONES}
+
+        pd.testing.assert_frame_equal(_ordena(r.lee(ESTACIONES, '2019-01-01', '2020-01-01')),
+                                      _datos_servidor(path_servidor))
+    finally:
+        r.cierra()
+
+
+def test_filas_con_retraso(servidor_parcial, path_bbdd, tmp_path):
+    # Filas que llegan al servidor después de la sincronización, con una Fecha anterior a la marca
+    path_servidor, _ = servidor_parcial
+    retraso = ('2019-10-25 06:00', '2019-10-25 07:00')
+    conexion = sqlite3.connect(path_servidor)
+    conexion.execute('DELETE FROM Datos WHERE NumEstacion = 316 AND Fecha >= ? AND Fecha < ?', retraso)
+    conexion.commit()
+
+    r = replica.Replica(str(tmp_path / 'replica.db'), fabrica=functools.partial(conecta, path_servidor))
+    try:
+        r.sincroniza(ESTACIONES, desde=DESDE)
+
+        conexion.execute('ATTACH DATABASE ? AS original', (path_bbdd,))
+        n = conexion.execute('INSERT INTO Datos SELECT * FROM original.Datos '
+                             'WHERE NumEstacion = 316 AND Fecha >= ? AND Fecha < ?', retraso).rowcount
+        conexion.commit()
+        conexion.close()
+        assert n > 0
+
+        assert r.sincroniza(ESTACIONES) == {316: n, 2169: 0}
+        pd.testing.assert_frame_equal(_ordena(r.lee(ESTACIONES, '2019-01-01', '2020-01-01')),
+                                      _datos_servidor(path_servidor))
+        # Los agregados de los días con filas con retraso se recalculan
+        esperado = _agregados_servidor(path_servidor, '2019-10-25 00:00', '2019-10-25 10:00', 'H')
+        pd.testing.assert_frame_equal(r.get_aggregates(316, '2019-10-25 00:00', '2019-10-25 10:00'),
+                                      esperado[esperado['NumEstacion'] == 316].reset_index(drop=True),
+                                      check_dtype=False)
+    finally:
+        r.cierra()
+
+
+def test_lectura_desde_la_replica(servidor, tmp_path):
+    path = str(tmp_path / 'replica.db')
+    r = replica.Replica(path, fabrica=functools.partial(conecta, servidor))
+    r.sincroniza(ESTACIONES, desde=DESDE)
+    r.cierra()
+
+    def lee():
+        return pd.concat([data for _, data in bbdd.lee_periodo_estaciones_ddbb('2019-10-25', '2019-10-26',
+                                                                               ESTACIONES)])
+
+    esperado = lee()
+    fabrica = bbdd._pool_parametros['fabrica']
+    bbdd.configura_origen(replica=path)
+    try:
+        data = lee()
+    finally:
+        bbdd.configura_origen()
+
+    pd.testing.assert_frame_equal(data, esperado)
+    # Al volver al servidor se restablece la función de conexión configurada antes
+    assert bbdd._pool_parametros['fabrica'] is fabrica
+
+
+def test_sin_adaptador_global_de_fechas():
+    # La réplica no cambia cómo pasan las fechas a SQLite el resto de usuarios de sqlite3
+    adaptador = sqlite3.adapters.get((dt.datetime, sqlite3.PrepareProtocol))
+    assert (adaptador is None) or (adaptador.__module__ == 'sqlite3.dbapi2')
+
+
+@pytest.mark.parametrize('freq', ['H', 'D'])
+def test_agregados_igual_que_los_datos_en_bruto(servidor_parcial, tmp_path, freq):
+    path_servidor, anade = servidor_parcial
+    anade(CORTES[0], CORTES[1])
+    r = replica.Replica(str(tmp_path / 'replica.db'), fabrica=functools.partial(conecta, path_servidor))
+    try:
+        # La réplica empieza después del inicio de los datos, por lo que el principio del periodo
+        # y lo posterior a la marca se calculan con los datos del servidor
+        r.sincroniza(ESTACIONES, desde='2019-10-24 12:00')
+        anade(CORTES[1], '2019-10-27 00:00')
+        agregados = r.get_aggregates(ESTACIONES, '2019-10-24 00:00', '2019-10-27 00:00', freq=freq)
+    finally:
+        r.cierra()
+
+    esperado = _agregados_servidor(path_servidor, '2019-10-24 00:00', '2019-10-27 00:00', freq)
+    pd.testing.assert_frame_equal(agregados, esperado, check_dtype=False)